@@ -1,22 +1,37 @@
 from fastapi import FastAPI, Depends, HTTPException, status, Form, Request, Body
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from dotenv import load_dotenv
 import os
 import uvicorn
 import requests
 import json
+import asyncio
+import functools
 from datetime import datetime, timedelta
+from typing import Optional
 import sys
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from shared.database import init_database, get_db_connection
+from shared.database import init_database, get_db_connection, iniciar_escrita, executar_no_banco, no_banco, CheckpointWAL
 from shared.auth import (
     create_access_token, get_current_user, require_admin,
     verify_password, ACCESS_TOKEN_EXPIRE_MINUTES
 )
-from shared.sync import ReplicaManager, load_replicas
+from shared.sync import ReplicaManager, AntiEntropia, ClienteRegistro, RegistroReplicas, load_replicas, sincronizar_catalogo
+from shared.feed import ConsumidorFeed
+from shared.idempotencia import LimpezaIdempotencia, buscar_resposta, salvar_resposta, limpar_respostas
+from shared.circuit_breaker import circuitos
+from shared.reservas import ConfirmadorReservas, init_confirmacoes, listar_recusadas
+from shared.pedidos import (
+    buscar_pedidos, normalizar_data, normalizar_fim, normalizar_dia, exportar_pedidos, ultimo_pedido,
+    acumular_vendas, consultar_vendas, consultar_vendas_produtos,
+    validar_itens, ler_lote, validar_lote, gravar_pedidos_lote, PEDIDOS_LOTE_BLOCO
+)
+from shared.repositorio import Armazenamento, ArmazenamentoSQLite
+from shared.escrow import SincronizadorCotas, init_cotas_filial, consumir_cota, registrar_venda
 
 load_dotenv('.env')
 
@@ -34,77 +49,92 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-REPLICAS = load_replicas('alvorada')
+REPLICAS = RegistroReplicas(load_replicas('alvorada'))
 
 replica_manager = ReplicaManager("alvorada", REPLICAS)
 
+cliente_registro = ClienteRegistro(
+    replica_manager.current_api_name,
+    os.getenv('API_URL', f"http://localhost:{API_PORT}"),
+    REPLICAS,
+    ["feed", "estoque_lote", "anti_entropia", "reservas", "cotas"],
+    app.version
+)
+
+anti_entropia = AntiEntropia(
+    DATABASE_NAME,
+    REPLICAS.get('matriz'),
+    intervalo=float(os.getenv('ANTI_ENTROPIA_INTERVALO_S', 300))
+)
+
+confirmador_reservas = ConfirmadorReservas(DATABASE_NAME, REPLICAS.get('matriz'))
+
+sincronizador_cotas = SincronizadorCotas(DATABASE_NAME, replica_manager.current_api_name, REPLICAS.get('matriz'))
+
+checkpoint_wal = CheckpointWAL(DATABASE_NAME)
+
+def limpar_idempotencia() -> int:
+    conn = get_db_connection(DATABASE_NAME)
+    try:
+        iniciar_escrita(conn)
+        removidas = limpar_respostas(conn.cursor())
+        conn.commit()
+        return removidas
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+limpeza_idempotencia = LimpezaIdempotencia(limpar_idempotencia)
+
+armazenamento: Armazenamento = ArmazenamentoSQLite(DATABASE_NAME)
+
+def sincronizar_com_matriz():
+    matriz_url = REPLICAS.get('matriz')
+    if not matriz_url:
+        return
+    
+    try:
+        token = create_access_token(data={"sub": "admin"}, expires_delta=timedelta(minutes=5))
+        headers = {"Authorization": f"Bearer {token}"}
+        aplicados = sincronizar_catalogo(DATABASE_NAME, matriz_url, headers)
+        print(f"Sincronização com a matriz concluída: {aplicados} alterações aplicadas")
+    except Exception as e:
+        print(f"ERRO: Falha ao sincronizar com a matriz: {e}")
+    
+    consumidor_feed = ConsumidorFeed(DATABASE_NAME, replica_manager.current_api_name, matriz_url)
+    consumidor_feed.start()
+    anti_entropia.start()
+
 @app.on_event("startup")
 async def startup_event():
     init_database(DATABASE_NAME, API_NAME)
-    
-    matriz_url = REPLICAS.get('matriz')
-    if matriz_url:
-        try:
-            token = create_access_token(data={"sub": "admin"}, expires_delta=timedelta(minutes=5))
-            headers = {"Authorization": f"Bearer {token}"}
-            response = requests.get(f"{matriz_url}/produtos", headers=headers, timeout=5)
-            
-            if response.status_code == 200:
-                produtos_matriz = response.json()
-                conn = get_db_connection(DATABASE_NAME)
-                cursor = conn.cursor()
-                
-                for produto in produtos_matriz:
-                    try:
-                        cursor.execute(
-                            "SELECT id FROM produtos WHERE codigo = ?",
-                            (produto['codigo'],)
-                        )
-                        produto_local = cursor.fetchone()
-                        
-                        if not produto_local:
-                            cursor.execute(
-                                "INSERT INTO produtos (codigo, nome, preco) VALUES (?, ?, ?)",
-                                (produto['codigo'], produto['nome'], produto['preco'])
-                            )
-                            produto_id_local = cursor.lastrowid
-                            
-                            resp_estoque = requests.get(f"{matriz_url}/estoque/{produto['codigo']}", headers=headers, timeout=3)
-                            quantidade_matriz = 0
-                            if resp_estoque.status_code == 200:
-                                quantidade_matriz = resp_estoque.json().get('quantidade', 0)
-                            
-                            cursor.execute(
-                                "INSERT INTO estoque (produto_id, quantidade) VALUES (?, ?)",
-                                (produto_id_local, quantidade_matriz)
-                            )
-                        else:
-                            resp_estoque = requests.get(f"{matriz_url}/estoque/{produto['codigo']}", headers=headers, timeout=3)
-                            if resp_estoque.status_code == 200:
-                                quantidade_matriz = resp_estoque.json().get('quantidade', 0)
-                                cursor.execute(
-                                    "UPDATE estoque SET quantidade = ? WHERE produto_id = ?",
-                                    (quantidade_matriz, produto_local['id'])
-                                )
-                    except:
-                        pass
-                
-                conn.commit()
-                conn.close()
-        except:
-            pass
+    init_confirmacoes(DATABASE_NAME)
+    init_cotas_filial(DATABASE_NAME)
+    asyncio.get_running_loop().run_in_executor(None, sincronizar_com_matriz)
+    replica_manager.start()
+    cliente_registro.start()
+    confirmador_reservas.start()
+    sincronizador_cotas.start()
+    limpeza_idempotencia.start()
+    checkpoint_wal.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await replica_manager.stop()
+    cliente_registro.stop()
+    confirmador_reservas.stop()
+    sincronizador_cotas.stop()
+    anti_entropia.stop()
+    limpeza_idempotencia.stop()
+    checkpoint_wal.stop()
 
 @app.post("/login", include_in_schema=False)
-async def login(form_data: OAuth2PasswordRequestForm = Depends()):
-    conn = get_db_connection(DATABASE_NAME)
-    cursor = conn.cursor()
-    
-    cursor.execute(
-        "SELECT * FROM usuarios WHERE login = ?",
-        (form_data.username,)
-    )
-    user_data = cursor.fetchone()
-    conn.close()
+@no_banco
+def login(form_data: OAuth2PasswordRequestForm = Depends()):
+    with armazenamento.leitura() as repositorio:
+        user_data = repositorio.buscar_usuario(form_data.username)
     
     if not user_data or not verify_password(form_data.password, user_data['password']):
         raise HTTPException(
@@ -120,27 +150,16 @@ async def login(form_data: OAuth2PasswordRequestForm = Depends()):
     return {"access_token": access_token, "token_type": "bearer"}
 
 @app.post("/usuarios", tags=["Usuários"])
-async def criar_usuario(
+@no_banco
+def criar_usuario(
     login: str = Form(default="teste"),
     password: str = Form(default="teste123"),
     current_user: dict = Depends(require_admin)
 ):
-    conn = get_db_connection(DATABASE_NAME)
-    cursor = conn.cursor()
-    
     try:
-        cursor.execute(
-            "SELECT * FROM usuarios WHERE login = ?",
-            (login,)
-        )
-        if cursor.fetchone():
-            raise HTTPException(status_code=400, detail="Login já existe")
-        
-        cursor.execute(
-            "INSERT INTO usuarios (login, password) VALUES (?, ?)",
-            (login, password)
-        )
-        conn.commit()
+        with armazenamento.escrita() as repositorio:
+            if not repositorio.criar_usuario(login, password):
+                raise HTTPException(status_code=400, detail="Login já existe")
         
         return {
             "message": "Usuário criado com sucesso"
@@ -148,53 +167,19 @@ async def criar_usuario(
     except HTTPException:
         raise
     except Exception as e:
-        conn.rollback()
         raise HTTPException(status_code=409, detail=str(e))
-    finally:
-        conn.close()
 
 @app.get("/produtos", tags=["Produtos"])
-async def listar_produtos(current_user: dict = Depends(get_current_user)):
-    conn = get_db_connection(DATABASE_NAME)
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT id, codigo, nome, preco, criado_em FROM produtos")
-    produtos = cursor.fetchall()
-    conn.close()
-    
-    return [
-        {
-            "id": produto['id'],
-            "codigo": produto['codigo'],
-            "nome": produto['nome'],
-            "preco": produto['preco'],
-            "criado_em": produto['criado_em']
-        }
-        for produto in produtos
-    ]
+@no_banco
+def listar_produtos(current_user: dict = Depends(get_current_user)):
+    with armazenamento.leitura() as repositorio:
+        return repositorio.listar_produtos()
 
-@app.post("/produtos", tags=["Produtos"])
-async def criar_produto(
-    request: Request,
-    current_user: dict = Depends(require_admin),
-    codigo: str = Form(default="123"),
-    nome: str = Form(default="mesa"),
-    preco: float = Form(default=10.0),
-    quantidade: int = Form(default=100)
-):
-    form_data = await request.form()
-    origem = form_data.get('origem', None)
-    
-    conn = get_db_connection(DATABASE_NAME)
-    cursor = conn.cursor()
-    
+def gravar_produto(codigo, nome, preco, quantidade, origem) -> dict:
     try:
-        cursor.execute(
-            "SELECT * FROM produtos WHERE codigo = ?",
-            (codigo,)
-        )
-        if cursor.fetchone():
-            raise HTTPException(status_code=400, detail="Código de produto já existe")
+        with armazenamento.leitura() as repositorio:
+            if repositorio.existe_produto(codigo):
+                raise HTTPException(status_code=400, detail="Código de produto já existe")
         
         if not origem:
             token = create_access_token(data={"sub": "admin"}, expires_delta=timedelta(minutes=5))
@@ -210,7 +195,9 @@ async def criar_produto(
             matriz_url = REPLICAS.get('matriz')
             if matriz_url:
                 try:
-                    resp = requests.post(
+                    resp = circuitos.request(
+                        'matriz',
+                        "POST",
                         f"{matriz_url}/produtos",
                         data=data,
                         headers=headers,
@@ -232,118 +219,201 @@ async def criar_produto(
                 except requests.RequestException as e:
                     raise HTTPException(status_code=503, detail=f"Erro de rede ao contatar matriz: {str(e)}")
 
-        cursor.execute(
-            "INSERT INTO produtos (codigo, nome, preco) VALUES (?, ?, ?)",
-            (codigo, nome, preco)
-        )
-        produto_id = cursor.lastrowid
+        with armazenamento.escrita() as repositorio:
+            repositorio.criar_produto(codigo, nome, preco, quantidade)
         
-        cursor.execute(
-            "INSERT INTO estoque (produto_id, quantidade) VALUES (?, ?)",
-            (produto_id, quantidade)
-        )
-        
-        conn.commit()
         return {
             "message": "Produto criado com sucesso"
         }
     except HTTPException:
-        conn.rollback()
         raise
     except Exception as e:
-        conn.rollback()
         raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/produtos", tags=["Produtos"])
+async def criar_produto(
+    request: Request,
+    current_user: dict = Depends(require_admin),
+    codigo: str = Form(default="123"),
+    nome: str = Form(default="mesa"),
+    preco: float = Form(default=10.0),
+    quantidade: int = Form(default=100)
+):
+    form_data = await request.form()
+    origem = form_data.get('origem', None)
+    
+    # Pode esperar a matriz, então roda no executor padrão e não ocupa as threads do banco
+    return await asyncio.get_running_loop().run_in_executor(None, gravar_produto, codigo, nome, preco, quantidade, origem)
+
+@app.get("/pedidos", tags=["Pedidos"])
+@no_banco
+def listar_pedidos(
+    limite: int = 100,
+    cursor: Optional[str] = None,
+    data_inicio: Optional[str] = None,
+    data_fim: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    limite = max(1, min(limite, 1000))
+    data_inicio = normalizar_data(data_inicio, 'data_inicio')
+    data_fim = normalizar_fim(data_fim, 'data_fim')
+    
+    conn = get_db_connection(DATABASE_NAME)
+    try:
+        return buscar_pedidos(conn.cursor(), limite, cursor, data_inicio, data_fim)
     finally:
         conn.close()
 
-@app.get("/pedidos", tags=["Pedidos"])
-async def listar_pedidos(
+@app.get("/pedidos/exportar", tags=["Pedidos"])
+@no_banco
+def exportar_pedidos_filial(
+    request: Request,
+    formato: str = "ndjson",
+    desde_id: int = 0,
+    data_inicio: Optional[str] = None,
+    data_fim: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
+    if formato not in ["ndjson", "csv"]:
+        raise HTTPException(status_code=400, detail="Formato inválido. Use 'ndjson' ou 'csv'")
+    
+    data_inicio = normalizar_data(data_inicio, 'data_inicio')
+    data_fim = normalizar_fim(data_fim, 'data_fim')
+    compactar = "gzip" in request.headers.get("accept-encoding", "")
+    
     conn = get_db_connection(DATABASE_NAME)
-    cursor = conn.cursor()
+    ate_id = ultimo_pedido(conn.cursor())
     
-    cursor.execute(
-        "SELECT id, total, criado_em FROM pedidos ORDER BY criado_em DESC"
-    )
-    pedidos = cursor.fetchall()
+    # O último id entra no cabeçalho para a próxima exportação incremental começar dele
+    headers = {
+        "Content-Disposition": f"attachment; filename=pedidos.{formato}",
+        "X-Ultimo-Id": str(ate_id)
+    }
+    if compactar:
+        headers["Content-Encoding"] = "gzip"
     
-    resultado = []
-    for pedido in pedidos:
-        cursor.execute(
-            "SELECT pi.quantidade, pi.preco_unitario, pi.subtotal, p.id as produto_id, p.codigo, p.nome FROM pedidos_itens pi JOIN produtos p ON pi.produto_id = p.id WHERE pi.pedido_id = ?",
-            (pedido['id'],)
-        )
-        itens = cursor.fetchall()
-        
-        resultado.append({
-            "id": pedido['id'],
-            "total": pedido['total'],
-            "criado_em": pedido['criado_em'],
-            "itens": [
-                {
-                    "produto_id": item['produto_id'],
-                    "produto_codigo": item['codigo'],
-                    "produto_nome": item['nome'],
-                    "quantidade": item['quantidade'],
-                    "preco_unitario": item['preco_unitario'],
-                    "subtotal": item['subtotal']
-                }
-                for item in itens
-            ]
-        })
-    
-    conn.close()
-    return resultado
+    return StreamingResponse(
+        exportar_pedidos(conn, formato, compactar, desde_id, ate_id, data_inicio, data_fim),
+        media_type="text/csv" if formato == "csv" else "application/x-ndjson",
+        headers=headers
+    )
 
 @app.get("/pedido/{pedido_id}", tags=["Pedidos"])
-async def consultar_pedido(
+@no_banco
+def consultar_pedido(
     pedido_id: int,
     current_user: dict = Depends(get_current_user)
 ):
-    conn = get_db_connection(DATABASE_NAME)
-    cursor = conn.cursor()
-    
-    cursor.execute(
-        "SELECT id, total, criado_em FROM pedidos WHERE id = ?",
-        (pedido_id,)
-    )
-    pedido = cursor.fetchone()
+    with armazenamento.leitura() as repositorio:
+        pedido = repositorio.buscar_pedido(pedido_id)
     
     if not pedido:
-        conn.close()
         raise HTTPException(status_code=404, detail="Pedido não encontrado")
     
-    cursor.execute(
-        "SELECT pi.quantidade, pi.preco_unitario, pi.subtotal, p.id as produto_id, p.codigo, p.nome FROM pedidos_itens pi JOIN produtos p ON pi.produto_id = p.id WHERE pi.pedido_id = ?",
-        (pedido_id,)
-    )
-    itens = cursor.fetchall()
-    conn.close()
+    return pedido
+
+def validar_itens_pedido(itens) -> tuple:
+    with armazenamento.leitura() as repositorio:
+        return validar_itens(repositorio, itens)
+
+def consultar_resposta(escopo: str, chave_idempotencia):
+    if not chave_idempotencia:
+        return None
+    conn = get_db_connection(DATABASE_NAME)
+    try:
+        return buscar_resposta(conn.cursor(), escopo, chave_idempotencia)
+    finally:
+        conn.close()
+
+def erro_matriz(e: requests.HTTPError) -> HTTPException:
+    detail = f"Matriz recusou baixa de estoque: {e.response.text}"
+    try:
+        detail_json = e.response.json().get('detail')
+        if detail_json:
+            detail = f"Matriz recusou: {detail_json}"
+    except:
+        pass
+    return HTTPException(status_code=e.response.status_code, detail=detail)
+
+def gravar_pedido(cursor, total_pedido, itens_validados, chave_idempotencia) -> dict:
+    with armazenamento.na_transacao(cursor) as repositorio:
+        pedido_id = repositorio.criar_pedido(total_pedido, itens_validados)
     
-    return {
-        "id": pedido['id'],
-        "total": pedido['total'],
-        "criado_em": pedido['criado_em'],
-        "itens": [
-            {
-                "produto_id": item['produto_id'],
-                "produto_codigo": item['codigo'],
-                "produto_nome": item['nome'],
-                "quantidade": item['quantidade'],
-                "preco_unitario": item['preco_unitario'],
-                "subtotal": item['subtotal']
-            }
-            for item in itens
-        ]
+    acumular_vendas(cursor, pedido_id, total_pedido, itens_validados)
+    
+    resposta = {
+        "message": "Pedido criado com sucesso",
+        "pedido_id": pedido_id,
+        "total": total_pedido,
+        "itens": itens_validados
     }
+    salvar_resposta(cursor, "pedido", chave_idempotencia, resposta)
+    return resposta
+
+def criar_pedido_na_cota(total_pedido, itens_validados, chave_idempotencia):
+    conn = get_db_connection(DATABASE_NAME)
+    cursor = conn.cursor()
+    
+    try:
+        iniciar_escrita(conn)
+        
+        resposta_anterior = buscar_resposta(cursor, "pedido", chave_idempotencia)
+        if resposta_anterior:
+            conn.rollback()
+            return resposta_anterior
+        
+        if not sincronizador_cotas.cota_valida() or not consumir_cota(cursor, itens_validados):
+            conn.rollback()
+            return None
+        
+        resposta = gravar_pedido(cursor, total_pedido, itens_validados, chave_idempotencia)
+        conn.commit()
+        return resposta
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def gravar_pedido_reservado(total_pedido, itens_validados, chave_idempotencia, reserva_id) -> dict:
+    conn = get_db_connection(DATABASE_NAME)
+    cursor = conn.cursor()
+    
+    try:
+        iniciar_escrita(conn)
+        
+        resposta_anterior = buscar_resposta(cursor, "pedido", chave_idempotencia)
+        if resposta_anterior:
+            conn.rollback()
+            return resposta_anterior
+        
+        resposta = gravar_pedido(cursor, total_pedido, itens_validados, chave_idempotencia)
+        registrar_venda(cursor, itens_validados)
+        
+        if reserva_id:
+            cursor.execute(
+                "INSERT INTO reservas_pendentes (reserva_id, pedido_id) VALUES (?, ?)",
+                (reserva_id, resposta['pedido_id'])
+            )
+        
+        conn.commit()
+        confirmador_reservas.notificar()
+        
+        return resposta
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
 
 @app.post("/pedido", tags=["Pedidos"])
 async def criar_pedido(
+    request: Request,
     pedido: dict = Body(example={"itens": [{"codigo_produto": "123", "quantidade": 5}]}),
     current_user: dict = Depends(get_current_user)
 ):
     itens = pedido.get('itens', [])
+    chave_idempotencia = request.headers.get('Idempotency-Key')
     
     if not isinstance(itens, list):
         raise HTTPException(status_code=400, detail="Formato inválido para itens")
@@ -351,130 +421,226 @@ async def criar_pedido(
     if not itens:
         raise HTTPException(status_code=400, detail="Pedido deve conter ao menos um item")
     
+    resposta_anterior = await executar_no_banco(consultar_resposta, "pedido", chave_idempotencia)
+    if resposta_anterior:
+        return resposta_anterior
+    
+    try:
+        total_pedido, itens_validados = await executar_no_banco(validar_itens_pedido, itens)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Itens do pedido inválidos: {str(e)}")
+    
+    # Se todas as linhas cabem na cota da filial, o pedido é confirmado sem falar com a matriz
+    try:
+        resposta = await executar_no_banco(criar_pedido_na_cota, total_pedido, itens_validados, chave_idempotencia)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    if resposta:
+        return resposta
+    
+    # A reserva na matriz acontece antes da trava local, o banco da filial só fica travado durante a gravação
+    loop = asyncio.get_running_loop()
+    reserva_id = None
+    if REPLICAS.get('matriz'):
+        try:
+            reserva = await loop.run_in_executor(
+                None,
+                confirmador_reservas.reservar,
+                [
+                    {"codigo_produto": item['produto_codigo'], "quantidade": item['quantidade']}
+                    for item in itens_validados
+                ],
+                API_NAME,
+                f"{API_NAME}:pedido:{chave_idempotencia}" if chave_idempotencia else None
+            )
+            reserva_id = reserva['reserva_id']
+        except requests.HTTPError as e:
+            raise erro_matriz(e)
+        except Exception as e:
+            raise HTTPException(status_code=503, detail=f"Erro de rede ao atualizar estoque na matriz: {str(e)}")
+    
+    try:
+        return await executar_no_banco(gravar_pedido_reservado, total_pedido, itens_validados, chave_idempotencia, reserva_id)
+    except Exception as e:
+        if reserva_id:
+            await loop.run_in_executor(None, confirmador_reservas.liberar, reserva_id)
+        if isinstance(e, HTTPException):
+            raise
+        raise HTTPException(status_code=500, detail=str(e))
+
+def reservar_bloco(bloco) -> list:
+    quantidades = {}
+    for pedido in bloco:
+        for codigo, quantidade in pedido['quantidades'].items():
+            quantidades[codigo] = quantidades.get(codigo, 0) + quantidade
+    
+    try:
+        reserva = confirmador_reservas.reservar(
+            [{"codigo_produto": codigo, "quantidade": quantidade} for codigo, quantidade in quantidades.items()],
+            API_NAME
+        )
+        return [(reserva['reserva_id'], bloco)]
+    except requests.HTTPError as e:
+        if e.response.status_code not in (400, 404, 409):
+            for pedido in bloco:
+                pedido.update(status_code=e.response.status_code, erro=erro_matriz(e).detail)
+            return []
+    except Exception as e:
+        for pedido in bloco:
+            pedido.update(status_code=503, erro=f"Erro de rede ao atualizar estoque na matriz: {str(e)}")
+        return []
+    
+    # A matriz recusou o bloco inteiro, então cada pedido tenta a sua própria reserva para só os sem estoque falharem
+    reservas = []
+    for pedido in bloco:
+        try:
+            reserva = confirmador_reservas.reservar(
+                [{"codigo_produto": codigo, "quantidade": quantidade} for codigo, quantidade in pedido['quantidades'].items()],
+                API_NAME
+            )
+            reservas.append((reserva['reserva_id'], [pedido]))
+        except requests.HTTPError as e:
+            pedido.update(status_code=e.response.status_code, erro=erro_matriz(e).detail)
+        except Exception as e:
+            pedido.update(status_code=503, erro=f"Erro de rede ao atualizar estoque na matriz: {str(e)}")
+    return reservas
+
+def gravar_bloco(bloco, reservas) -> bool:
     conn = get_db_connection(DATABASE_NAME)
     cursor = conn.cursor()
     
     try:
-        conn.execute("BEGIN EXCLUSIVE")
+        iniciar_escrita(conn)
         
-        total_pedido = 0
-        itens_validados = []
+        # Uma chave pode ter sido usada por um POST /pedido depois da conferência inicial
+        repetidos = False
+        for pedido in bloco:
+            resposta_anterior = buscar_resposta(cursor, "pedido", pedido['chave'])
+            if resposta_anterior:
+                pedido.update(repetido=True, pedido_id=resposta_anterior['pedido_id'], total=resposta_anterior['total'])
+                repetidos = True
+        if repetidos:
+            conn.rollback()
+            return False
         
-        for item in itens:
-            codigo_produto = item.get('codigo_produto')
-            quantidade = item.get('quantidade', 0)
-            
-            if not codigo_produto:
-                raise HTTPException(status_code=400, detail="Item do pedido não contém 'codigo_produto'")
-            
-            cursor.execute(
-                "SELECT p.id, p.codigo, p.nome, p.preco, e.quantidade FROM produtos p JOIN estoque e ON p.id = e.produto_id WHERE p.codigo = ?",
-                (codigo_produto,)
-            )
-            produto = cursor.fetchone()
-            
-            if not produto:
-                raise HTTPException(status_code=404, detail=f"Produto com código {codigo_produto} não encontrado")
-            
-            if produto['quantidade'] < quantidade:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"Estoque insuficiente para {produto['nome']}. Disponível: {produto['quantidade']}"
-                )
-            
-            subtotal = quantidade * produto['preco']
-            total_pedido += subtotal
-            
-            itens_validados.append({
-                'produto_id': produto['id'],
-                'produto_codigo': produto['codigo'],
-                'produto_nome': produto['nome'],
-                'quantidade': quantidade,
-                'preco_unitario': produto['preco'],
-                'subtotal': subtotal
+        gravar_pedidos_lote(cursor, bloco)
+        for pedido in bloco:
+            salvar_resposta(cursor, "pedido", pedido['chave'], {
+                "message": "Pedido criado com sucesso",
+                "pedido_id": pedido['pedido_id'],
+                "total": pedido['total'],
+                "itens": pedido['itens']
             })
-        
-        cursor.execute(
-            "INSERT INTO pedidos (total) VALUES (?)",
-            (total_pedido,)
+        cursor.executemany(
+            "INSERT INTO reservas_pendentes (reserva_id, pedido_id) VALUES (?, ?)",
+            [(reserva_id, pedidos[0]['pedido_id']) for reserva_id, pedidos in reservas]
         )
-        pedido_id = cursor.lastrowid
-        
-        token = create_access_token(data={"sub": "admin"}, expires_delta=timedelta(minutes=5))
-        headers = {"Authorization": f"Bearer {token}"}
-        matriz_url = REPLICAS.get('matriz')
         
-        for item in itens_validados:
-            cursor.execute(
-                "INSERT INTO pedidos_itens (pedido_id, produto_id, quantidade, preco_unitario, subtotal) VALUES (?, ?, ?, ?, ?)",
-                (pedido_id, item['produto_id'], item['quantidade'], item['preco_unitario'], item['subtotal'])
-            )
-            
-            cursor.execute(
-                "UPDATE estoque SET quantidade = quantidade - ?, atualizado_em = CURRENT_TIMESTAMP WHERE produto_id = ?",
-                (item['quantidade'], item['produto_id'])
-            )
-            
-            if matriz_url:
-                try:
-                    data = {
-                        "operacao": "saida",
-                        "quantidade": item['quantidade'],
-                        "origem": API_NAME
-                    }
-                    resp_put = requests.put(
-                        f"{matriz_url}/estoque/{item['produto_codigo']}",
-                        data=data,
-                        headers=headers,
-                        timeout=5
-                    )
-                    resp_put.raise_for_status()
+        conn.commit()
+        return True
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
 
-                except requests.HTTPError as e:
-                    detail = f"Matriz recusou baixa de estoque: {e.response.text}"
-                    try:
-                        detail_json = e.response.json().get('detail')
-                        if detail_json:
-                            detail = f"Matriz recusou: {detail_json}"
-                    except:
-                        pass
-                    raise HTTPException(status_code=e.response.status_code, detail=detail)
-                
-                except Exception as e:
-                    raise HTTPException(status_code=503, detail=f"Erro de rede ao atualizar estoque na matriz: {str(e)}")
+def processar_bloco(bloco):
+    while bloco:
+        reservas = reservar_bloco(bloco) if REPLICAS.get('matriz') else []
+        bloco = [pedido for pedido in bloco if 'erro' not in pedido]
+        if not bloco:
+            return
         
-        conn.commit()
+        try:
+            gravado = gravar_bloco(bloco, reservas)
+        except Exception as e:
+            gravado = None
+            for pedido in bloco:
+                pedido.update(status_code=500, erro=str(e))
+        
+        if gravado:
+            confirmador_reservas.notificar()
+            return
+        for reserva_id, _ in reservas:
+            confirmador_reservas.liberar(reserva_id)
+        if gravado is None:
+            return
+        bloco = [pedido for pedido in bloco if not pedido.get('repetido')]
+
+def resultado_lote(pedido) -> dict:
+    resultado = {"linha": pedido['linha'], "referencia": pedido.get('referencia')}
+    if 'erro' in pedido:
+        resultado.update(status="erro", status_code=pedido['status_code'], detail=pedido['erro'])
+    else:
+        resultado.update(
+            status="repetido" if pedido.get('repetido') else "criado",
+            pedido_id=pedido['pedido_id'],
+            total=pedido['total']
+        )
+    return resultado
+
+def processar_lote(pedidos):
+    conn = get_db_connection(DATABASE_NAME)
+    try:
+        cursor = conn.cursor()
+        for pedido in pedidos:
+            if 'erro' not in pedido:
+                resposta_anterior = buscar_resposta(cursor, "pedido", pedido['chave'])
+                if resposta_anterior:
+                    pedido.update(repetido=True, pedido_id=resposta_anterior['pedido_id'], total=resposta_anterior['total'])
+        validar_lote(cursor, [pedido for pedido in pedidos if not pedido.get('repetido')])
+    finally:
+        conn.close()
+    
+    # Pedidos do lote não usam a cota da filial nem entram na demanda dela, a cota fica para o atendimento de balcão
+    for inicio in range(0, len(pedidos), PEDIDOS_LOTE_BLOCO):
+        bloco = pedidos[inicio:inicio + PEDIDOS_LOTE_BLOCO]
+        processar_bloco([pedido for pedido in bloco if 'erro' not in pedido and not pedido.get('repetido')])
+        yield "".join(json.dumps(resultado_lote(pedido)) + "\n" for pedido in bloco)
+
+@app.post("/pedidos/lote", tags=["Pedidos"])
+async def criar_pedidos_lote(
+    request: Request,
+    current_user: dict = Depends(get_current_user)
+):
+    pedidos = ler_lote(await request.body())
+    if not pedidos:
+        raise HTTPException(status_code=400, detail="Lote deve conter ao menos um pedido")
+    
+    return StreamingResponse(processar_lote(pedidos), media_type="application/x-ndjson")
+
+@app.put("/estoque/lote", include_in_schema=False)
+@no_banco
+def atualizar_estoque_lote(
+    lote: dict = Body(...),
+    current_user: dict = Depends(require_admin)
+):
+    itens = lote.get('itens', [])
+    
+    if not lote.get('origem') or not isinstance(itens, list):
+        raise HTTPException(status_code=400, detail="Lote de estoque inválido")
+    
+    try:
+        with armazenamento.escrita() as repositorio:
+            repositorio.definir_estoques({item['codigo_produto']: int(item['quantidade_atual']) for item in itens})
         
         return {
-            "message": "Pedido criado com sucesso",
-            "pedido_id": pedido_id,
-            "total": total_pedido,
-            "itens": itens_validados
+            "message": "Estoque atualizado",
+            "itens": len(itens)
         }
-        
-    except HTTPException:
-        conn.rollback()
-        raise
     except Exception as e:
-        conn.rollback()
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
 
 @app.get("/estoque/{codigo_produto}", tags=["Estoque"])
-async def consultar_estoque(
+@no_banco
+def consultar_estoque(
     codigo_produto: str,
     current_user: dict = Depends(get_current_user)
 ):
-    conn = get_db_connection(DATABASE_NAME)
-    cursor = conn.cursor()
-    
-    cursor.execute(
-        "SELECT p.id, p.codigo, p.nome, e.quantidade, e.atualizado_em FROM produtos p JOIN estoque e ON p.id = e.produto_id WHERE p.codigo = ?",
-        (codigo_produto,)
-    )
-    resultado = cursor.fetchone()
-    conn.close()
+    with armazenamento.leitura() as repositorio:
+        resultado = repositorio.buscar_produto(codigo_produto)
     
     if not resultado:
         raise HTTPException(status_code=404, detail="Produto não encontrado")
@@ -487,6 +653,59 @@ async def consultar_estoque(
         "atualizado_em": resultado['atualizado_em']
     }
 
+def consultar_saldo(codigo_produto):
+    with armazenamento.leitura() as repositorio:
+        return repositorio.buscar_produto(codigo_produto)
+
+def gravar_estoque(codigo_produto, operacao, quantidade, origem, quantidade_atual, chave_idempotencia, resposta_matriz) -> dict:
+    try:
+        with armazenamento.escrita() as repositorio:
+            resposta_anterior = repositorio.buscar_resposta(f"estoque:{codigo_produto}", chave_idempotencia)
+            if resposta_anterior:
+                return resposta_anterior
+            
+            produto = repositorio.buscar_produto(codigo_produto)
+            
+            if not produto:
+                raise HTTPException(status_code=404, detail="Produto não encontrado")
+            
+            produto_id_local = produto['id']
+            quantidade_anterior = produto['quantidade']
+
+            if resposta_matriz:
+                nova_quantidade = int(resposta_matriz['quantidade_atual'])
+            elif origem and quantidade_atual is not None:
+                nova_quantidade = int(quantidade_atual)
+            elif operacao == "entrada":
+                nova_quantidade = quantidade_anterior + quantidade
+            else:
+                if quantidade_anterior < quantidade:
+                    raise HTTPException(
+                        status_code=400,
+                        detail=f"Estoque insuficiente. Disponível: {quantidade_anterior}"
+                    )
+                nova_quantidade = quantidade_anterior - quantidade
+            
+            repositorio.definir_estoque(produto_id_local, nova_quantidade)
+            
+            resposta = {
+                "message": "Estoque atualizado",
+                "produto_id": produto_id_local,
+                "codigo_produto": codigo_produto,
+                "operacao": operacao,
+                "quantidade_alterada": quantidade,
+                "quantidade_anterior": quantidade_anterior,
+                "quantidade_atual": nova_quantidade
+            }
+            repositorio.salvar_resposta(f"estoque:{codigo_produto}", chave_idempotencia, resposta)
+            
+            return resposta
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.put("/estoque/{codigo_produto}", tags=["Estoque"])
 async def atualizar_estoque(
     request: Request,
@@ -497,94 +716,136 @@ async def atualizar_estoque(
 ):
     form_data = await request.form()
     origem = form_data.get('origem', None)
+    quantidade_atual = form_data.get('quantidade_atual', None)
+    chave_idempotencia = request.headers.get('Idempotency-Key')
     
     if operacao not in ['entrada', 'saida']:
         raise HTTPException(status_code=400, detail="Operação inválida. Use 'entrada' ou 'saida'")
     
-    conn = get_db_connection(DATABASE_NAME)
-    cursor = conn.cursor()
+    matriz_url = REPLICAS.get('matriz')
+    resposta_matriz = None
     
-    try:
-        conn.execute("BEGIN EXCLUSIVE")
+    # A matriz é chamada sem a trava local, a filial só trava o banco para gravar a quantidade que a matriz confirmou
+    if not origem and matriz_url:
+        resposta_anterior = await executar_no_banco(consultar_resposta, f"estoque:{codigo_produto}", chave_idempotencia)
+        if resposta_anterior:
+            return resposta_anterior
         
-        cursor.execute(
-            "SELECT p.id, e.quantidade FROM produtos p JOIN estoque e ON p.id = e.produto_id WHERE p.codigo = ?",
-            (codigo_produto,)
-        )
-        produto = cursor.fetchone()
+        produto = await executar_no_banco(consultar_saldo, codigo_produto)
         
         if not produto:
             raise HTTPException(status_code=404, detail="Produto não encontrado")
+        if operacao == "saida" and produto['quantidade'] < quantidade:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Estoque insuficiente. Disponível: {produto['quantidade']}"
+            )
         
-        produto_id_local = produto['id']
-        quantidade_anterior = produto['quantidade']
-
-        if operacao == "entrada":
-            nova_quantidade = quantidade_anterior + quantidade
-        else:
-            if quantidade_anterior < quantidade:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"Estoque insuficiente. Disponível: {quantidade_anterior}"
-                )
-            nova_quantidade = quantidade_anterior - quantidade
+        token = create_access_token(data={"sub": "admin"}, expires_delta=timedelta(minutes=5))
+        headers = {"Authorization": f"Bearer {token}"}
+        if chave_idempotencia:
+            headers["Idempotency-Key"] = f"{API_NAME}:estoque:{chave_idempotencia}"
+        data = {
+            "operacao": operacao,
+            "quantidade": quantidade,
+            "origem": API_NAME
+        }
         
-        if not origem:
-            token = create_access_token(data={"sub": "admin"}, expires_delta=timedelta(minutes=5))
-            headers = {"Authorization": f"Bearer {token}"}
-            data = {
-                "operacao": operacao,
-                "quantidade": quantidade,
-                "origem": API_NAME
-            }
-            
-            matriz_url = REPLICAS.get('matriz')
-            if matriz_url:
-                try:
-                    resp_put = requests.put(
-                        f"{matriz_url}/estoque/{codigo_produto}",
-                        data=data,
-                        headers=headers,
-                        timeout=5
-                    )
-                    resp_put.raise_for_status()
-                except requests.Timeout:
-                    raise HTTPException(status_code=504, detail="Matriz demorou para responder (timeout)")
-                except requests.HTTPError as e:
-                    detail = f"Matriz falhou: {e.response.text}"
-                    try:
-                        detail_json = e.response.json().get('detail')
-                        if detail_json:
-                            detail = f"Matriz recusou: {detail_json}"
-                    except:
-                        pass
-                    raise HTTPException(status_code=e.response.status_code, detail=detail)
-                except requests.RequestException as e:
-                    raise HTTPException(status_code=503, detail=f"Erro de rede ao contatar matriz: {str(e)}")
+        try:
+            # A chamada à matriz espera a rede, então roda no executor padrão e não ocupa as threads do banco
+            resp_put = await asyncio.get_running_loop().run_in_executor(None, functools.partial(
+                circuitos.request,
+                'matriz',
+                "PUT",
+                f"{matriz_url}/estoque/{codigo_produto}",
+                data=data,
+                headers=headers,
+                timeout=5
+            ))
+            resp_put.raise_for_status()
+            resposta_matriz = resp_put.json()
+        except requests.Timeout:
+            raise HTTPException(status_code=504, detail="Matriz demorou para responder (timeout)")
+        except requests.HTTPError as e:
+            detail = f"Matriz falhou: {e.response.text}"
+            try:
+                detail_json = e.response.json().get('detail')
+                if detail_json:
+                    detail = f"Matriz recusou: {detail_json}"
+            except:
+                pass
+            raise HTTPException(status_code=e.response.status_code, detail=detail)
+        except requests.RequestException as e:
+            raise HTTPException(status_code=503, detail=f"Erro de rede ao contatar matriz: {str(e)}")
+    
+    return await executar_no_banco(
+        gravar_estoque, codigo_produto, operacao, quantidade, origem, quantidade_atual, chave_idempotencia, resposta_matriz
+    )
 
-        cursor.execute(
-            "UPDATE estoque SET quantidade = ?, atualizado_em = CURRENT_TIMESTAMP WHERE produto_id = ?",
-            (nova_quantidade, produto_id_local)
-        )
-        
-        conn.commit()
-        
+@app.get("/relatorios/vendas", tags=["Relatórios"])
+@no_banco
+def relatorio_vendas(
+    data_inicio: Optional[str] = None,
+    data_fim: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    data_inicio = normalizar_dia(data_inicio, 'data_inicio')
+    data_fim = normalizar_dia(data_fim, 'data_fim')
+    
+    conn = get_db_connection(DATABASE_NAME)
+    try:
         return {
-            "message": "Estoque atualizado",
-            "produto_id": produto_id_local,
-            "codigo_produto": codigo_produto,
-            "operacao": operacao,
-            "quantidade_alterada": quantidade,
-            "quantidade_anterior": quantidade_anterior,
-            "quantidade_atual": nova_quantidade
+            "filial": replica_manager.current_api_name,
+            **consultar_vendas(conn.cursor(), data_inicio, data_fim)
         }
-        
-    except HTTPException:
-        conn.rollback()
-        raise
-    except Exception as e:
-        conn.rollback()
-        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        conn.close()
+
+@app.get("/relatorios/vendas/produtos", tags=["Relatórios"])
+@no_banco
+def relatorio_vendas_produtos(
+    codigo_produto: Optional[str] = None,
+    data_inicio: Optional[str] = None,
+    data_fim: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    data_inicio = normalizar_dia(data_inicio, 'data_inicio')
+    data_fim = normalizar_dia(data_fim, 'data_fim')
+    
+    conn = get_db_connection(DATABASE_NAME)
+    try:
+        return {
+            "filial": replica_manager.current_api_name,
+            "vendas": consultar_vendas_produtos(conn.cursor(), codigo_produto, data_inicio, data_fim)
+        }
+    finally:
+        conn.close()
+
+@app.post("/anti-entropia", tags=["Sincronização"])
+async def executar_anti_entropia(current_user: dict = Depends(require_admin)):
+    if not REPLICAS.get('matriz'):
+        raise HTTPException(status_code=503, detail="Matriz não configurada")
+    
+    try:
+        reparados = await asyncio.get_running_loop().run_in_executor(None, anti_entropia.executar)
+    except requests.RequestException as e:
+        raise HTTPException(status_code=503, detail=f"Erro de rede ao contatar matriz: {str(e)}")
+    
+    return {
+        "message": "Anti-entropia concluída",
+        "produtos_reparados": reparados
+    }
+
+@app.get("/reservas/recusadas", tags=["Pedidos"])
+@no_banco
+def listar_reservas_recusadas(
+    limite: int = 100,
+    current_user: dict = Depends(get_current_user)
+):
+    # Pedidos confirmados aqui cuja baixa a matriz recusou (reserva expirada sem estoque para refazer)
+    conn = get_db_connection(DATABASE_NAME)
+    try:
+        return listar_recusadas(conn.cursor(), max(1, min(limite, 1000)))
     finally:
         conn.close()
 
@@ -596,7 +857,8 @@ async def get_status(current_user: dict = Depends(get_current_user)):
         "api_name": API_NAME,
         "status": "online",
         "timestamp": datetime.now().isoformat(),
-        "replicas": replicas_status
+        "replicas": replicas_status,
+        "circuitos": circuitos.estados()
     }
 
 if __name__ == "__main__":
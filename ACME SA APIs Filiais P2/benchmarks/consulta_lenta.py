@@ -0,0 +1,122 @@
+import argparse
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+import uvicorn
+from fastapi import FastAPI
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shared.database import init_database, get_db_connection, no_banco
+
+# Mede a latência de um endpoint rápido enquanto outro endpoint roda uma consulta lenta, com a consulta
+# feita direto dentro do async def (como antes) e pelo executor do banco (no_banco).
+# Uso, em "ACME SA APIs Filiais P2/": python benchmarks/consulta_lenta.py
+
+def porta_livre() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def percentil(valores, p):
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(len(ordenados) * p))]
+
+def montar_app(db_name: str, segundos: float) -> FastAPI:
+    app = FastAPI()
+
+    def consulta_lenta():
+        conn = get_db_connection(db_name)
+        try:
+            # Segura a conexão até o tempo pedido, como um relatório sobre uma tabela grande
+            limite = time.monotonic() + segundos
+            conn.create_function("continuar", 0, lambda: time.monotonic() < limite)
+            return conn.execute(
+                "WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE continuar()) SELECT COUNT(*) FROM n"
+            ).fetchone()[0]
+        finally:
+            conn.close()
+
+    def consulta_rapida():
+        conn = get_db_connection(db_name)
+        try:
+            return conn.execute("SELECT COUNT(*) FROM produtos").fetchone()[0]
+        finally:
+            conn.close()
+
+    @app.get("/bloqueante/lenta")
+    async def bloqueante_lenta():
+        return {"linhas": consulta_lenta()}
+
+    @app.get("/bloqueante/rapida")
+    async def bloqueante_rapida():
+        return {"produtos": consulta_rapida()}
+
+    @app.get("/executor/lenta")
+    @no_banco
+    def executor_lenta():
+        return {"linhas": consulta_lenta()}
+
+    @app.get("/executor/rapida")
+    @no_banco
+    def executor_rapida():
+        return {"produtos": consulta_rapida()}
+
+    return app
+
+def medir(base: str, modo: str, segundos: float, intervalo: float) -> dict:
+    lenta = threading.Thread(target=requests.get, args=(f"{base}/{modo}/lenta",), kwargs={"timeout": segundos + 30})
+    lenta.start()
+    # Dá tempo da consulta lenta começar antes das rápidas
+    time.sleep(0.1)
+
+    latencias = []
+    while lenta.is_alive():
+        inicio = time.perf_counter()
+        requests.get(f"{base}/{modo}/rapida", timeout=segundos + 30).raise_for_status()
+        latencias.append((time.perf_counter() - inicio) * 1000)
+        time.sleep(intervalo)
+    lenta.join()
+
+    return {
+        "requisicoes": len(latencias),
+        "p50_ms": round(percentil(latencias, 0.50), 1),
+        "p99_ms": round(percentil(latencias, 0.99), 1),
+        "max_ms": round(max(latencias), 1)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Latência de um endpoint rápido durante uma consulta lenta")
+    parser.add_argument("--segundos", type=float, default=2.0)
+    parser.add_argument("--intervalo-ms", type=float, default=20.0)
+    args = parser.parse_args()
+
+    pasta = tempfile.mkdtemp()
+    db_name = os.path.join(pasta, "consulta_lenta.db")
+    init_database(db_name, "Consulta lenta")
+
+    porta = porta_livre()
+    servidor = uvicorn.Server(uvicorn.Config(montar_app(db_name, args.segundos), host="127.0.0.1", port=porta, log_level="warning"))
+    thread = threading.Thread(target=servidor.run, daemon=True)
+    thread.start()
+    while not servidor.started:
+        time.sleep(0.05)
+
+    base = f"http://127.0.0.1:{porta}"
+    print(f"{'modo':<12} {'requisições':>11} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for modo in ["bloqueante", "executor"]:
+        r = medir(base, modo, args.segundos, args.intervalo_ms / 1000)
+        print(f"{modo:<12} {r['requisicoes']:>11} {r['p50_ms']:>8} {r['p99_ms']:>8} {r['max_ms']:>8}")
+
+    servidor.should_exit = True
+    thread.join()
+    shutil.rmtree(pasta, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Mede a latência de leituras curtas (como o GET /estoque/{codigo_produto}) enquanto um escritor
+# segura transações de escrita, com cada perfil de journal e trava em um processo separado.
+# Uso, em "ACME SA APIs Filiais P2/": python benchmarks/leitura_sob_escrita.py
+
+PERFIS = [("DELETE", "EXCLUSIVE"), ("WAL", "IMMEDIATE")]
+
+def percentil(valores, p):
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(len(ordenados) * p))]
+
+def medir(args):
+    from shared.database import init_database, get_db_connection, iniciar_escrita
+
+    pasta = tempfile.mkdtemp()
+    db_name = os.path.join(pasta, "benchmark.db")
+    init_database(db_name, "Benchmark")
+
+    conn = get_db_connection(db_name)
+    iniciar_escrita(conn)
+    for i in range(args.produtos):
+        conn.execute("INSERT INTO produtos (codigo, nome, preco) VALUES (?, ?, ?)", (f"P{i}", f"Produto {i}", 1.0))
+        conn.execute("INSERT INTO estoque (produto_id, quantidade) VALUES (?, ?)", (i + 1, 1000000))
+    conn.commit()
+    conn.close()
+
+    parar = threading.Event()
+    escritas = [0]
+
+    def escritor():
+        while not parar.is_set():
+            conn = get_db_connection(db_name)
+            try:
+                iniciar_escrita(conn)
+                conn.execute(
+                    "UPDATE estoque SET quantidade = quantidade - 1 WHERE produto_id = ?",
+                    (escritas[0] % args.produtos + 1,)
+                )
+                # Simula o trabalho feito com a trava na mão, como a gravação de um pedido
+                time.sleep(args.escrita_ms / 1000)
+                conn.commit()
+                escritas[0] += 1
+            finally:
+                conn.close()
+            time.sleep(args.intervalo_ms / 1000)
+
+    latencias = []
+    trava = threading.Lock()
+
+    def leitor(indice):
+        locais = []
+        n = indice
+        while not parar.is_set():
+            inicio = time.perf_counter()
+            conn = get_db_connection(db_name)
+            try:
+                conn.execute(
+                    "SELECT p.id, p.codigo, p.nome, e.quantidade FROM produtos p JOIN estoque e ON p.id = e.produto_id WHERE p.codigo = ?",
+                    (f"P{n % args.produtos}",)
+                ).fetchone()
+            finally:
+                conn.close()
+            locais.append((time.perf_counter() - inicio) * 1000)
+            n += args.leitores
+        with trava:
+            latencias.extend(locais)
+
+    threads = [threading.Thread(target=escritor)] + [threading.Thread(target=leitor, args=(i,)) for i in range(args.leitores)]
+    for thread in threads:
+        thread.start()
+    time.sleep(args.duracao)
+    parar.set()
+    for thread in threads:
+        thread.join()
+    shutil.rmtree(pasta, ignore_errors=True)
+
+    return {
+        "leituras_s": round(len(latencias) / args.duracao),
+        "escritas_s": round(escritas[0] / args.duracao),
+        "p50_ms": round(percentil(latencias, 0.50), 3),
+        "p99_ms": round(percentil(latencias, 0.99), 3),
+        "max_ms": round(max(latencias), 3)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Latência de leitura sob carga de escrita, por perfil de journal")
+    parser.add_argument("--duracao", type=float, default=5.0)
+    parser.add_argument("--leitores", type=int, default=8)
+    parser.add_argument("--produtos", type=int, default=1000)
+    parser.add_argument("--escrita-ms", type=float, default=5.0)
+    parser.add_argument("--intervalo-ms", type=float, default=1.0)
+    parser.add_argument("--perfil", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.perfil:
+        print(json.dumps(medir(args)))
+        return
+
+    print(f"{'journal':<8} {'trava':<10} {'leituras/s':>10} {'escritas/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for journal, trava in PERFIS:
+        ambiente = dict(os.environ, SQLITE_JOURNAL_MODE=journal, SQLITE_TRAVA_ESCRITA=trava)
+        saida = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--perfil", journal,
+             "--duracao", str(args.duracao), "--leitores", str(args.leitores),
+             "--produtos", str(args.produtos), "--escrita-ms", str(args.escrita_ms),
+             "--intervalo-ms", str(args.intervalo_ms)],
+            env=ambiente, capture_output=True, text=True, check=True
+        )
+        r = json.loads(saida.stdout.strip().splitlines()[-1])
+        print(f"{journal:<8} {trava:<10} {r['leituras_s']:>10} {r['escritas_s']:>10} {r['p50_ms']:>8} {r['p99_ms']:>8} {r['max_ms']:>8}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+from typing import Dict, List
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shared.database import get_db_connection, init_database, SQL_ESTOQUE_POR_CODIGO, SQL_ESTOQUE_NOVO, SQL_ALTERACOES
+from shared.outbox import init_outbox, SQL_CURSOR_REPLICA, SQL_EVENTOS_PENDENTES, SQL_LIMPAR_OUTBOX
+from shared.idempotencia import SQL_BUSCAR_RESPOSTA, SQL_EXPIRADAS, SQL_MAIS_ANTIGAS
+from shared.merkle import SQL_LINHAS_FOLHAS
+from shared.pedidos import (
+    SQL_ID_PRODUTO, SQL_BAIXAR_ESTOQUE, SQL_DIA_DO_PEDIDO, SQL_PRODUTOS_POR_CODIGO, SQL_ITENS_DOS_PEDIDOS,
+    consulta_pedidos, consulta_exportacao, consulta_vendas, consulta_vendas_produtos
+)
+from shared.repositorio import SQL_USUARIO, SQL_PRODUTO, SQL_PEDIDO, SQL_ITENS_PEDIDO
+from shared.reservas import (
+    init_reservas, init_confirmacoes, SQL_PRODUTOS_DA_RESERVA, SQL_RESERVA, SQL_RESERVAS_VENCIDAS,
+    SQL_RESERVAS_A_CONFIRMAR, SQL_RESERVAS_RECUSADAS
+)
+from shared.escrow import (
+    init_cotas_matriz, init_cotas_filial, SQL_COTAS_RESERVADAS, SQL_PRODUTOS_EM_COTA, SQL_ESTOQUE_DO_PRODUTO,
+    SQL_COTA, SQL_COTAS_DAS_OUTRAS, SQL_LISTAR_COTAS, SQL_SALDO_LOCAL
+)
+
+# Consultas dos caminhos quentes da matriz e das filiais, importadas dos módulos que as executam. Nenhuma pode
+# ler uma tabela inteira nem ordenar numa B-tree temporária, então uma consulta nova num caminho quente deve
+# virar uma constante no seu módulo e entrar nesta lista junto com o seu índice.
+# Roda com os testes (tests/test_planos.py) e também sozinho, inclusive nos bancos de uma instalação.
+# Uso, em "ACME SA APIs Filiais P2/": python benchmarks/planos.py [banco.db ...]
+DOIS = "?, ?"
+POSICAO = ("2030-01-01 00:00:00", 10)
+
+CONSULTAS = [
+    ("login", SQL_USUARIO, ("admin",)),
+    ("produto por código", SQL_ID_PRODUTO, ("P1",)),
+    ("consultar_estoque", SQL_PRODUTO, ("P1",)),
+    ("validar lote de pedidos", SQL_PRODUTOS_POR_CODIGO.format(DOIS), ("P1", "P2")),
+    ("baixa de estoque", SQL_BAIXAR_ESTOQUE, (1, 1)),
+    ("estoque por código", SQL_ESTOQUE_POR_CODIGO, (1, "P1")),
+    ("estoque novo", SQL_ESTOQUE_NOVO, (1, "P1")),
+    # Corpo do trigger merkle_produtos_update (shared/merkle.py), que não aparece no plano de quem dispara o trigger
+    ("trigger merkle de produtos", "SELECT e.quantidade FROM estoque e WHERE e.produto_id = ?", (1,)),
+    ("listar_pedidos", *consulta_pedidos(100, POSICAO, None, None)),
+    ("listar_pedidos por período", *consulta_pedidos(100, None, "2020-01-01 00:00:00", "2030-01-01 00:00:00")),
+    ("listar_pedidos por período, página seguinte", *consulta_pedidos(100, POSICAO, "2020-01-01 00:00:00", "2030-01-01 00:00:00")),
+    ("consultar_pedido", SQL_PEDIDO, (1,)),
+    ("itens do pedido", SQL_ITENS_PEDIDO, (1,)),
+    ("itens de vários pedidos", SQL_ITENS_DOS_PEDIDOS.format(DOIS), (1, 2)),
+    ("dia do pedido", SQL_DIA_DO_PEDIDO, (1,)),
+    ("exportar pedidos", *consulta_exportacao(0, 100, None, None, 1000)),
+    ("exportar pedidos por período", *consulta_exportacao(0, 100, "2020-01-01 00:00:00", "2030-01-01 00:00:00", 1000)),
+    ("relatório de vendas", *consulta_vendas("2020-01-01", "2030-01-01")),
+    ("relatório de vendas por produto", *consulta_vendas_produtos(1, "2020-01-01", "2030-01-01")),
+    ("idempotência", SQL_BUSCAR_RESPOSTA, ("pedido", "k", 0)),
+    ("idempotência expirada", SQL_EXPIRADAS, (0, 10000)),
+    ("idempotência excedente", SQL_MAIS_ANTIGAS, (10000,)),
+    ("alterações desde", SQL_ALTERACOES, (0, 500)),
+    ("folhas merkle", SQL_LINHAS_FOLHAS.format(DOIS), (1, 2)),
+    ("outbox pendente", SQL_EVENTOS_PENDENTES, (0, 100)),
+    ("cursor de réplica", SQL_CURSOR_REPLICA, ("alipio",)),
+    ("limpeza da outbox", SQL_LIMPAR_OUTBOX.format(DOIS), ("alipio", "alvorada")),
+    ("reserva", SQL_RESERVA, ("r",)),
+    ("produtos da reserva", SQL_PRODUTOS_DA_RESERVA.format(DOIS), ("P1", "P2")),
+    ("reservas vencidas", SQL_RESERVAS_VENCIDAS, ("pendente", 0, 500)),
+    ("cotas reservadas", SQL_COTAS_RESERVADAS.format(DOIS), (1, 2)),
+    ("cota da filial", SQL_COTA, ("alipio", 1)),
+    ("estoque do produto em cota", SQL_ESTOQUE_DO_PRODUTO, ("P1",)),
+    ("cotas das outras filiais", SQL_COTAS_DAS_OUTRAS, (0, 1, "alipio")),
+    ("produtos em cota da filial", SQL_PRODUTOS_EM_COTA, ("alipio",)),
+    ("GET /cotas", SQL_LISTAR_COTAS, (0, "", 500)),
+    ("saldo da cota local", SQL_SALDO_LOCAL.format(DOIS), (1, 2)),
+    ("reservas a confirmar", SQL_RESERVAS_A_CONFIRMAR, ()),
+    ("reservas recusadas", SQL_RESERVAS_RECUSADAS, (100,)),
+]
+
+def problemas_do_plano(sql: str, plano: List[str]) -> List[str]:
+    # Um SCAN com índice só para cedo quando a consulta ordena pelo índice e tem LIMIT; sem os dois ele lê o índice
+    # inteiro, como a tabela. Índice automático e ordenação em B-tree temporária são sempre problema
+    limitada = " ORDER BY " in sql.upper() and " LIMIT " in sql.upper()
+    return [
+        detalhe for detalhe in plano
+        if (detalhe.startswith("SCAN ") and not (limitada and " USING " in detalhe))
+        or "AUTOMATIC" in detalhe or "TEMP B-TREE" in detalhe
+    ]
+
+def plano(conn, sql: str, parametros) -> List[str]:
+    return [linha[3] for linha in conn.execute(f"EXPLAIN QUERY PLAN {sql}", parametros).fetchall()]
+
+def verificar_planos(conn) -> Dict[str, List[str]]:
+    # O EXPLAIN não lê o banco, então uma conexão do pool poderia planejar com um schema antigo em memória
+    conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+    problemas = {}
+    for nome, sql, parametros in CONSULTAS:
+        try:
+            detalhes = plano(conn, sql, parametros)
+        except sqlite3.OperationalError as e:
+            if "no such table" in str(e):
+                # Tabela que só existe na matriz ou só nas filiais
+                continue
+            raise
+        encontrados = problemas_do_plano(sql, detalhes)
+        if encontrados:
+            problemas[nome] = encontrados
+    return problemas
+
+def banco_completo(pasta: str) -> str:
+    db_name = os.path.join(pasta, "planos.db")
+    init_database(db_name, "Planos")
+    init_outbox(db_name)
+    init_reservas(db_name)
+    init_cotas_matriz(db_name)
+    init_confirmacoes(db_name)
+    init_cotas_filial(db_name)
+    return db_name
+
+def main(bancos: List[str]) -> int:
+    pasta = None
+    if not bancos:
+        pasta = tempfile.mkdtemp()
+        bancos = [banco_completo(pasta)]
+
+    falhas = 0
+    for db_name in bancos:
+        conn = get_db_connection(db_name)
+        try:
+            problemas = verificar_planos(conn)
+        finally:
+            conn.close()
+        for nome, detalhes in problemas.items():
+            print(f"{db_name}: {nome}: {'; '.join(detalhes)}")
+        falhas += len(problemas)
+        print(f"{db_name}: {len(CONSULTAS)} consultas verificadas, {len(problemas)} com leitura da tabela inteira")
+    if pasta:
+        shutil.rmtree(pasta, ignore_errors=True)
+    return 1 if falhas else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
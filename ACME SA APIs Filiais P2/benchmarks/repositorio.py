@@ -0,0 +1,76 @@
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi import HTTPException
+
+from shared.database import init_database
+from shared.pedidos import validar_itens
+from shared.repositorio import Armazenamento, ArmazenamentoSQLite, ArmazenamentoMemoria
+
+# Roda a mesma carga de pedidos (a validação do POST /pedido, baixa de estoque, gravação e consulta) só pela
+# interface do repositório, com cada motor recebido por injeção.
+# Uso, em "ACME SA APIs Filiais P2/": python benchmarks/repositorio.py
+
+def medir(armazenamento: Armazenamento, args) -> dict:
+    sorteio = random.Random(42)
+    with armazenamento.escrita() as repositorio:
+        for i in range(args.produtos):
+            repositorio.criar_produto(f"P{i}", f"Produto {i}", 1.0 + i % 10, 1000000)
+
+    inicio = time.perf_counter()
+    pedidos = []
+    for _ in range(args.pedidos):
+        itens = [
+            {"codigo_produto": f"P{sorteio.randrange(args.produtos)}", "quantidade": sorteio.randint(1, 3)}
+            for _ in range(args.itens)
+        ]
+        with armazenamento.escrita() as repositorio:
+            try:
+                total, itens_validados = validar_itens(repositorio, itens)
+            except HTTPException:
+                continue
+            pedidos.append(repositorio.criar_pedido(total, itens_validados))
+    gravacao = time.perf_counter() - inicio
+
+    inicio = time.perf_counter()
+    with armazenamento.leitura() as repositorio:
+        for pedido_id in pedidos:
+            repositorio.buscar_pedido(pedido_id)
+            repositorio.buscar_produto(f"P{pedido_id % args.produtos}")
+    leitura = time.perf_counter() - inicio
+
+    return {
+        "pedidos_s": round(len(pedidos) / gravacao),
+        "consultas_s": round(2 * len(pedidos) / leitura)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Mesma carga de pedidos no repositório SQLite e no em memória")
+    parser.add_argument("--produtos", type=int, default=1000)
+    parser.add_argument("--pedidos", type=int, default=5000)
+    parser.add_argument("--itens", type=int, default=3)
+    parser.add_argument("--motores", default="sqlite,memoria")
+    args = parser.parse_args()
+
+    pasta = tempfile.mkdtemp()
+    db_name = os.path.join(pasta, "repositorio.db")
+    init_database(db_name, "Repositório")
+
+    motores = {"sqlite": lambda: ArmazenamentoSQLite(db_name), "memoria": ArmazenamentoMemoria}
+
+    print(f"{'motor':<8} {'pedidos/s':>10} {'consultas/s':>12}")
+    for motor in args.motores.split(","):
+        r = medir(motores[motor](), args)
+        print(f"{motor:<8} {r['pedidos_s']:>10} {r['consultas_s']:>12}")
+
+    shutil.rmtree(pasta, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,40 @@
-from fastapi import FastAPI, Depends, HTTPException, status, Form, Request, BackgroundTasks
+from fastapi import FastAPI, Depends, HTTPException, status, Form, Request, Body
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from dotenv import load_dotenv
 import os
 import uvicorn
-import requests
+import json
+import zlib
+import math
 from datetime import datetime, timedelta
 import sys
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from shared.database import init_database, get_db_connection
+from shared.database import init_database, get_db_connection, no_banco, CheckpointWAL, proxima_sequencia, ler_controle, buscar_alteracoes
 from shared.auth import (
     create_access_token, get_current_user, require_admin,
     verify_password, ACCESS_TOKEN_EXPIRE_MINUTES
 )
-from shared.sync import ReplicaManager, load_replicas
+from shared.sync import ReplicaManager, ReplicationDispatcher, RegistroReplicas, load_replicas, init_registro, salvar_registro
+from shared.outbox import OutboxWorker, init_outbox, registrar_evento, iniciar_cursor_replica, avancar_cursor_replica, limpar_outbox
+from shared.feed import FeedAlteracoes
+from shared.idempotencia import LimpezaIdempotencia, buscar_resposta, salvar_resposta, limpar_respostas
+from shared.reservas import (
+    ExpiradorReservas, init_reservas, agrupar_itens, baixar_itens,
+    criar_reserva, confirmar_reserva, liberar_reserva, expirar_reservas, reserva_ativa, RESERVA_TTL_S
+)
+from shared.escrow import init_cotas_matriz, cotas_reservadas, sincronizar_cotas, consultar_cotas
+from shared.escritor import (
+    EscritorUnico, CriarUsuario, CriarProduto, AlterarEstoque, BaixarEstoque, CriarReserva,
+    ConfirmarReserva, LiberarReserva, ExpirarReservas, LimparIdempotencia, SincronizarCotas, SalvarRegistro,
+    IniciarCursorReplica, AvancarCursorReplica, LimparOutbox
+)
+from shared.repositorio import Armazenamento, ArmazenamentoSQLite
+from shared.circuit_breaker import circuitos
+from shared import merkle
 
 load_dotenv('.env')
 
@@ -33,53 +52,73 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-REPLICAS = load_replicas('matriz')
+REPLICAS = RegistroReplicas(
+    load_replicas('matriz'),
+    ttl=float(os.getenv('REGISTRO_TTL_S', 30))
+)
 
 replica_manager = ReplicaManager("matriz", REPLICAS)
 
-def replicar_produto_sync(data: dict, headers: dict, skip_origem: str):
-    for nome_filial, url_filial in REPLICAS.items():
-        if skip_origem and nome_filial.lower() in skip_origem.lower():
-            continue
-        try:
-            requests.post(
-                f"{url_filial}/produtos",
-                data=data,
-                headers=headers,
-                timeout=5
-            )
-        except Exception as e:
-            print(f"ERRO: Falha ao replicar produto {data.get('codigo')} para {nome_filial}: {e}")
-
-def replicar_estoque_sync(codigo_produto: str, data: dict, headers: dict, skip_origem: str):
-    for nome_filial, url_filial in REPLICAS.items():
-        if skip_origem and nome_filial.lower() in skip_origem.lower():
-            continue
-        try:
-            requests.put(
-                f"{url_filial}/estoque/{codigo_produto}",
-                data=data,
-                headers=headers,
-                timeout=5
-            )
-        except Exception as e:
-            print(f"ERRO: Falha ao replicar estoque {codigo_produto} para {nome_filial}: {e}")
+replication_dispatcher = ReplicationDispatcher(
+    REPLICAS,
+    max_por_replica=int(os.getenv('REPLICACAO_MAX_POR_FILIAL', 4))
+)
+
+feed_alteracoes = FeedAlteracoes(DATABASE_NAME)
+
+def notificar_alteracoes():
+    outbox_worker.notificar()
+    feed_alteracoes.notificar()
+
+# Toda escrita no banco da matriz passa pela fila do escritor, que tem a única conexão de escrita
+escritor = EscritorUnico(DATABASE_NAME, ao_gravar=notificar_alteracoes)
+
+outbox_worker = OutboxWorker(
+    DATABASE_NAME,
+    REPLICAS,
+    replication_dispatcher,
+    lambda comando: escritor.enviar(comando).result(),
+    feed=feed_alteracoes,
+    janela=int(os.getenv('REPLICACAO_JANELA_MS', 50)) / 1000
+)
+
+expirador_reservas = ExpiradorReservas(lambda: escritor.enviar(ExpirarReservas()).result())
+
+limpeza_idempotencia = LimpezaIdempotencia(lambda: escritor.enviar(LimparIdempotencia()).result())
+
+checkpoint_wal = CheckpointWAL(DATABASE_NAME)
+
+armazenamento: Armazenamento = ArmazenamentoSQLite(DATABASE_NAME)
 
 @app.on_event("startup")
 async def startup_event():
     init_database(DATABASE_NAME, API_NAME)
+    init_outbox(DATABASE_NAME)
+    init_registro(DATABASE_NAME, REPLICAS)
+    init_reservas(DATABASE_NAME)
+    init_cotas_matriz(DATABASE_NAME)
+    feed_alteracoes.start()
+    outbox_worker.start()
+    replica_manager.start()
+    escritor.start()
+    expirador_reservas.start()
+    limpeza_idempotencia.start()
+    checkpoint_wal.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await outbox_worker.stop()
+    await replica_manager.stop()
+    expirador_reservas.stop()
+    limpeza_idempotencia.stop()
+    escritor.stop()
+    checkpoint_wal.stop()
 
 @app.post("/login", include_in_schema=False)
-async def login(form_data: OAuth2PasswordRequestForm = Depends()):
-    conn = get_db_connection(DATABASE_NAME)
-    cursor = conn.cursor()
-    
-    cursor.execute(
-        "SELECT * FROM usuarios WHERE login = ?",
-        (form_data.username,)
-    )
-    user_data = cursor.fetchone()
-    conn.close()
+@no_banco
+def login(form_data: OAuth2PasswordRequestForm = Depends()):
+    with armazenamento.leitura() as repositorio:
+        user_data = repositorio.buscar_usuario(form_data.username)
     
     if not user_data or not verify_password(form_data.password, user_data['password']):
         raise HTTPException(
@@ -94,64 +133,65 @@ async def login(form_data: OAuth2PasswordRequestForm = Depends()):
     
     return {"access_token": access_token, "token_type": "bearer"}
 
+async def gravar(comando, status_erro: int = 500):
+    try:
+        return await escritor.executar(comando)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=status_erro, detail=str(e))
+
+@escritor.comando(CriarUsuario)
+def aplicar_usuario(cursor, comando: CriarUsuario) -> dict:
+    with armazenamento.na_transacao(cursor) as repositorio:
+        if not repositorio.criar_usuario(comando.login, comando.password):
+            raise HTTPException(status_code=400, detail="Login já existe")
+    
+    return {
+        "message": "Usuário criado com sucesso"
+    }
+
 @app.post("/usuarios", tags=["Usuários"])
 async def criar_usuario(
     login: str = Form(default="teste"),
     password: str = Form(default="teste123"),
     current_user: dict = Depends(require_admin)
 ):
-    conn = get_db_connection(DATABASE_NAME)
-    cursor = conn.cursor()
-    
-    try:
-        cursor.execute(
-            "SELECT * FROM usuarios WHERE login = ?",
-            (login,)
-        )
-        if cursor.fetchone():
-            raise HTTPException(status_code=400, detail="Login já existe")
+    return await gravar(CriarUsuario(login, password), status_erro=409)
+
+@app.get("/produtos", tags=["Produtos"])
+@no_banco
+def listar_produtos(current_user: dict = Depends(get_current_user)):
+    with armazenamento.leitura() as repositorio:
+        return repositorio.listar_produtos()
+
+@escritor.comando(CriarProduto)
+def aplicar_produto(cursor, comando: CriarProduto) -> dict:
+    with armazenamento.na_transacao(cursor) as repositorio:
+        if repositorio.existe_produto(comando.codigo):
+            raise HTTPException(status_code=400, detail="Código de produto já existe")
         
-        cursor.execute(
-            "INSERT INTO usuarios (login, password) VALUES (?, ?)",
-            (login, password)
-        )
-        conn.commit()
+        produto_id = repositorio.criar_produto(comando.codigo, comando.nome, comando.preco, comando.quantidade, proxima_sequencia(cursor), comando.origem)
         
-        return {
-            "message": "Usuário criado com sucesso"
+        data_para_replicar = {
+            "codigo": comando.codigo,
+            "nome": comando.nome,
+            "preco": comando.preco,
+            "quantidade": comando.quantidade,
+            "origem": "matriz"
         }
-    except HTTPException:
-        raise
-    except Exception as e:
-        conn.rollback()
-        raise HTTPException(status_code=409, detail=str(e))
-    finally:
-        conn.close()
-
-@app.get("/produtos", tags=["Produtos"])
-async def listar_produtos(current_user: dict = Depends(get_current_user)):
-    conn = get_db_connection(DATABASE_NAME)
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT id, codigo, nome, preco, criado_em FROM produtos")
-    produtos = cursor.fetchall()
-    conn.close()
-    
-    return [
-        {
-            "id": produto['id'],
-            "codigo": produto['codigo'],
-            "nome": produto['nome'],
-            "preco": produto['preco'],
-            "criado_em": produto['criado_em']
+        
+        registrar_evento(cursor, "POST", "/produtos", data_para_replicar, comando.origem)
+        
+        return {
+            "message": "Produto criado",
+            "id": produto_id,
+            "codigo": comando.codigo
         }
-        for produto in produtos
-    ]
 
 @app.post("/produtos", include_in_schema=False)
 async def criar_produto(
     request: Request,
-    background_tasks: BackgroundTasks,
     current_user: dict = Depends(require_admin),
     codigo: str = Form(default="123"),
     nome: str = Form(default="mesa"),
@@ -161,77 +201,16 @@ async def criar_produto(
     form_data = await request.form()
     origem = form_data.get('origem', None)
     
-    conn = get_db_connection(DATABASE_NAME)
-    cursor = conn.cursor()
-    
-    try:
-        conn.execute("BEGIN EXCLUSIVE")
-        cursor.execute(
-            "SELECT * FROM produtos WHERE codigo = ?",
-            (codigo,)
-        )
-        if cursor.fetchone():
-            raise HTTPException(status_code=400, detail="Código de produto já existe")
-        
-        cursor.execute(
-            "INSERT INTO produtos (codigo, nome, preco) VALUES (?, ?, ?)",
-            (codigo, nome, preco)
-        )
-        produto_id = cursor.lastrowid
-        
-        cursor.execute(
-            "INSERT INTO estoque (produto_id, quantidade) VALUES (?, ?)",
-            (produto_id, quantidade)
-        )
-        
-        conn.commit()
-        
-        token = create_access_token(data={"sub": "admin"}, expires_delta=timedelta(minutes=5))
-        headers = {"Authorization": f"Bearer {token}"}
-        
-        data_para_replicar = {
-            "codigo": codigo,
-            "nome": nome,
-            "preco": preco,
-            "quantidade": quantidade,
-            "origem": "matriz"
-        }
-        
-        background_tasks.add_task(
-            replicar_produto_sync,
-            data=data_para_replicar,
-            headers=headers,
-            skip_origem=origem
-        )
-        
-        return {
-            "message": "Produto criado",
-            "id": produto_id,
-            "codigo": codigo
-        }
-    except HTTPException:
-        conn.rollback()
-        raise
-    except Exception as e:
-        conn.rollback()
-        raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
+    return await gravar(CriarProduto(codigo, nome, preco, quantidade, origem))
 
 @app.get("/estoque/{codigo_produto}", tags=["Estoque"])
-async def consultar_estoque(
+@no_banco
+def consultar_estoque(
     codigo_produto: str,
     current_user: dict = Depends(get_current_user)
 ):
-    conn = get_db_connection(DATABASE_NAME)
-    cursor = conn.cursor()
-    
-    cursor.execute(
-        "SELECT p.id, p.codigo, p.nome, e.quantidade, e.atualizado_em FROM produtos p JOIN estoque e ON p.id = e.produto_id WHERE p.codigo = ?",
-        (codigo_produto,)
-    )
-    resultado = cursor.fetchone()
-    conn.close()
+    with armazenamento.leitura() as repositorio:
+        resultado = repositorio.buscar_produto(codigo_produto)
     
     if not resultado:
         raise HTTPException(status_code=404, detail="Produto não encontrado")
@@ -244,32 +223,19 @@ async def consultar_estoque(
         "atualizado_em": resultado['atualizado_em']
     }
 
-@app.put("/estoque/{codigo_produto}", include_in_schema=False)
-async def atualizar_estoque(
-    request: Request,
-    codigo_produto: str,
-    background_tasks: BackgroundTasks,
-    current_user: dict = Depends(require_admin)
-):
-    form_data = await request.form()
-    operacao = form_data.get('operacao', 'entrada')
-    quantidade = int(form_data.get('quantidade', 0))
-    origem = form_data.get('origem', None)
+@escritor.comando(AlterarEstoque)
+def aplicar_estoque(cursor, comando: AlterarEstoque) -> dict:
+    codigo_produto = comando.codigo_produto
+    operacao = comando.operacao
+    quantidade = comando.quantidade
+    chave_idempotencia = comando.chave_idempotencia
     
-    if operacao not in ['entrada', 'saida']:
-        raise HTTPException(status_code=400, detail="Operação inválida. Use 'entrada' ou 'saida'")
-    
-    conn = get_db_connection(DATABASE_NAME)
-    cursor = conn.cursor()
-    
-    try:
-        conn.execute("BEGIN EXCLUSIVE")
+    with armazenamento.na_transacao(cursor) as repositorio:
+        resposta_anterior = repositorio.buscar_resposta(f"estoque:{codigo_produto}", chave_idempotencia)
+        if resposta_anterior:
+            return resposta_anterior
         
-        cursor.execute(
-            "SELECT p.id, e.quantidade FROM produtos p JOIN estoque e ON p.id = e.produto_id WHERE p.codigo = ?",
-            (codigo_produto,)
-        )
-        produto = cursor.fetchone()
+        produto = repositorio.buscar_produto(codigo_produto)
         
         if not produto:
             raise HTTPException(status_code=404, detail="Produto não encontrado")
@@ -280,35 +246,23 @@ async def atualizar_estoque(
         if operacao == "entrada":
             nova_quantidade = quantidade_anterior + quantidade
         else:
-            if quantidade_anterior < quantidade:
-                raise HTTPException(status_code=400, detail=f"Estoque insuficiente. Disponível: {quantidade_anterior}")
+            disponivel = quantidade_anterior - cotas_reservadas(cursor, [produto_id_local]).get(produto_id_local, 0)
+            if disponivel < quantidade:
+                raise HTTPException(status_code=400, detail=f"Estoque insuficiente. Disponível: {disponivel}")
             nova_quantidade = quantidade_anterior - quantidade
         
-        cursor.execute(
-            "UPDATE estoque SET quantidade = ?, atualizado_em = CURRENT_TIMESTAMP WHERE produto_id = ?",
-            (nova_quantidade, produto_id_local)
-        )
-        
-        conn.commit()
-        
-        token = create_access_token(data={"sub": "admin"}, expires_delta=timedelta(minutes=5))
-        headers = {"Authorization": f"Bearer {token}"}
+        repositorio.definir_estoque(produto_id_local, nova_quantidade, proxima_sequencia(cursor), comando.origem)
         
         data_para_replicar = {
             "operacao": operacao,
             "quantidade": quantidade,
+            "quantidade_atual": nova_quantidade,
             "origem": "matriz"
         }
         
-        background_tasks.add_task(
-            replicar_estoque_sync,
-            codigo_produto=codigo_produto,
-            data=data_para_replicar,
-            headers=headers,
-            skip_origem=origem
-        )
+        registrar_evento(cursor, "PUT", f"/estoque/{codigo_produto}", data_para_replicar, comando.origem)
         
-        return {
+        resposta = {
             "message": "Estoque atualizado",
             "produto_id": produto_id_local,
             "codigo_produto": codigo_produto,
@@ -317,16 +271,321 @@ async def atualizar_estoque(
             "quantidade_anterior": quantidade_anterior,
             "quantidade_atual": nova_quantidade
         }
+        repositorio.salvar_resposta(f"estoque:{codigo_produto}", chave_idempotencia, resposta)
         
-    except HTTPException:
-        conn.rollback()
-        raise
-    except Exception as e:
-        conn.rollback()
-        raise HTTPException(status_code=500, detail=str(e))
+        return resposta
+
+@app.put("/estoque/{codigo_produto}", include_in_schema=False)
+async def atualizar_estoque(
+    request: Request,
+    codigo_produto: str,
+    current_user: dict = Depends(require_admin)
+):
+    form_data = await request.form()
+    operacao = form_data.get('operacao', 'entrada')
+    quantidade = int(form_data.get('quantidade', 0))
+    origem = form_data.get('origem', None)
+    chave_idempotencia = request.headers.get('Idempotency-Key')
+    
+    if operacao not in ['entrada', 'saida']:
+        raise HTTPException(status_code=400, detail="Operação inválida. Use 'entrada' ou 'saida'")
+    
+    # As atualizações que chegam juntas são gravadas em uma única transação, cada uma com a sua própria resposta
+    return await gravar(AlterarEstoque(codigo_produto, operacao, quantidade, origem, chave_idempotencia))
+
+@escritor.comando(BaixarEstoque)
+def aplicar_baixa(cursor, comando: BaixarEstoque) -> dict:
+    resposta_anterior = buscar_resposta(cursor, "reserva", comando.chave_idempotencia)
+    if resposta_anterior:
+        return resposta_anterior
+    
+    resposta = {
+        "message": "Estoque reservado",
+        "itens": baixar_itens(cursor, comando.quantidades, comando.origem)
+    }
+    salvar_resposta(cursor, "reserva", comando.chave_idempotencia, resposta)
+    return resposta
+
+@app.post("/estoque/reserva", include_in_schema=False)
+async def reservar_estoque(
+    request: Request,
+    reserva: dict = Body(...),
+    current_user: dict = Depends(require_admin)
+):
+    quantidades = agrupar_itens(reserva.get('itens'))
+    
+    return await gravar(BaixarEstoque(quantidades, reserva.get('origem'), request.headers.get('Idempotency-Key')))
+
+@escritor.comando(CriarReserva)
+def aplicar_reserva(cursor, comando: CriarReserva) -> dict:
+    # Uma reserva já liberada ou expirada não serve para a nova tentativa, a chave passa a apontar para outra
+    resposta_anterior = buscar_resposta(cursor, "reservas", comando.chave_idempotencia)
+    if resposta_anterior and reserva_ativa(cursor, resposta_anterior['reserva_id']):
+        return resposta_anterior
+    
+    resposta = criar_reserva(cursor, comando.quantidades, comando.origem, comando.ttl)
+    salvar_resposta(cursor, "reservas", comando.chave_idempotencia, resposta)
+    return resposta
+
+@app.post("/reservas", include_in_schema=False)
+async def criar_reserva_estoque(
+    request: Request,
+    reserva: dict = Body(...),
+    current_user: dict = Depends(require_admin)
+):
+    quantidades = agrupar_itens(reserva.get('itens'))
+    ttl = reserva.get('ttl_s', RESERVA_TTL_S)
+    
+    if isinstance(ttl, bool) or not isinstance(ttl, (int, float)) or not math.isfinite(ttl) or ttl <= 0:
+        raise HTTPException(status_code=400, detail="ttl_s deve ser um número positivo de segundos")
+    ttl = min(float(ttl), 10 * RESERVA_TTL_S)
+    
+    return await gravar(CriarReserva(quantidades, reserva.get('origem'), ttl, request.headers.get('Idempotency-Key')))
+
+@escritor.comando(ConfirmarReserva)
+def aplicar_confirmacao(cursor, comando: ConfirmarReserva) -> dict:
+    return confirmar_reserva(cursor, comando.reserva_id)
+
+@escritor.comando(LiberarReserva)
+def aplicar_liberacao(cursor, comando: LiberarReserva) -> dict:
+    return liberar_reserva(cursor, comando.reserva_id)
+
+@escritor.comando(ExpirarReservas)
+def aplicar_expiracao(cursor, comando: ExpirarReservas) -> int:
+    return expirar_reservas(cursor, comando.lote)
+
+@escritor.comando(LimparIdempotencia)
+def aplicar_limpeza_idempotencia(cursor, comando: LimparIdempotencia) -> int:
+    return limpar_respostas(cursor)
+
+@escritor.comando(SincronizarCotas)
+def aplicar_cotas(cursor, comando: SincronizarCotas) -> list:
+    return sincronizar_cotas(cursor, comando.filial, comando.itens)
+
+@escritor.comando(SalvarRegistro)
+def aplicar_registro(cursor, comando: SalvarRegistro):
+    salvar_registro(cursor, comando.membro)
+
+@escritor.comando(IniciarCursorReplica)
+def aplicar_inicio_cursor(cursor, comando: IniciarCursorReplica) -> dict:
+    return iniciar_cursor_replica(cursor, comando.replica)
+
+@escritor.comando(AvancarCursorReplica)
+def aplicar_avanco_cursor(cursor, comando: AvancarCursorReplica):
+    avancar_cursor_replica(cursor, comando.replica, comando.ultimo_id, comando.tentativas, comando.proxima_tentativa, comando.erro)
+
+@escritor.comando(LimparOutbox)
+def aplicar_limpeza_outbox(cursor, comando: LimparOutbox) -> int:
+    return limpar_outbox(cursor, comando.replicas)
+
+@app.post("/reservas/{reserva_id}/confirmar", include_in_schema=False)
+async def confirmar_reserva_estoque(
+    reserva_id: str,
+    current_user: dict = Depends(require_admin)
+):
+    return await gravar(ConfirmarReserva(reserva_id))
+
+@app.post("/reservas/{reserva_id}/liberar", include_in_schema=False)
+async def liberar_reserva_estoque(
+    reserva_id: str,
+    current_user: dict = Depends(require_admin)
+):
+    return await gravar(LiberarReserva(reserva_id))
+
+@app.post("/cotas/sincronizar", include_in_schema=False)
+async def sincronizar_cotas_filial(
+    sincronizacao: dict = Body(...),
+    current_user: dict = Depends(require_admin)
+):
+    filial = sincronizacao.get('filial')
+    itens = sincronizacao.get('itens', [])
+    
+    if not filial or not isinstance(itens, list):
+        raise HTTPException(status_code=400, detail="Sincronização de cotas inválida")
+    
+    cotas = await gravar(SincronizarCotas(filial, itens))
+    
+    return {
+        "filial": filial,
+        "itens": cotas
+    }
+
+@app.get("/cotas", tags=["Estoque"])
+@no_banco
+def listar_cotas(
+    apos_produto: int = 0,
+    apos_filial: str = "",
+    limite: int = 500,
+    current_user: dict = Depends(get_current_user)
+):
+    limite = max(1, min(limite, 5000))
+    
+    conn = get_db_connection(DATABASE_NAME)
+    try:
+        return consultar_cotas(conn.cursor(), apos_produto, apos_filial, limite)
     finally:
         conn.close()
 
+@app.get("/alteracoes", tags=["Sincronização"])
+@no_banco
+def listar_alteracoes(
+    since: int = 0,
+    limite: int = 500,
+    current_user: dict = Depends(get_current_user)
+):
+    limite = max(1, min(limite, 5000))
+    
+    conn = get_db_connection(DATABASE_NAME)
+    alteracoes = buscar_alteracoes(conn.cursor(), since, limite + 1)
+    conn.close()
+    
+    tem_mais = len(alteracoes) > limite
+    alteracoes = alteracoes[:limite]
+    
+    return {
+        "itens": alteracoes,
+        "ultima_seq": alteracoes[-1]['seq'] if alteracoes else since,
+        "tem_mais": tem_mais
+    }
+
+@app.get("/feed", tags=["Sincronização"])
+async def assinar_feed(
+    request: Request,
+    since: int = 0,
+    filial: str = None,
+    current_user: dict = Depends(get_current_user)
+):
+    ultimo_evento = request.headers.get("last-event-id")
+    if ultimo_evento and ultimo_evento.isdigit():
+        since = max(since, int(ultimo_evento))
+    
+    return StreamingResponse(
+        feed_alteracoes.eventos(since, filial),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.post("/merkle", tags=["Sincronização"])
+@no_banco
+def consultar_merkle(
+    consulta: dict = Body(example={"nivel": 0, "nos": [0]}),
+    current_user: dict = Depends(get_current_user)
+):
+    nivel = consulta.get('nivel', 0)
+    nos = consulta.get('nos', [])
+    
+    if not isinstance(nivel, int) or not 0 <= nivel < merkle.NIVEIS:
+        raise HTTPException(status_code=400, detail="Nível inválido")
+    if not isinstance(nos, list) or any(not isinstance(no, int) or not 0 <= no < merkle.ARIDADE ** nivel for no in nos):
+        raise HTTPException(status_code=400, detail="Nós inválidos para o nível")
+    
+    conn = get_db_connection(DATABASE_NAME)
+    filhos = merkle.filhos(conn.cursor(), nivel, nos)
+    conn.close()
+    
+    return {
+        "nivel": nivel,
+        "nos": filhos
+    }
+
+@app.post("/merkle/folhas", tags=["Sincronização"])
+@no_banco
+def consultar_folhas_merkle(
+    consulta: dict = Body(example={"folhas": [0]}),
+    current_user: dict = Depends(get_current_user)
+):
+    folhas = consulta.get('folhas', [])
+    
+    if not isinstance(folhas, list) or any(not isinstance(folha, int) or not 0 <= folha < merkle.NUM_FOLHAS for folha in folhas):
+        raise HTTPException(status_code=400, detail="Folhas inválidas")
+    
+    conn = get_db_connection(DATABASE_NAME)
+    itens = merkle.linhas_folhas(conn.cursor(), folhas) if folhas else []
+    conn.close()
+    
+    return {
+        "itens": itens
+    }
+
+def gerar_snapshot(compactar: bool, lote: int = 1000):
+    conn = get_db_connection(DATABASE_NAME)
+    cursor = conn.cursor()
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compactar else None
+    
+    def codificar(texto: str) -> bytes:
+        dados = texto.encode()
+        return compressor.compress(dados) if compressor else dados
+    
+    try:
+        # Uma única transação de leitura garante que a sequência e as linhas são do mesmo instante
+        conn.execute("BEGIN")
+        yield codificar(json.dumps({"tipo": "snapshot", "seq": ler_controle(cursor, 'seq')}) + "\n")
+        
+        cursor.execute(
+            "SELECT p.codigo, p.nome, p.preco, e.quantidade FROM produtos p JOIN estoque e ON p.id = e.produto_id ORDER BY p.id"
+        )
+        while True:
+            linhas = cursor.fetchmany(lote)
+            if not linhas:
+                break
+            dados = codificar("".join(
+                json.dumps({
+                    "codigo": linha['codigo'],
+                    "nome": linha['nome'],
+                    "preco": linha['preco'],
+                    "quantidade": linha['quantidade']
+                }) + "\n"
+                for linha in linhas
+            ))
+            if dados:
+                yield dados
+        
+        if compressor:
+            yield compressor.flush()
+    finally:
+        conn.rollback()
+        conn.close()
+
+@app.get("/snapshot", tags=["Sincronização"])
+async def exportar_snapshot(
+    request: Request,
+    current_user: dict = Depends(get_current_user)
+):
+    compactar = "gzip" in request.headers.get("accept-encoding", "")
+    headers = {"Content-Encoding": "gzip"} if compactar else {}
+    
+    return StreamingResponse(
+        gerar_snapshot(compactar),
+        media_type="application/x-ndjson",
+        headers=headers
+    )
+
+@app.post("/replicas/registro", include_in_schema=False)
+async def registrar_replica(
+    registro: dict = Body(...),
+    current_user: dict = Depends(require_admin)
+):
+    nome = registro.get('nome')
+    url = registro.get('url')
+    capacidades = registro.get('capacidades', [])
+    
+    if not nome or nome == 'matriz' or not url or not url.startswith(('http://', 'https://')):
+        raise HTTPException(status_code=400, detail="Registro de réplica inválido")
+    if not isinstance(capacidades, list):
+        raise HTTPException(status_code=400, detail="Formato inválido para capacidades")
+    
+    membro = REPLICAS.registrar(nome, url, capacidades, registro.get('versao'))
+    
+    await escritor.executar(SalvarRegistro(membro))
+    
+    return {
+        "replicas": REPLICAS.detalhes(),
+        "ttl_s": REPLICAS.ttl
+    }
+
+@app.get("/replicas", tags=["Filiais"])
+async def listar_replicas(current_user: dict = Depends(get_current_user)):
+    return REPLICAS.detalhes()
 
 @app.get("/status", tags=["Filiais"])
 async def get_status(current_user: dict = Depends(get_current_user)):
@@ -336,8 +595,10 @@ async def get_status(current_user: dict = Depends(get_current_user)):
         "api_name": API_NAME,
         "status": "online",
         "timestamp": datetime.now().isoformat(),
-        "replicas": replicas_status
+        "replicas": replicas_status,
+        "replicacao": outbox_worker.drenagens,
+        "circuitos": circuitos.estados()
     }
 
 if __name__ == "__main__":
-    uvicorn.run("api:app", host="localhost", port=API_PORT, reload=True)
\ No newline at end of file
+    uvicorn.run("api:app", host="localhost", port=API_PORT, reload=True, timeout_graceful_shutdown=5)
\ No newline at end of file
@@ -0,0 +1,115 @@
+import os
+import threading
+import time
+from collections import deque
+from typing import Dict
+
+import requests
+
+CIRCUITO_TAXA_FALHA = float(os.getenv('CIRCUITO_TAXA_FALHA', 0.5))
+CIRCUITO_MINIMO_CHAMADAS = int(os.getenv('CIRCUITO_MINIMO_CHAMADAS', 5))
+CIRCUITO_JANELA = int(os.getenv('CIRCUITO_JANELA', 20))
+CIRCUITO_TEMPO_ABERTO_S = float(os.getenv('CIRCUITO_TEMPO_ABERTO_S', 10))
+
+FECHADO = "fechado"
+ABERTO = "aberto"
+MEIO_ABERTO = "meio_aberto"
+
+class CircuitoAbertoError(requests.ConnectionError):
+    pass
+
+class CircuitBreaker:
+    def __init__(self, name: str, taxa_falha: float = CIRCUITO_TAXA_FALHA, minimo_chamadas: int = CIRCUITO_MINIMO_CHAMADAS,
+                 janela: int = CIRCUITO_JANELA, tempo_aberto: float = CIRCUITO_TEMPO_ABERTO_S):
+        self.name = name
+        self.taxa_falha = taxa_falha
+        self.minimo_chamadas = minimo_chamadas
+        self.tempo_aberto = tempo_aberto
+        self.resultados = deque(maxlen=janela)
+        self.estado = FECHADO
+        self.aberto_em = 0.0
+        self.teste_em_andamento = False
+        self.lock = threading.Lock()
+
+    def permitir(self) -> bool:
+        with self.lock:
+            if self.estado == FECHADO:
+                return True
+            if self.estado == ABERTO:
+                if time.monotonic() - self.aberto_em < self.tempo_aberto:
+                    return False
+                self.estado = MEIO_ABERTO
+                self.teste_em_andamento = False
+            # Meio aberto deixa passar uma chamada de teste por vez
+            if self.teste_em_andamento:
+                return False
+            self.teste_em_andamento = True
+            return True
+
+    def registrar(self, sucesso: bool):
+        with self.lock:
+            if self.estado == MEIO_ABERTO:
+                self.teste_em_andamento = False
+                if sucesso:
+                    self.estado = FECHADO
+                    self.resultados.clear()
+                else:
+                    self._abrir()
+                return
+
+            self.resultados.append(sucesso)
+            falhas = self.resultados.count(False)
+            if len(self.resultados) >= self.minimo_chamadas and falhas / len(self.resultados) >= self.taxa_falha:
+                self._abrir()
+
+    def _abrir(self):
+        self.estado = ABERTO
+        self.aberto_em = time.monotonic()
+        self.resultados.clear()
+        print(f"ERRO: Circuito para {self.name} aberto por {self.tempo_aberto}s")
+
+    def request(self, session, method: str, url: str, **kwargs) -> requests.Response:
+        if not self.permitir():
+            raise CircuitoAbertoError(f"Circuito para {self.name} aberto, chamada recusada sem contatar a réplica")
+
+        try:
+            response = (session or requests).request(method, url, **kwargs)
+        except Exception:
+            self.registrar(False)
+            raise
+
+        self.registrar(response.status_code < 500)
+        return response
+
+    def estado_atual(self) -> Dict:
+        with self.lock:
+            restante = None
+            if self.estado == ABERTO:
+                restante = round(max(0.0, self.tempo_aberto - (time.monotonic() - self.aberto_em)), 2)
+            return {
+                "estado": self.estado,
+                "chamadas_na_janela": len(self.resultados),
+                "falhas_na_janela": self.resultados.count(False),
+                "reabre_em_s": restante
+            }
+
+class RegistroCircuitos:
+    def __init__(self):
+        self.circuitos: Dict[str, CircuitBreaker] = {}
+        self.lock = threading.Lock()
+
+    def get(self, name: str) -> CircuitBreaker:
+        with self.lock:
+            if name not in self.circuitos:
+                self.circuitos[name] = CircuitBreaker(name)
+            return self.circuitos[name]
+
+    def request(self, name: str, method: str, url: str, session=None, **kwargs) -> requests.Response:
+        return self.get(name).request(session, method, url, **kwargs)
+
+    def estados(self) -> Dict[str, Dict]:
+        with self.lock:
+            circuitos = dict(self.circuitos)
+        return {name: circuito.estado_atual() for name, circuito in circuitos.items()}
+
+circuitos = RegistroCircuitos()
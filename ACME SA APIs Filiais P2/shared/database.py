@@ -1,14 +1,228 @@
 import sqlite3
 from datetime import datetime
+import asyncio
+import functools
 import os
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional
 
-def get_db_connection(db_name):
-    conn = sqlite3.connect(db_name, check_same_thread=False)
+from shared.idempotencia import init_idempotencia
+from shared.pedidos import init_pedidos
+from shared.merkle import registrar_funcoes, init_merkle, conferir_merkle
+
+POOL_MAX_CONEXOES = int(os.getenv('POOL_MAX_CONEXOES', 32))
+POOL_ESPERA_S = float(os.getenv('POOL_ESPERA_S', 10))
+POOL_VERIFICAR_S = float(os.getenv('POOL_VERIFICAR_S', 30))
+POOL_CACHE_COMANDOS = int(os.getenv('POOL_CACHE_COMANDOS', 256))
+BANCO_THREADS = int(os.getenv('BANCO_THREADS', 16))
+
+# Perfil de journal e trava: com WAL as leituras não esperam a escrita em andamento
+SQLITE_JOURNAL_MODE = os.getenv('SQLITE_JOURNAL_MODE', 'WAL').upper()
+SQLITE_TRAVA_ESCRITA = os.getenv('SQLITE_TRAVA_ESCRITA', 'IMMEDIATE' if SQLITE_JOURNAL_MODE == 'WAL' else 'EXCLUSIVE').upper()
+SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL').upper()
+SQLITE_ESPERA_TRAVA_S = float(os.getenv('SQLITE_ESPERA_TRAVA_S', 5))
+WAL_AUTOCHECKPOINT_PAGINAS = int(os.getenv('WAL_AUTOCHECKPOINT_PAGINAS', 1000))
+WAL_CHECKPOINT_LIMITE_MB = float(os.getenv('WAL_CHECKPOINT_LIMITE_MB', 64))
+WAL_CHECKPOINT_INTERVALO_S = float(os.getenv('WAL_CHECKPOINT_INTERVALO_S', 30))
+
+if SQLITE_JOURNAL_MODE not in ('WAL', 'DELETE', 'TRUNCATE', 'PERSIST'):
+    raise ValueError(f"SQLITE_JOURNAL_MODE inválido: {SQLITE_JOURNAL_MODE}")
+if SQLITE_TRAVA_ESCRITA not in ('DEFERRED', 'IMMEDIATE', 'EXCLUSIVE'):
+    raise ValueError(f"SQLITE_TRAVA_ESCRITA inválido: {SQLITE_TRAVA_ESCRITA}")
+if SQLITE_SYNCHRONOUS not in ('OFF', 'NORMAL', 'FULL', 'EXTRA'):
+    raise ValueError(f"SQLITE_SYNCHRONOUS inválido: {SQLITE_SYNCHRONOUS}")
+
+def abrir_conexao(db_name):
+    conn = sqlite3.connect(db_name, timeout=SQLITE_ESPERA_TRAVA_S, check_same_thread=False, cached_statements=POOL_CACHE_COMANDOS)
     conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA journal_mode=DELETE")
-    conn.execute("PRAGMA synchronous=NORMAL")
+    registrar_funcoes(conn)
+    conn.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+    conn.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    if SQLITE_JOURNAL_MODE == 'WAL':
+        conn.execute(f"PRAGMA wal_autocheckpoint={WAL_AUTOCHECKPOINT_PAGINAS}")
     return conn
 
+def iniciar_escrita(conn):
+    conn.execute(f"BEGIN {SQLITE_TRAVA_ESCRITA}")
+
+class ConexaoPool:
+    def __init__(self, pool: "PoolConexoes", conn: sqlite3.Connection):
+        self._pool = pool
+        self._conn = conn
+        self._cursores = weakref.WeakSet()
+
+    def cursor(self):
+        cursor = self.conexao.cursor()
+        self._cursores.add(cursor)
+        return cursor
+
+    def execute(self, sql, parametros=()):
+        return self.cursor().execute(sql, parametros)
+
+    def executemany(self, sql, parametros):
+        return self.cursor().executemany(sql, parametros)
+
+    def executescript(self, sql):
+        return self.cursor().executescript(sql)
+
+    @property
+    def conexao(self) -> sqlite3.Connection:
+        if self._conn is None:
+            raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+        return self._conn
+
+    def close(self):
+        if self._conn is None:
+            return
+        conn, self._conn = self._conn, None
+        # Um SELECT lido pela metade mantém a trava de leitura, então os cursores são fechados antes de devolver a conexão
+        for cursor in list(self._cursores):
+            try:
+                cursor.close()
+            except sqlite3.Error:
+                pass
+        self._pool.devolver(conn)
+
+    def __getattr__(self, nome):
+        return getattr(self.conexao, nome)
+
+    def __enter__(self):
+        self.conexao.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        return self.conexao.__exit__(*args)
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+class PoolConexoes:
+    def __init__(self, db_name: str, maximo: int = POOL_MAX_CONEXOES, espera: float = POOL_ESPERA_S):
+        self.db_name = db_name
+        self.espera = espera
+        self.vagas = threading.BoundedSemaphore(maximo)
+        self.trava = threading.Lock()
+        self.livres = []
+
+    def _retirar(self) -> ConexaoPool:
+        try:
+            conn = self._livre() or abrir_conexao(self.db_name)
+        except Exception:
+            self.vagas.release()
+            raise
+        return ConexaoPool(self, conn)
+
+    def _livre(self):
+        while True:
+            with self.trava:
+                if not self.livres:
+                    return None
+                # A última devolvida é a que tem o cache de páginas e de comandos mais quente
+                conn, devolvida_em = self.livres.pop()
+            if time.monotonic() - devolvida_em < POOL_VERIFICAR_S:
+                return conn
+            try:
+                conn.execute("SELECT 1").fetchone()
+                return conn
+            except sqlite3.Error:
+                self._fechar(conn)
+
+    def _fechar(self, conn):
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    def adquirir(self) -> ConexaoPool:
+        if not self.vagas.acquire(timeout=self.espera):
+            raise sqlite3.OperationalError(f"Pool de conexões de {self.db_name} esgotado")
+        return self._retirar()
+
+    def devolver(self, conn: sqlite3.Connection):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            with self.trava:
+                self.livres.append((conn, time.monotonic()))
+        except sqlite3.Error:
+            self._fechar(conn)
+        finally:
+            self.vagas.release()
+
+_pools: Dict[str, PoolConexoes] = {}
+_pools_trava = threading.Lock()
+
+def obter_pool(db_name) -> PoolConexoes:
+    with _pools_trava:
+        if db_name not in _pools:
+            _pools[db_name] = PoolConexoes(db_name)
+        return _pools[db_name]
+
+def get_db_connection(db_name) -> ConexaoPool:
+    return obter_pool(db_name).adquirir()
+
+# Executor só do banco: chamadas à matriz esperando timeout não ocupam as threads das consultas
+executor_banco = ThreadPoolExecutor(max_workers=BANCO_THREADS, thread_name_prefix="banco")
+
+async def executar_no_banco(funcao: Callable, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(executor_banco, functools.partial(funcao, *args, **kwargs))
+
+def no_banco(funcao: Callable):
+    # O endpoint é escrito de forma síncrona e roda no executor do banco, o event loop só espera o resultado
+    @functools.wraps(funcao)
+    async def endpoint(*args, **kwargs):
+        return await executar_no_banco(funcao, *args, **kwargs)
+    return endpoint
+
+def executar_checkpoint(db_name, modo: str = "TRUNCATE") -> Dict:
+    conn = get_db_connection(db_name)
+    try:
+        ocupado, paginas_wal, paginas_copiadas = conn.execute(f"PRAGMA wal_checkpoint({modo})").fetchone()
+        return {"ocupado": bool(ocupado), "paginas_wal": paginas_wal, "paginas_copiadas": paginas_copiadas}
+    finally:
+        conn.close()
+
+class CheckpointWAL:
+    def __init__(self, db_name: str, limite_mb: float = WAL_CHECKPOINT_LIMITE_MB, intervalo: float = WAL_CHECKPOINT_INTERVALO_S):
+        self.db_name = db_name
+        self.limite = limite_mb * 1024 * 1024
+        self.intervalo = intervalo
+        self.parar = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def tamanho_wal(self) -> int:
+        try:
+            return os.path.getsize(f"{self.db_name}-wal")
+        except OSError:
+            return 0
+
+    def _loop(self):
+        while not self.parar.wait(self.intervalo):
+            # O checkpoint automático só copia as páginas, o arquivo WAL continua do mesmo tamanho até um TRUNCATE
+            if self.tamanho_wal() <= self.limite:
+                continue
+            try:
+                resultado = executar_checkpoint(self.db_name)
+                if resultado['ocupado']:
+                    print(f"Checkpoint do WAL de {self.db_name} adiado: há leituras longas em andamento")
+            except Exception as e:
+                print(f"ERRO: Falha no checkpoint do WAL de {self.db_name}: {e}")
+
+    def start(self):
+        if SQLITE_JOURNAL_MODE != 'WAL':
+            return
+        self.thread = threading.Thread(target=self._loop, name="checkpoint-wal", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.parar.set()
+
 def init_database(db_name, api_name):
     conn = get_db_connection(db_name)
     cursor = conn.cursor()
@@ -63,8 +277,18 @@ def init_database(db_name, api_name):
         )
     ''')
     
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sincronizacao (
+            chave TEXT PRIMARY KEY,
+            valor INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    
     conn.commit()
     
+    aplicar_migracoes(conn)
+    conferir_merkle(cursor)
+    
     cursor.execute("SELECT COUNT(*) as count FROM usuarios")
     if cursor.fetchone()['count'] == 0:
         cursor.execute(
@@ -76,3 +300,120 @@ def init_database(db_name, api_name):
     conn.close()
     
     print(f"Banco de dados '{db_name}' inicializado para {api_name}")
+
+
+def _estoque_unico_por_produto(cursor):
+    # Bancos antigos podem ter mais de uma linha de estoque por produto, fica a mais recente
+    cursor.execute("DELETE FROM estoque WHERE id NOT IN (SELECT MAX(id) FROM estoque GROUP BY produto_id)")
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_estoque_produto ON estoque (produto_id)")
+
+def _indices_pedidos(cursor):
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pedidos_criado_em_id ON pedidos (criado_em, id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pedidos_itens_pedido ON pedidos_itens (pedido_id)")
+
+def _origem_do_estoque(cursor):
+    # Quem pediu a última alteração, o feed não devolve a alteração para a filial que a originou
+    adicionar_coluna(cursor, 'estoque', 'origem', 'TEXT')
+
+def _sequencia_de_alteracoes(cursor):
+    adicionar_coluna(cursor, 'produtos', 'seq', 'INTEGER NOT NULL DEFAULT 0')
+    if adicionar_coluna(cursor, 'estoque', 'seq', 'INTEGER NOT NULL DEFAULT 0'):
+        cursor.execute("UPDATE estoque SET seq = id")
+        cursor.execute(
+            "UPDATE produtos SET seq = COALESCE((SELECT MAX(e.seq) FROM estoque e WHERE e.produto_id = produtos.id), 0)"
+        )
+        cursor.execute(
+            "INSERT OR REPLACE INTO sincronizacao (chave, valor) VALUES ('seq', (SELECT COALESCE(MAX(seq), 0) FROM estoque))"
+        )
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_estoque_seq ON estoque (seq)")
+
+def _arvore_merkle(cursor):
+    init_merkle(cursor, adicionar_coluna)
+
+# Cada migração roda uma única vez por banco, na ordem, e a versão aplicada fica no PRAGMA user_version.
+# As de 4 em diante entraram em bancos que já tinham as colunas e tabelas criadas no início da API, então
+# conferem o que já existe antes de criar.
+MIGRACOES = [
+    (1, "estoque com uma linha por produto", _estoque_unico_por_produto),
+    (2, "índices de pedidos por data e dos itens por pedido", _indices_pedidos),
+    (3, "origem da última alteração de estoque", _origem_do_estoque),
+    (4, "sequência de alterações de produtos e estoque", _sequencia_de_alteracoes),
+    (5, "árvore de Merkle dos produtos", _arvore_merkle),
+    (6, "totais diários de vendas", init_pedidos),
+    (7, "respostas idempotentes", init_idempotencia),
+]
+
+def versao_schema(conn) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def aplicar_migracoes(conn):
+    for versao, descricao, migracao in MIGRACOES:
+        if versao_schema(conn) >= versao:
+            continue
+        try:
+            iniciar_escrita(conn)
+            # Conferido de novo dentro da trava, caso outro processo tenha migrado o banco nesse meio tempo
+            if versao_schema(conn) >= versao:
+                conn.rollback()
+                continue
+            migracao(conn.cursor())
+            conn.execute(f"PRAGMA user_version = {versao}")
+            conn.commit()
+            print(f"Migração {versao} aplicada: {descricao}")
+        except Exception:
+            conn.rollback()
+            raise
+
+def adicionar_coluna(cursor, tabela, coluna, definicao):
+    cursor.execute(f"PRAGMA table_info({tabela})")
+    if any(linha['name'] == coluna for linha in cursor.fetchall()):
+        return False
+    cursor.execute(f"ALTER TABLE {tabela} ADD COLUMN {coluna} {definicao}")
+    return True
+
+def ler_controle(cursor, chave, padrao=0):
+    cursor.execute("SELECT valor FROM sincronizacao WHERE chave = ?", (chave,))
+    linha = cursor.fetchone()
+    return linha['valor'] if linha else padrao
+
+def gravar_controle(cursor, chave, valor):
+    cursor.execute(
+        "INSERT INTO sincronizacao (chave, valor) VALUES (?, ?) ON CONFLICT(chave) DO UPDATE SET valor = excluded.valor",
+        (chave, valor)
+    )
+
+def proxima_sequencia(cursor):
+    cursor.execute(
+        "INSERT INTO sincronizacao (chave, valor) VALUES ('seq', 1) ON CONFLICT(chave) DO UPDATE SET valor = valor + 1"
+    )
+    return ler_controle(cursor, 'seq')
+
+SQL_ESTOQUE_POR_CODIGO = "UPDATE estoque SET quantidade = ?, atualizado_em = CURRENT_TIMESTAMP WHERE produto_id = (SELECT id FROM produtos WHERE codigo = ?)"
+SQL_ESTOQUE_NOVO = "INSERT INTO estoque (produto_id, quantidade) SELECT p.id, ? FROM produtos p WHERE p.codigo = ? AND NOT EXISTS (SELECT 1 FROM estoque e WHERE e.produto_id = p.id)"
+SQL_ALTERACOES = (
+    "SELECT p.codigo, p.nome, p.preco, p.seq AS seq_produto, e.quantidade, e.seq, e.origem "
+    "FROM estoque e JOIN produtos p ON p.id = e.produto_id WHERE e.seq > ? ORDER BY e.seq LIMIT ?"
+)
+
+def aplicar_catalogo(cursor, itens):
+    cursor.executemany(
+        "INSERT INTO produtos (codigo, nome, preco) VALUES (?, ?, ?) ON CONFLICT(codigo) DO UPDATE SET nome = excluded.nome, preco = excluded.preco",
+        [(item['codigo'], item['nome'], item['preco']) for item in itens]
+    )
+    cursor.executemany(SQL_ESTOQUE_POR_CODIGO, [(item['quantidade'], item['codigo']) for item in itens])
+    cursor.executemany(SQL_ESTOQUE_NOVO, [(item['quantidade'], item['codigo']) for item in itens])
+
+def buscar_alteracoes(cursor, since, limite):
+    cursor.execute(SQL_ALTERACOES, (since, limite))
+    return [
+        {
+            "tipo": "produto" if alteracao['seq_produto'] == alteracao['seq'] else "estoque",
+            "seq": alteracao['seq'],
+            "codigo": alteracao['codigo'],
+            "nome": alteracao['nome'],
+            "preco": alteracao['preco'],
+            "quantidade": alteracao['quantidade'],
+            "origem": alteracao['origem']
+        }
+        for alteracao in cursor.fetchall()
+    ]
@@ -0,0 +1,206 @@
+import asyncio
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+from shared.database import abrir_conexao, iniciar_escrita
+
+ESCRITOR_JANELA_MS = float(os.getenv('ESCRITOR_JANELA_MS', 2))
+ESCRITOR_MAX_LOTE = int(os.getenv('ESCRITOR_MAX_LOTE', 256))
+
+# Comandos de escrita da matriz, cada um vira um item da fila do escritor
+@dataclass(frozen=True)
+class CriarUsuario:
+    login: str
+    password: str
+
+@dataclass(frozen=True)
+class CriarProduto:
+    codigo: str
+    nome: str
+    preco: float
+    quantidade: int
+    origem: Optional[str] = None
+
+@dataclass(frozen=True)
+class AlterarEstoque:
+    codigo_produto: str
+    operacao: str
+    quantidade: int
+    origem: Optional[str] = None
+    chave_idempotencia: Optional[str] = None
+
+@dataclass(frozen=True)
+class BaixarEstoque:
+    quantidades: Dict[str, int]
+    origem: Optional[str] = None
+    chave_idempotencia: Optional[str] = None
+
+@dataclass(frozen=True)
+class CriarReserva:
+    quantidades: Dict[str, int]
+    origem: Optional[str]
+    ttl: float
+    chave_idempotencia: Optional[str] = None
+
+@dataclass(frozen=True)
+class ConfirmarReserva:
+    reserva_id: str
+
+@dataclass(frozen=True)
+class LiberarReserva:
+    reserva_id: str
+
+@dataclass(frozen=True)
+class ExpirarReservas:
+    lote: int = 500
+
+@dataclass(frozen=True)
+class LimparIdempotencia:
+    pass
+
+@dataclass(frozen=True)
+class SincronizarCotas:
+    filial: str
+    itens: List[Dict]
+
+@dataclass(frozen=True)
+class SalvarRegistro:
+    membro: Dict
+
+@dataclass(frozen=True)
+class IniciarCursorReplica:
+    replica: str
+
+@dataclass(frozen=True)
+class AvancarCursorReplica:
+    replica: str
+    ultimo_id: int
+    tentativas: int = 0
+    proxima_tentativa: float = 0
+    erro: Optional[str] = None
+
+@dataclass(frozen=True)
+class LimparOutbox:
+    replicas: Tuple[str, ...]
+
+class EscritorUnico:
+    def __init__(self, db_name: str, janela: float = ESCRITOR_JANELA_MS / 1000, max_lote: int = ESCRITOR_MAX_LOTE,
+                 ao_gravar: Optional[Callable[[], None]] = None):
+        self.db_name = db_name
+        self.janela = janela
+        self.max_lote = max_lote
+        self.ao_gravar = ao_gravar
+        self.executores: Dict[type, Callable] = {}
+        self.fila: "queue.Queue" = queue.Queue()
+        self.conn: Optional[sqlite3.Connection] = None
+        self.thread: Optional[threading.Thread] = None
+        self.lotes = 0
+        self.operacoes = 0
+
+    def comando(self, tipo: type):
+        # Registra a função que aplica um tipo de comando, ela recebe o cursor da transação e o comando
+        def registrar(funcao: Callable):
+            self.executores[tipo] = funcao
+            return funcao
+        return registrar
+
+    def enviar(self, comando) -> Future:
+        if type(comando) not in self.executores:
+            raise TypeError(f"Comando sem executor registrado: {type(comando).__name__}")
+        futuro = Future()
+        self.fila.put((comando, futuro))
+        return futuro
+
+    async def executar(self, comando):
+        return await asyncio.wrap_future(self.enviar(comando))
+
+    def _coletar(self, primeira) -> list:
+        lote = [primeira]
+        limite = time.monotonic() + self.janela
+        while len(lote) < self.max_lote:
+            restante = limite - time.monotonic()
+            try:
+                operacao = self.fila.get(timeout=restante) if restante > 0 else self.fila.get_nowait()
+            except queue.Empty:
+                break
+            if operacao is None:
+                self.fila.put(None)
+                break
+            lote.append(operacao)
+        return lote
+
+    def _conexao(self) -> sqlite3.Connection:
+        # A conexão de escrita é só do escritor e fica aberta enquanto ele estiver ligado
+        if self.conn is None:
+            self.conn = abrir_conexao(self.db_name)
+        return self.conn
+
+    def _gravar(self, lote):
+        resultados = []
+        conn = self._conexao()
+        cursor = conn.cursor()
+        alteracoes = conn.total_changes
+        try:
+            iniciar_escrita(conn)
+            for comando, _ in lote:
+                # Cada comando roda num savepoint, o que falha é desfeito sem levar os outros do lote junto
+                cursor.execute("SAVEPOINT comando")
+                try:
+                    resultados.append((self.executores[type(comando)](cursor, comando), None))
+                    cursor.execute("RELEASE comando")
+                except Exception as e:
+                    cursor.execute("ROLLBACK TO comando")
+                    cursor.execute("RELEASE comando")
+                    resultados.append((None, e))
+            conn.commit()
+        except Exception as e:
+            try:
+                conn.rollback()
+            except sqlite3.Error:
+                pass
+            if isinstance(e, sqlite3.Error):
+                # Conexão em estado desconhecido, a próxima rodada abre outra
+                conn.close()
+                self.conn = None
+            for _, futuro in lote:
+                futuro.set_exception(e)
+            return
+        finally:
+            cursor.close()
+
+        self.lotes += 1
+        self.operacoes += len(lote)
+        # Ninguém recebe resposta antes do commit, então uma resposta de sucesso sempre está gravada
+        for (_, futuro), (resultado, erro) in zip(lote, resultados):
+            if erro is not None:
+                futuro.set_exception(erro)
+            else:
+                futuro.set_result(resultado)
+        if self.ao_gravar and conn.total_changes != alteracoes:
+            self.ao_gravar()
+
+    def _loop(self):
+        while True:
+            primeira = self.fila.get()
+            if primeira is None:
+                break
+            try:
+                self._gravar(self._coletar(primeira))
+            except Exception as e:
+                print(f"ERRO: Falha no escritor da matriz: {e}")
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._loop, name="escritor", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.fila.put(None)
@@ -0,0 +1,330 @@
+import math
+import os
+import threading
+import time
+from datetime import timedelta
+from typing import Dict, List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from shared.database import get_db_connection, iniciar_escrita, proxima_sequencia
+from shared.auth import create_access_token
+from shared.outbox import registrar_evento
+from shared.circuit_breaker import circuitos
+
+COTA_HORIZONTE_S = float(os.getenv('COTA_HORIZONTE_S', 60))
+COTA_FRACAO_MAX = float(os.getenv('COTA_FRACAO_MAX', 0.5))
+COTA_INTERVALO_S = float(os.getenv('COTA_INTERVALO_S', 5))
+COTA_SUAVIZACAO = 0.3
+# A filial só usa a cota até COTA_TTL_S / 2 depois da última sincronização bem-sucedida. Passado COTA_TTL_S sem
+# sincronizar, a cota expira: a demanda dela sai da divisão entre as filiais e, na volta, ela devolve o que não vendeu
+COTA_TTL_S = float(os.getenv('COTA_TTL_S', 120))
+
+# Todos os contadores são totais acumulados que só crescem, então repetir uma sincronização não conta nada duas vezes.
+# Cota em poder da filial = concedido_total - consumido_total - devolvido_total
+
+SQL_COTAS_RESERVADAS = (
+    "SELECT produto_id, SUM(concedido_total - consumido_total - devolvido_total) AS reservado FROM cotas_escrow "
+    "WHERE produto_id IN ({}) GROUP BY produto_id"
+)
+SQL_PRODUTOS_EM_COTA = "SELECT p.codigo FROM cotas_escrow c JOIN produtos p ON p.id = c.produto_id WHERE c.filial = ?"
+SQL_ESTOQUE_DO_PRODUTO = "SELECT p.id, e.quantidade FROM produtos p JOIN estoque e ON p.id = e.produto_id WHERE p.codigo = ?"
+SQL_COTA = "SELECT * FROM cotas_escrow WHERE filial = ? AND produto_id = ?"
+SQL_COTAS_DAS_OUTRAS = (
+    "SELECT COALESCE(SUM(CASE WHEN sincronizado_em >= ? THEN demanda ELSE 0 END), 0) AS demanda, "
+    "COALESCE(SUM(concedido_total - consumido_total - devolvido_total), 0) AS em_poder "
+    "FROM cotas_escrow WHERE produto_id = ? AND filial != ?"
+)
+# Paginação por chave (produto_id, filial): cada página é uma busca no índice de cotas, o catálogo não é percorrido
+SQL_LISTAR_COTAS = (
+    "SELECT c.filial, c.produto_id, p.codigo, c.concedido_total - c.consumido_total - c.devolvido_total AS em_poder, "
+    "c.demanda, c.sincronizado_em, e.quantidade "
+    "FROM cotas_escrow c JOIN produtos p ON p.id = c.produto_id JOIN estoque e ON e.produto_id = c.produto_id "
+    "WHERE (c.produto_id, c.filial) > (?, ?) ORDER BY c.produto_id, c.filial LIMIT ?"
+)
+SQL_SALDO_LOCAL = (
+    "SELECT produto_id, concedido_total - consumido_total - devolvido_total AS saldo FROM cotas_locais "
+    "WHERE produto_id IN ({})"
+)
+
+def init_cotas_matriz(db_name):
+    conn = get_db_connection(db_name)
+    cursor = conn.cursor()
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS cotas_escrow (
+            filial TEXT NOT NULL,
+            produto_id INTEGER NOT NULL,
+            concedido_total INTEGER NOT NULL DEFAULT 0,
+            consumido_total INTEGER NOT NULL DEFAULT 0,
+            devolvido_total INTEGER NOT NULL DEFAULT 0,
+            vendido_total INTEGER NOT NULL DEFAULT 0,
+            demanda REAL NOT NULL DEFAULT 0,
+            sincronizado_em REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (filial, produto_id),
+            FOREIGN KEY (produto_id) REFERENCES produtos (id)
+        )
+    ''')
+    cursor.execute("DROP INDEX IF EXISTS idx_cotas_escrow_produto")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_cotas_escrow_produto_filial ON cotas_escrow (produto_id, filial)")
+
+    conn.commit()
+    conn.close()
+
+def cotas_reservadas(cursor, produto_ids: List[int]) -> Dict[int, int]:
+    if not produto_ids:
+        return {}
+    # A cota expirada continua separada: a filial pode ter vendido dentro dela e ainda não ter informado
+    cursor.execute(SQL_COTAS_RESERVADAS.format(",".join("?" for _ in produto_ids)), list(produto_ids))
+    return {linha['produto_id']: linha['reservado'] for linha in cursor.fetchall()}
+
+def sincronizar_cotas(cursor, filial: str, itens: List[Dict]) -> List[Dict]:
+    agora = time.time()
+    resultado = []
+
+    codigos = [item['codigo_produto'] for item in itens]
+    cursor.execute(SQL_PRODUTOS_EM_COTA, (filial,))
+    codigos += [linha['codigo'] for linha in cursor.fetchall() if linha['codigo'] not in codigos]
+    informados = {item['codigo_produto']: item for item in itens}
+
+    for codigo in codigos:
+        cursor.execute(SQL_ESTOQUE_DO_PRODUTO, (codigo,))
+        produto = cursor.fetchone()
+        if not produto:
+            continue
+
+        cursor.execute(
+            "INSERT OR IGNORE INTO cotas_escrow (filial, produto_id, sincronizado_em) VALUES (?, ?, ?)",
+            (filial, produto['id'], agora - COTA_INTERVALO_S)
+        )
+        cursor.execute(SQL_COTA, (filial, produto['id']))
+        cota = cursor.fetchone()
+
+        item = informados.get(codigo, {})
+        expirada = cota['sincronizado_em'] < agora - COTA_TTL_S
+        consumido_total = max(cota['consumido_total'], int(item.get('consumido_total', 0)))
+        devolvido_total = max(cota['devolvido_total'], int(item.get('devolvido_total', 0)))
+        vendido_total = max(cota['vendido_total'], int(item.get('vendido_total', 0)))
+        # A filial nunca consome nem devolve mais do que recebeu
+        consumido_total = min(consumido_total, cota['concedido_total'] - devolvido_total)
+
+        quantidade = produto['quantidade']
+        # O que a filial vendeu dentro da cota sai do estoque da matriz só agora, a unidade já estava separada para ela.
+        # A alteração não tem origem, então a própria filial também recebe o valor absoluto acertado.
+        # Um consumo que não cabe mais no estoque (um ajuste feito direto no banco, por exemplo) para em zero
+        baixa = min(consumido_total - cota['consumido_total'], max(0, quantidade))
+        if baixa:
+            quantidade -= baixa
+            cursor.execute(
+                "UPDATE estoque SET quantidade = ?, seq = ?, origem = NULL, atualizado_em = CURRENT_TIMESTAMP WHERE produto_id = ?",
+                (quantidade, proxima_sequencia(cursor), produto['id'])
+            )
+            registrar_evento(cursor, "PUT", f"/estoque/{codigo}", {
+                "operacao": "saida",
+                "quantidade": baixa,
+                "quantidade_atual": quantidade,
+                "origem": "matriz"
+            })
+
+        intervalo = max(1.0, agora - cota['sincronizado_em'])
+        demanda = COTA_SUAVIZACAO * (vendido_total - cota['vendido_total']) / intervalo + (1 - COTA_SUAVIZACAO) * cota['demanda']
+        em_poder = cota['concedido_total'] - consumido_total - devolvido_total
+
+        cursor.execute(SQL_COTAS_DAS_OUTRAS, (agora - COTA_TTL_S, produto['id'], filial))
+        outras = cursor.fetchone()
+
+        # A cota alvo cobre a demanda do horizonte, limitada à fatia da filial na demanda de todas
+        alvo = 0
+        if demanda > 0.001:
+            fatia = math.floor(quantidade * COTA_FRACAO_MAX * demanda / (demanda + outras['demanda']))
+            alvo = min(math.ceil(demanda * COTA_HORIZONTE_S), fatia)
+
+        # Uma parte do estoque fica sempre com a matriz para os pedidos fora da cota
+        livre = quantidade - math.ceil(quantidade * (1 - COTA_FRACAO_MAX)) - outras['em_poder'] - em_poder
+        concedido_total = cota['concedido_total']
+        devolver = 0
+        if expirada:
+            # A filial parou de usar a cota, devolve tudo o que não vendeu e recebe uma cota nova na próxima sincronização
+            devolver = em_poder
+        elif alvo > em_poder:
+            concedido_total += max(0, min(alvo - em_poder, livre))
+        elif em_poder > alvo:
+            devolver = em_poder - alvo
+
+        cursor.execute(
+            "UPDATE cotas_escrow SET concedido_total = ?, consumido_total = ?, devolvido_total = ?, vendido_total = ?, "
+            "demanda = ?, sincronizado_em = ? WHERE filial = ? AND produto_id = ?",
+            (concedido_total, consumido_total, devolvido_total, vendido_total, demanda, agora, filial, produto['id'])
+        )
+        resultado.append({
+            "codigo_produto": codigo,
+            "concedido_total": concedido_total,
+            "devolver": devolver,
+            "demanda_por_s": round(demanda, 4)
+        })
+    return resultado
+
+def consultar_cotas(cursor, apos_produto: int = 0, apos_filial: str = "", limite: int = 500) -> Dict:
+    limite_ttl = time.time() - COTA_TTL_S
+    cursor.execute(SQL_LISTAR_COTAS, (apos_produto, apos_filial, limite + 1))
+    cotas = cursor.fetchall()
+
+    tem_mais = len(cotas) > limite
+    cotas = cotas[:limite]
+    return {
+        "itens": [
+            {
+                "filial": cota['filial'],
+                "codigo_produto": cota['codigo'],
+                "cota": cota['em_poder'],
+                "demanda_por_s": round(cota['demanda'], 4),
+                "estoque_total": cota['quantidade'],
+                "expirada": cota['sincronizado_em'] < limite_ttl
+            }
+            for cota in cotas
+        ],
+        "apos_produto": cotas[-1]['produto_id'] if cotas else apos_produto,
+        "apos_filial": cotas[-1]['filial'] if cotas else apos_filial,
+        "tem_mais": tem_mais
+    }
+
+def init_cotas_filial(db_name):
+    conn = get_db_connection(db_name)
+    cursor = conn.cursor()
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS cotas_locais (
+            produto_id INTEGER PRIMARY KEY,
+            concedido_total INTEGER NOT NULL DEFAULT 0,
+            consumido_total INTEGER NOT NULL DEFAULT 0,
+            devolvido_total INTEGER NOT NULL DEFAULT 0,
+            vendido_total INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY (produto_id) REFERENCES produtos (id)
+        )
+    ''')
+
+    conn.commit()
+    conn.close()
+
+def consumir_cota(cursor, itens: List[Dict]) -> bool:
+    quantidades = {}
+    for item in itens:
+        quantidades[item['produto_id']] = quantidades.get(item['produto_id'], 0) + item['quantidade']
+
+    cursor.execute(SQL_SALDO_LOCAL.format(",".join("?" for _ in quantidades)), list(quantidades))
+    saldos = {linha['produto_id']: linha['saldo'] for linha in cursor.fetchall()}
+    # Toda linha precisa de uma cota com saldo, sem linha de cota o pedido vai para a matriz
+    if any(
+        produto_id not in saldos or quantidade <= 0 or saldos[produto_id] < quantidade
+        for produto_id, quantidade in quantidades.items()
+    ):
+        return False
+
+    cursor.executemany(
+        "UPDATE cotas_locais SET consumido_total = consumido_total + ?, vendido_total = vendido_total + ? WHERE produto_id = ?",
+        [(quantidade, quantidade, produto_id) for produto_id, quantidade in quantidades.items()]
+    )
+    return True
+
+def registrar_venda(cursor, itens: List[Dict]):
+    cursor.executemany(
+        "INSERT INTO cotas_locais (produto_id, vendido_total) VALUES (?, ?) "
+        "ON CONFLICT(produto_id) DO UPDATE SET vendido_total = vendido_total + excluded.vendido_total",
+        [(item['produto_id'], item['quantidade']) for item in itens]
+    )
+
+class SincronizadorCotas:
+    def __init__(self, db_name: str, nome: str, matriz_url: Optional[str], intervalo: float = COTA_INTERVALO_S, timeout: float = 5.0):
+        self.db_name = db_name
+        self.nome = nome
+        self.matriz_url = matriz_url
+        self.intervalo = intervalo
+        self.timeout = timeout
+        self.session = requests.Session()
+        # Os contadores são absolutos, então reenviar depois de uma conexão keep-alive fechada pela matriz é seguro
+        self.session.mount("http://", HTTPAdapter(max_retries=Retry(total=1, connect=1, read=1, status=0, allowed_methods=None)))
+        self.session.mount("https://", HTTPAdapter(max_retries=Retry(total=1, connect=1, read=1, status=0, allowed_methods=None)))
+        self.acordar = threading.Event()
+        self.parar = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        self.sincronizado_em = 0.0
+
+    def cota_valida(self) -> bool:
+        # Sem sincronizar, a filial para de usar a cota bem antes de a matriz considerá-la expirada (COTA_TTL_S)
+        return time.monotonic() - self.sincronizado_em < COTA_TTL_S / 2
+
+    def executar(self):
+        conn = get_db_connection(self.db_name)
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                "SELECT p.codigo, c.consumido_total, c.devolvido_total, c.vendido_total FROM cotas_locais c JOIN produtos p ON p.id = c.produto_id"
+            )
+            itens = [dict(linha) for linha in cursor.fetchall()]
+            itens = [{"codigo_produto": item.pop('codigo'), **item} for item in itens]
+
+            enviado_em = time.monotonic()
+            token = create_access_token(data={"sub": "admin"}, expires_delta=timedelta(minutes=5))
+            response = circuitos.request(
+                'matriz',
+                "POST",
+                f"{self.matriz_url}/cotas/sincronizar",
+                session=self.session,
+                json={"filial": self.nome, "itens": itens},
+                headers={"Authorization": f"Bearer {token}"},
+                timeout=self.timeout
+            )
+            response.raise_for_status()
+
+            iniciar_escrita(conn)
+            for cota in response.json()['itens']:
+                cursor.execute("SELECT id FROM produtos WHERE codigo = ?", (cota['codigo_produto'],))
+                produto = cursor.fetchone()
+                if not produto:
+                    continue
+                cursor.execute("INSERT OR IGNORE INTO cotas_locais (produto_id) VALUES (?)", (produto['id'],))
+                cursor.execute(
+                    "UPDATE cotas_locais SET concedido_total = MAX(concedido_total, ?) WHERE produto_id = ?",
+                    (cota['concedido_total'], produto['id'])
+                )
+                if cota['devolver'] > 0:
+                    # Só devolve o que ainda não foi vendido, o resto a matriz pede de novo na próxima sincronização
+                    cursor.execute(
+                        "UPDATE cotas_locais SET devolvido_total = devolvido_total + "
+                        "MIN(?, MAX(0, concedido_total - consumido_total - devolvido_total)) WHERE produto_id = ?",
+                        (cota['devolver'], produto['id'])
+                    )
+            conn.commit()
+            # A validade conta do envio, o momento mais antigo em que a matriz pode ter gravado esta sincronização
+            self.sincronizado_em = enviado_em
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def _loop(self):
+        while not self.parar.is_set():
+            self.acordar.wait(self.intervalo)
+            self.acordar.clear()
+            if self.parar.is_set():
+                return
+            try:
+                self.executar()
+            except Exception as e:
+                print(f"ERRO: Falha ao sincronizar cotas com a matriz: {e}")
+
+    def notificar(self):
+        self.acordar.set()
+
+    def start(self):
+        if not self.matriz_url:
+            return
+        self.thread = threading.Thread(target=self._loop, name="cotas", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.parar.set()
+        self.acordar.set()
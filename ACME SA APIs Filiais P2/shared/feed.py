@@ -0,0 +1,140 @@
+import asyncio
+import json
+import threading
+import time
+from datetime import timedelta
+from typing import Dict, Optional
+
+from shared.database import get_db_connection, executar_no_banco, aplicar_catalogo, ler_controle, gravar_controle, buscar_alteracoes
+from shared.auth import create_access_token
+from shared.circuit_breaker import circuitos
+
+class FeedAlteracoes:
+    def __init__(self, db_name: str, lote: int = 500, intervalo_ping: float = 15.0):
+        self.db_name = db_name
+        self.lote = lote
+        self.intervalo_ping = intervalo_ping
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.evento: Optional[asyncio.Event] = None
+        self.assinantes: Dict[str, int] = {}
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.evento = asyncio.Event()
+
+    def notificar(self):
+        if self.loop:
+            self.loop.call_soon_threadsafe(self._acordar)
+
+    def _acordar(self):
+        # Troca o evento para que cada assinante acorde uma única vez por alteração
+        evento, self.evento = self.evento, asyncio.Event()
+        evento.set()
+
+    def assinante_ativo(self, name: str) -> bool:
+        return self.assinantes.get(name, 0) > 0
+
+    def _buscar_sync(self, since: int):
+        conn = get_db_connection(self.db_name)
+        try:
+            return buscar_alteracoes(conn.cursor(), since, self.lote)
+        finally:
+            conn.close()
+
+    async def eventos(self, since: int, name: Optional[str] = None):
+        if name:
+            self.assinantes[name] = self.assinantes.get(name, 0) + 1
+        try:
+            yield "retry: 1000\n\n"
+            while True:
+                evento = self.evento
+                alteracoes = await executar_no_banco(self._buscar_sync, since)
+
+                for alteracao in alteracoes:
+                    since = alteracao['seq']
+                    # A filial que originou a alteração já a aplicou, devolver só disputaria com a gravação local
+                    origem = alteracao.pop('origem', None)
+                    if name and origem and name.lower() in origem.lower():
+                        continue
+                    yield f"id: {since}\nevent: {alteracao['tipo']}\ndata: {json.dumps(alteracao)}\n\n"
+
+                if len(alteracoes) == self.lote:
+                    continue
+
+                try:
+                    await asyncio.wait_for(evento.wait(), timeout=self.intervalo_ping)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+        finally:
+            if name:
+                self.assinantes[name] -= 1
+
+class ConsumidorFeed:
+    def __init__(self, db_name: str, name: str, matriz_url: str, backoff_max: float = 30.0, timeout: float = 45.0):
+        self.db_name = db_name
+        self.name = name
+        self.matriz_url = matriz_url
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.parar = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._executar, name=f"feed-{self.name}", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.parar.set()
+
+    def _aplicar(self, conn, alteracao: dict):
+        cursor = conn.cursor()
+        aplicar_catalogo(cursor, [alteracao])
+        gravar_controle(cursor, 'seq_matriz', alteracao['seq'])
+        conn.commit()
+
+    def _consumir(self):
+        conn = get_db_connection(self.db_name)
+        try:
+            since = ler_controle(conn.cursor(), 'seq_matriz')
+            token = create_access_token(data={"sub": "admin"}, expires_delta=timedelta(minutes=5))
+            headers = {"Authorization": f"Bearer {token}", "Accept": "text/event-stream"}
+
+            with circuitos.request(
+                'matriz',
+                "GET",
+                f"{self.matriz_url}/feed",
+                params={"since": since, "filial": self.name},
+                headers=headers,
+                stream=True,
+                timeout=(3, self.timeout)
+            ) as response:
+                response.raise_for_status()
+                print(f"Feed de alterações da matriz conectado a partir da sequência {since}")
+
+                dados = []
+                for linha in response.iter_lines(decode_unicode=True):
+                    if self.parar.is_set():
+                        return
+                    if linha:
+                        if linha.startswith("data:"):
+                            dados.append(linha[5:].strip())
+                        continue
+                    if dados:
+                        self._aplicar(conn, json.loads("\n".join(dados)))
+                        dados = []
+        finally:
+            conn.close()
+
+    def _executar(self):
+        tentativas = 0
+        while not self.parar.is_set():
+            inicio = time.monotonic()
+            try:
+                self._consumir()
+            except Exception as e:
+                print(f"ERRO: Feed de alterações da matriz desconectado: {e}")
+
+            if time.monotonic() - inicio > self.backoff_max:
+                tentativas = 0
+            tentativas += 1
+            self.parar.wait(min(2 ** (tentativas - 1), self.backoff_max))
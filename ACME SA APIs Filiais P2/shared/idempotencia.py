@@ -0,0 +1,78 @@
+import json
+import os
+import threading
+import time
+from typing import Callable, Optional
+
+IDEMPOTENCIA_TTL_SEGUNDOS = int(os.getenv('IDEMPOTENCIA_TTL_SEGUNDOS', 24 * 60 * 60))
+IDEMPOTENCIA_MAX_CHAVES = int(os.getenv('IDEMPOTENCIA_MAX_CHAVES', 100000))
+IDEMPOTENCIA_LIMPEZA_S = float(os.getenv('IDEMPOTENCIA_LIMPEZA_S', 60))
+IDEMPOTENCIA_LIMPEZA_LOTE = int(os.getenv('IDEMPOTENCIA_LIMPEZA_LOTE', 10000))
+
+def init_idempotencia(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS idempotencia (
+            escopo TEXT NOT NULL,
+            chave TEXT NOT NULL,
+            resposta TEXT NOT NULL,
+            criado_em REAL NOT NULL,
+            PRIMARY KEY (escopo, chave)
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_idempotencia_criado_em ON idempotencia (criado_em)")
+
+SQL_BUSCAR_RESPOSTA = "SELECT resposta FROM idempotencia WHERE escopo = ? AND chave = ? AND criado_em > ?"
+SQL_EXPIRADAS = "DELETE FROM idempotencia WHERE rowid IN (SELECT rowid FROM idempotencia WHERE criado_em <= ? ORDER BY criado_em LIMIT ?)"
+SQL_MAIS_ANTIGAS = "DELETE FROM idempotencia WHERE rowid IN (SELECT rowid FROM idempotencia ORDER BY criado_em LIMIT ?)"
+
+def buscar_resposta(cursor, escopo: str, chave: Optional[str]) -> Optional[dict]:
+    if not chave:
+        return None
+
+    cursor.execute(SQL_BUSCAR_RESPOSTA, (escopo, chave, time.time() - IDEMPOTENCIA_TTL_SEGUNDOS))
+    linha = cursor.fetchone()
+    return json.loads(linha['resposta']) if linha else None
+
+def salvar_resposta(cursor, escopo: str, chave: Optional[str], resposta: dict):
+    if not chave:
+        return
+
+    # Só a gravação fica na transação da requisição, a limpeza roda em segundo plano (LimpezaIdempotencia)
+    cursor.execute(
+        "INSERT OR REPLACE INTO idempotencia (escopo, chave, resposta, criado_em) VALUES (?, ?, ?, ?)",
+        (escopo, chave, json.dumps(resposta), time.time())
+    )
+
+def limpar_respostas(cursor, lote: int = IDEMPOTENCIA_LIMPEZA_LOTE) -> int:
+    cursor.execute(SQL_EXPIRADAS, (time.time() - IDEMPOTENCIA_TTL_SEGUNDOS, lote))
+    removidas = cursor.rowcount
+
+    # Acima do limite sai o excesso, das chaves mais antigas, sem percorrer as que ficam
+    cursor.execute("SELECT COUNT(*) FROM idempotencia")
+    excesso = cursor.fetchone()[0] - IDEMPOTENCIA_MAX_CHAVES
+    if excesso > 0:
+        cursor.execute(SQL_MAIS_ANTIGAS, (min(excesso, lote),))
+        removidas += cursor.rowcount
+    return removidas
+
+class LimpezaIdempotencia:
+    # A limpeza é passada por quem liga a thread, na matriz ela vira um comando do escritor
+    def __init__(self, limpar: Callable[[], int], intervalo: float = IDEMPOTENCIA_LIMPEZA_S):
+        self.limpar = limpar
+        self.intervalo = intervalo
+        self.parar = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def _loop(self):
+        while not self.parar.wait(self.intervalo):
+            try:
+                self.limpar()
+            except Exception as e:
+                print(f"ERRO: Falha ao limpar chaves de idempotência: {e}")
+
+    def start(self):
+        self.thread = threading.Thread(target=self._loop, name="limpeza-idempotencia", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.parar.set()
@@ -0,0 +1,144 @@
+import hashlib
+from typing import Dict, List
+
+# Árvore fixa: raiz (nível 0) -> 16 -> 256 -> 4096 folhas (nível 3)
+ARIDADE = 16
+NIVEIS = 3
+NUM_FOLHAS = ARIDADE ** NIVEIS
+
+def hash_linha(codigo, nome, preco, quantidade) -> int:
+    if codigo is None or quantidade is None:
+        return 0
+    texto = f"{codigo}\x1f{nome}\x1f{float(preco)!r}\x1f{int(quantidade)}"
+    return int.from_bytes(hashlib.blake2b(texto.encode(), digest_size=8).digest(), "big", signed=True)
+
+def folha_codigo(codigo) -> int:
+    digest = hashlib.blake2b(str(codigo).encode(), digest_size=4).digest()
+    return int.from_bytes(digest, "big") % NUM_FOLHAS
+
+def xor(a, b) -> int:
+    return (a or 0) ^ (b or 0)
+
+def registrar_funcoes(conn):
+    conn.create_function("merkle_hash", 4, hash_linha, deterministic=True)
+    conn.create_function("merkle_folha", 1, folha_codigo, deterministic=True)
+    conn.create_function("merkle_xor", 2, xor, deterministic=True)
+
+def init_merkle(cursor, adicionar_coluna):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS merkle_folhas (
+            folha INTEGER PRIMARY KEY,
+            digest INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+
+    nova_coluna = adicionar_coluna(cursor, 'produtos', 'folha', 'INTEGER')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_produtos_folha ON produtos (folha)")
+
+    # Os triggers mantêm o digest de cada folha atualizado em qualquer escrita, com XOR do hash antigo e do novo
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS merkle_produtos_insert AFTER INSERT ON produtos
+        BEGIN
+            UPDATE produtos SET folha = merkle_folha(NEW.codigo) WHERE id = NEW.id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS merkle_produtos_update AFTER UPDATE OF nome, preco ON produtos
+        WHEN OLD.nome IS NOT NEW.nome OR OLD.preco IS NOT NEW.preco
+        BEGIN
+            UPDATE merkle_folhas SET digest = merkle_xor(digest, (
+                SELECT merkle_xor(
+                    merkle_hash(OLD.codigo, OLD.nome, OLD.preco, e.quantidade),
+                    merkle_hash(NEW.codigo, NEW.nome, NEW.preco, e.quantidade)
+                ) FROM estoque e WHERE e.produto_id = NEW.id
+            ))
+            WHERE folha = merkle_folha(NEW.codigo);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS merkle_estoque_insert AFTER INSERT ON estoque
+        BEGIN
+            UPDATE merkle_folhas SET digest = merkle_xor(digest, (
+                SELECT merkle_hash(p.codigo, p.nome, p.preco, NEW.quantidade) FROM produtos p WHERE p.id = NEW.produto_id
+            ))
+            WHERE folha = (SELECT merkle_folha(p.codigo) FROM produtos p WHERE p.id = NEW.produto_id);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS merkle_estoque_update AFTER UPDATE OF quantidade ON estoque
+        WHEN OLD.quantidade IS NOT NEW.quantidade
+        BEGIN
+            UPDATE merkle_folhas SET digest = merkle_xor(digest, (
+                SELECT merkle_xor(
+                    merkle_hash(p.codigo, p.nome, p.preco, OLD.quantidade),
+                    merkle_hash(p.codigo, p.nome, p.preco, NEW.quantidade)
+                ) FROM produtos p WHERE p.id = NEW.produto_id
+            ))
+            WHERE folha = (SELECT merkle_folha(p.codigo) FROM produtos p WHERE p.id = NEW.produto_id);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS merkle_estoque_delete AFTER DELETE ON estoque
+        BEGIN
+            UPDATE merkle_folhas SET digest = merkle_xor(digest, (
+                SELECT merkle_hash(p.codigo, p.nome, p.preco, OLD.quantidade) FROM produtos p WHERE p.id = OLD.produto_id
+            ))
+            WHERE folha = (SELECT merkle_folha(p.codigo) FROM produtos p WHERE p.id = OLD.produto_id);
+        END
+    ''')
+
+    if nova_coluna:
+        reconstruir(cursor)
+
+def conferir_merkle(cursor):
+    # Roda a cada início: uma tabela de folhas incompleta é refeita a partir dos produtos
+    cursor.execute("SELECT COUNT(*) AS count FROM merkle_folhas")
+    if cursor.fetchone()['count'] != NUM_FOLHAS:
+        reconstruir(cursor)
+
+def reconstruir(cursor):
+    cursor.execute("UPDATE produtos SET folha = merkle_folha(codigo)")
+    digests = [0] * NUM_FOLHAS
+    cursor.execute(
+        "SELECT p.folha, merkle_hash(p.codigo, p.nome, p.preco, e.quantidade) AS hash FROM produtos p JOIN estoque e ON p.id = e.produto_id"
+    )
+    for linha in cursor.fetchall():
+        digests[linha['folha']] ^= linha['hash']
+
+    cursor.execute("DELETE FROM merkle_folhas")
+    cursor.executemany(
+        "INSERT INTO merkle_folhas (folha, digest) VALUES (?, ?)",
+        list(enumerate(digests))
+    )
+
+def filhos(cursor, nivel: int, nos: List[int]) -> Dict[int, List[int]]:
+    cursor.execute("SELECT folha, digest FROM merkle_folhas ORDER BY folha")
+    folhas = [linha['digest'] for linha in cursor.fetchall()]
+
+    # Cada filho no nível seguinte cobre um intervalo contínuo de folhas, o digest é o XOR delas
+    tamanho = ARIDADE ** (NIVEIS - nivel - 1)
+    resultado = {}
+    for no in nos:
+        digests = []
+        for filho in range(no * ARIDADE, (no + 1) * ARIDADE):
+            digest = 0
+            for folha in folhas[filho * tamanho:(filho + 1) * tamanho]:
+                digest ^= folha
+            digests.append(digest)
+        resultado[no] = digests
+    return resultado
+
+# Em constante para o benchmarks/planos.py verificar o plano
+SQL_LINHAS_FOLHAS = "SELECT p.codigo, p.nome, p.preco, e.quantidade FROM produtos p JOIN estoque e ON p.id = e.produto_id WHERE p.folha IN ({})"
+
+def linhas_folhas(cursor, folhas: List[int]) -> List[Dict]:
+    cursor.execute(SQL_LINHAS_FOLHAS.format(",".join("?" for _ in folhas)), tuple(folhas))
+    return [
+        {
+            "codigo": linha['codigo'],
+            "nome": linha['nome'],
+            "preco": linha['preco'],
+            "quantidade": linha['quantidade']
+        }
+        for linha in cursor.fetchall()
+    ]
@@ -0,0 +1,270 @@
+import asyncio
+import json
+import time
+from datetime import timedelta
+from typing import Callable, Dict, Optional, Tuple
+
+from shared.database import get_db_connection
+from shared.auth import create_access_token
+from shared.escritor import IniciarCursorReplica, AvancarCursorReplica, LimparOutbox
+
+SQL_CURSOR_REPLICA = "SELECT * FROM replicacao_cursores WHERE replica = ?"
+SQL_EVENTOS_PENDENTES = "SELECT id, metodo, caminho, payload, origem FROM replicacao_outbox WHERE id > ? ORDER BY id LIMIT ?"
+SQL_LIMPAR_OUTBOX = "DELETE FROM replicacao_outbox WHERE id <= (SELECT MIN(ultimo_id) FROM replicacao_cursores WHERE replica IN ({}))"
+
+def init_outbox(db_name):
+    conn = get_db_connection(db_name)
+    cursor = conn.cursor()
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS replicacao_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            metodo TEXT NOT NULL,
+            caminho TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            origem TEXT,
+            criado_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS replicacao_cursores (
+            replica TEXT PRIMARY KEY,
+            ultimo_id INTEGER NOT NULL DEFAULT 0,
+            tentativas INTEGER NOT NULL DEFAULT 0,
+            proxima_tentativa REAL NOT NULL DEFAULT 0,
+            ultimo_erro TEXT,
+            atualizado_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    conn.commit()
+    conn.close()
+
+def registrar_evento(cursor, metodo: str, caminho: str, payload: dict, origem: Optional[str] = None) -> int:
+    cursor.execute(
+        "INSERT INTO replicacao_outbox (metodo, caminho, payload, origem) VALUES (?, ?, ?, ?)",
+        (metodo, caminho, json.dumps(payload), origem)
+    )
+    return cursor.lastrowid
+
+def iniciar_cursor_replica(cursor, replica: str) -> Dict:
+    # Uma filial nova já faz a sincronização completa ao ligar, então começa do fim da fila
+    cursor.execute(
+        "INSERT OR IGNORE INTO replicacao_cursores (replica, ultimo_id) SELECT ?, COALESCE(MAX(id), 0) FROM replicacao_outbox",
+        (replica,)
+    )
+    cursor.execute(SQL_CURSOR_REPLICA, (replica,))
+    return dict(cursor.fetchone())
+
+def avancar_cursor_replica(cursor, replica: str, ultimo_id: int, tentativas: int = 0, proxima_tentativa: float = 0,
+                           erro: Optional[str] = None):
+    cursor.execute(
+        "UPDATE replicacao_cursores SET ultimo_id = ?, tentativas = ?, proxima_tentativa = ?, ultimo_erro = ?, atualizado_em = CURRENT_TIMESTAMP WHERE replica = ?",
+        (ultimo_id, tentativas, proxima_tentativa, erro, replica)
+    )
+
+def limpar_outbox(cursor, replicas: Tuple[str, ...]) -> int:
+    cursor.execute(SQL_LIMPAR_OUTBOX.format(",".join("?" for _ in replicas)), replicas)
+    return cursor.rowcount
+
+def _originado_em(name: str, origem: Optional[str]) -> bool:
+    # A filial que originou a alteração não a recebe de volta, no envio um a um e no lote de estoque
+    return bool(origem) and name.lower() in origem.lower()
+
+class OutboxWorker:
+    def __init__(self, db_name: str, replicas: Dict[str, str], dispatcher, gravar: Callable, lote: int = 500,
+                 backoff_base: float = 0.5, backoff_max: float = 60.0, intervalo: float = 1.0, feed=None,
+                 janela: float = 0.05):
+        self.db_name = db_name
+        # O worker só lê o banco, o avanço dos cursores e a limpeza vão como comandos para o escritor da matriz
+        self.gravar = gravar
+        self.replicas = replicas
+        self.dispatcher = dispatcher
+        self.feed = feed
+        self.lote = lote
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.intervalo = intervalo
+        self.janela = janela
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.evento: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+        self.em_execucao = set()
+        # Tempo de cada drenagem por filial, o equivalente ao tempo de conclusão da replicação
+        self.drenagens: Dict[str, Dict] = {}
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.evento = asyncio.Event()
+        self.task = self.loop.create_task(self._executar())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    def notificar(self):
+        if self.loop and self.evento:
+            self.loop.call_soon_threadsafe(self.evento.set)
+
+    def _headers(self) -> dict:
+        token = create_access_token(data={"sub": "admin"}, expires_delta=timedelta(minutes=5))
+        return {"Authorization": f"Bearer {token}"}
+
+    def _cursor_replica(self, cursor, name: str):
+        cursor.execute(SQL_CURSOR_REPLICA, (name,))
+        estado = cursor.fetchone()
+        if estado:
+            return estado
+        return self.gravar(IniciarCursorReplica(name))
+
+    def _erro_temporario(self, name: str, resultado: Dict) -> Optional[str]:
+        if resultado['ok']:
+            return None
+        status_code = resultado['status_code']
+        # 4xx (exceto auth/timeout/limite) é recusa definitiva da filial, não adianta reenviar
+        if status_code is None or status_code >= 500 or status_code in (401, 408, 429):
+            return resultado.get('erro') or f"HTTP {status_code}"
+        print(f"ERRO: Filial {name} recusou evento da outbox (HTTP {status_code})")
+        return None
+
+    def _enviar_estoque_lote(self, name: str, url: str, estoque: Dict[str, int], headers: dict) -> Optional[str]:
+        itens = [
+            {"codigo_produto": codigo, "quantidade_atual": quantidade}
+            for codigo, quantidade in estoque.items()
+        ]
+        resultado = self.dispatcher.enviar(
+            name, url, "PUT", "/estoque/lote", None, headers,
+            json_body={"itens": itens, "origem": "matriz"}
+        )
+        return self._erro_temporario(name, resultado)
+
+    def _drenar_replica_sync(self, name: str, url: str):
+        conn = get_db_connection(self.db_name)
+        cursor = conn.cursor()
+
+        try:
+            estado = self._cursor_replica(cursor, name)
+
+            if estado['proxima_tentativa'] > time.time():
+                return False
+
+            cursor.execute(SQL_EVENTOS_PENDENTES, (estado['ultimo_id'], self.lote))
+            eventos = cursor.fetchall()
+            if not eventos:
+                return False
+
+            inicio = time.perf_counter()
+            headers = self._headers()
+            ultimo_id = estado['ultimo_id']
+            erro = None
+            # Filial conectada no feed de alterações já recebe tudo por lá
+            assinante = self.feed is not None and self.feed.assinante_ativo(name)
+            # Quantidade final por produto, os eventos de estoque do lote viram uma única requisição
+            estoque_pendente: Dict[str, int] = {}
+            ultimo_pendente = ultimo_id
+
+            for evento in eventos:
+                if assinante:
+                    ultimo_id = evento['id']
+                    continue
+
+                payload = json.loads(evento['payload'])
+                da_replica = _originado_em(name, evento['origem'])
+                if evento['caminho'].startswith('/estoque/') and 'quantidade_atual' in payload:
+                    codigo = evento['caminho'][len('/estoque/'):]
+                    if da_replica:
+                        # A filial já tem o valor que ela mesma gravou, e ele substitui o que estava pendente
+                        estoque_pendente.pop(codigo, None)
+                    else:
+                        estoque_pendente[codigo] = payload['quantidade_atual']
+                    ultimo_pendente = evento['id']
+                    continue
+
+                if estoque_pendente:
+                    erro = self._enviar_estoque_lote(name, url, estoque_pendente, headers)
+                    if erro:
+                        break
+                    ultimo_id = ultimo_pendente
+                    estoque_pendente = {}
+
+                if not da_replica:
+                    resultado = self.dispatcher.enviar(name, url, evento['metodo'], evento['caminho'], payload, headers)
+                    erro = self._erro_temporario(name, resultado)
+                    if erro:
+                        break
+                ultimo_id = evento['id']
+            else:
+                if estoque_pendente:
+                    erro = self._enviar_estoque_lote(name, url, estoque_pendente, headers)
+                if not erro:
+                    ultimo_id = max(ultimo_id, ultimo_pendente)
+
+            if erro:
+                tentativas = estado['tentativas'] + 1
+                espera = min(self.backoff_base * (2 ** (tentativas - 1)), self.backoff_max)
+                self.gravar(AvancarCursorReplica(name, ultimo_id, tentativas, time.time() + espera, erro))
+                print(f"ERRO: Falha ao replicar para {name}, nova tentativa em {espera:.1f}s: {erro}")
+            else:
+                self.gravar(AvancarCursorReplica(name, ultimo_id))
+
+            self._registrar_drenagem(name, sum(1 for evento in eventos if evento['id'] <= ultimo_id), ultimo_id, inicio, erro, assinante)
+            return ultimo_id != estado['ultimo_id']
+        finally:
+            conn.close()
+
+    def _registrar_drenagem(self, name: str, eventos: int, ultimo_id: int, inicio: float, erro: Optional[str], assinante: bool):
+        duracao = round((time.perf_counter() - inicio) * 1000, 2)
+        anterior = self.drenagens.get(name, {})
+        self.drenagens[name] = {
+            "ultima_duracao_ms": duracao,
+            "ultimos_eventos": eventos,
+            "ultimo_id": ultimo_id,
+            "ok": erro is None,
+            "pelo_feed": assinante,
+            "drenagens": anterior.get("drenagens", 0) + 1,
+            "max_duracao_ms": max(anterior.get("max_duracao_ms", 0), duracao)
+        }
+
+    def _limpar_sync(self):
+        # Só as réplicas ativas seguram a limpeza, uma filial que saiu do registro não acumula eventos para sempre
+        self.gravar(LimparOutbox(tuple(self.replicas.keys())))
+
+    async def _drenar_replica(self, name: str, url: str):
+        processou = False
+        try:
+            processou = await self.loop.run_in_executor(self.dispatcher.executor, self._drenar_replica_sync, name, url)
+        except Exception as e:
+            print(f"ERRO: Falha ao processar outbox para {name}: {e}")
+        finally:
+            self.em_execucao.discard(name)
+        if processou:
+            # Eventos podem ter chegado durante o envio, drena de novo sem esperar o intervalo
+            self.evento.set()
+
+    async def _executar(self):
+        while True:
+            self.evento.clear()
+
+            # Cada filial é drenada de forma independente, uma filial lenta não atrasa as outras
+            for name, url in list(self.replicas.items()):
+                if name not in self.em_execucao:
+                    self.em_execucao.add(name)
+                    self.loop.create_task(self._drenar_replica(name, url))
+
+            if self.replicas:
+                try:
+                    await self.loop.run_in_executor(self.dispatcher.executor, self._limpar_sync)
+                except Exception as e:
+                    print(f"ERRO: Falha ao limpar outbox: {e}")
+
+            try:
+                await asyncio.wait_for(self.evento.wait(), timeout=self.intervalo)
+                # Espera a janela para juntar as alterações que chegarem logo em seguida
+                await asyncio.sleep(self.janela)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,492 @@
+import base64
+import csv
+import io
+import json
+import os
+import zlib
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import HTTPException
+
+# As listas IN recebem os marcadores em {}, e as consultas com filtros opcionais saem das funções consulta_*,
+# as mesmas que o benchmarks/planos.py verifica
+SQL_ID_PRODUTO = "SELECT id FROM produtos WHERE codigo = ?"
+SQL_BAIXAR_ESTOQUE = "UPDATE estoque SET quantidade = quantidade - ?, atualizado_em = CURRENT_TIMESTAMP WHERE produto_id = ?"
+SQL_DIA_DO_PEDIDO = "SELECT date(criado_em) AS dia FROM pedidos WHERE id = ?"
+SQL_PRODUTOS_POR_CODIGO = (
+    "SELECT p.id, p.codigo, p.nome, p.preco, e.quantidade FROM produtos p JOIN estoque e ON p.id = e.produto_id "
+    "WHERE p.codigo IN ({})"
+)
+SQL_ITENS_DOS_PEDIDOS = (
+    "SELECT pi.pedido_id, pi.quantidade, pi.preco_unitario, pi.subtotal, p.id as produto_id, p.codigo, p.nome "
+    "FROM pedidos_itens pi JOIN produtos p ON pi.produto_id = p.id WHERE pi.pedido_id IN ({}) "
+    "ORDER BY pi.pedido_id, pi.id"
+)
+
+def marcadores(quantidade: int) -> str:
+    return ",".join("?" for _ in range(quantidade))
+
+def init_pedidos(cursor):
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'vendas_diarias'")
+    novas = cursor.fetchone() is None
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS vendas_diarias (
+            dia TEXT PRIMARY KEY,
+            pedidos INTEGER NOT NULL DEFAULT 0,
+            itens INTEGER NOT NULL DEFAULT 0,
+            receita REAL NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS vendas_diarias_produto (
+            dia TEXT NOT NULL,
+            produto_id INTEGER NOT NULL,
+            pedidos INTEGER NOT NULL DEFAULT 0,
+            quantidade INTEGER NOT NULL DEFAULT 0,
+            receita REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (dia, produto_id),
+            FOREIGN KEY (produto_id) REFERENCES produtos(id)
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_vendas_diarias_produto_produto ON vendas_diarias_produto (produto_id, dia)")
+
+    if novas:
+        # Bancos que já tinham pedidos calculam os totais uma única vez, depois eles são mantidos a cada pedido
+        cursor.execute('''
+            INSERT INTO vendas_diarias (dia, pedidos, itens, receita)
+            SELECT date(p.criado_em), COUNT(*), COALESCE(SUM((SELECT SUM(pi.quantidade) FROM pedidos_itens pi WHERE pi.pedido_id = p.id)), 0), SUM(p.total)
+            FROM pedidos p GROUP BY date(p.criado_em)
+        ''')
+        cursor.execute('''
+            INSERT INTO vendas_diarias_produto (dia, produto_id, pedidos, quantidade, receita)
+            SELECT date(p.criado_em), pi.produto_id, COUNT(DISTINCT p.id), SUM(pi.quantidade), SUM(pi.subtotal)
+            FROM pedidos p JOIN pedidos_itens pi ON pi.pedido_id = p.id GROUP BY date(p.criado_em), pi.produto_id
+        ''')
+
+PEDIDOS_LOTE_MAX = int(os.getenv('PEDIDOS_LOTE_MAX', 20000))
+PEDIDOS_LOTE_BLOCO = int(os.getenv('PEDIDOS_LOTE_BLOCO', 500))
+
+def acumular_vendas(cursor, pedido_id: int, total: float, itens: List[Dict]):
+    cursor.execute(SQL_DIA_DO_PEDIDO, (pedido_id,))
+    dia = cursor.fetchone()['dia']
+    acumular_vendas_dia(cursor, dia, [{"total": total, "itens": itens}])
+
+def acumular_vendas_dia(cursor, dia: str, pedidos: List[Dict]):
+    cursor.execute(
+        "INSERT INTO vendas_diarias (dia, pedidos, itens, receita) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(dia) DO UPDATE SET pedidos = pedidos + excluded.pedidos, itens = itens + excluded.itens, "
+        "receita = receita + excluded.receita",
+        (
+            dia,
+            len(pedidos),
+            sum(item['quantidade'] for pedido in pedidos for item in pedido['itens']),
+            sum(pedido['total'] for pedido in pedidos)
+        )
+    )
+
+    por_produto = {}
+    for pedido in pedidos:
+        vistos = set()
+        for item in pedido['itens']:
+            contagem, quantidade, receita = por_produto.get(item['produto_id'], (0, 0, 0))
+            por_produto[item['produto_id']] = (
+                contagem + (item['produto_id'] not in vistos),
+                quantidade + item['quantidade'],
+                receita + item['subtotal']
+            )
+            vistos.add(item['produto_id'])
+    cursor.executemany(
+        "INSERT INTO vendas_diarias_produto (dia, produto_id, pedidos, quantidade, receita) VALUES (?, ?, ?, ?, ?) "
+        "ON CONFLICT(dia, produto_id) DO UPDATE SET pedidos = pedidos + excluded.pedidos, quantidade = quantidade + excluded.quantidade, "
+        "receita = receita + excluded.receita",
+        [(dia, produto_id, contagem, quantidade, receita) for produto_id, (contagem, quantidade, receita) in por_produto.items()]
+    )
+
+def ler_lote(corpo: bytes) -> List[Dict]:
+    pedidos = []
+    chaves = set()
+    for numero, linha in enumerate(corpo.splitlines(), start=1):
+        if not linha.strip():
+            continue
+        if len(pedidos) >= PEDIDOS_LOTE_MAX:
+            raise HTTPException(status_code=413, detail=f"Lote limitado a {PEDIDOS_LOTE_MAX} pedidos")
+
+        pedido = {"linha": numero}
+        pedidos.append(pedido)
+        try:
+            dados = json.loads(linha)
+        except ValueError:
+            pedido.update(status_code=400, erro="JSON inválido")
+            continue
+        if not isinstance(dados, dict):
+            pedido.update(status_code=400, erro="Cada linha deve ser um objeto JSON")
+            continue
+
+        pedido['referencia'] = dados.get('referencia')
+        pedido['chave'] = dados.get('idempotency_key')
+        itens = dados.get('itens')
+        if not isinstance(itens, list) or not itens:
+            pedido.update(status_code=400, erro="Pedido deve conter ao menos um item")
+        elif any(
+            not isinstance(item, dict) or not item.get('codigo_produto')
+            or not isinstance(item.get('quantidade'), int) or item['quantidade'] <= 0
+            for item in itens
+        ):
+            pedido.update(status_code=400, erro="Item do pedido inválido, informe 'codigo_produto' e 'quantidade' positiva")
+        elif pedido['chave'] and pedido['chave'] in chaves:
+            pedido.update(status_code=409, erro="idempotency_key repetida no mesmo lote")
+        else:
+            pedido['itens'] = itens
+            if pedido['chave']:
+                chaves.add(pedido['chave'])
+    return pedidos
+
+def validar_itens(repositorio, itens: List[Dict]) -> Tuple[float, List[Dict]]:
+    # Regra do POST /pedido, usada com qualquer motor do repositório
+    total_pedido = 0
+    itens_validados = []
+
+    for item in itens:
+        if not isinstance(item, dict):
+            raise HTTPException(status_code=400, detail="Item do pedido inválido")
+
+        codigo_produto = item.get('codigo_produto')
+        quantidade = item.get('quantidade', 0)
+
+        if not codigo_produto:
+            raise HTTPException(status_code=400, detail="Item do pedido não contém 'codigo_produto'")
+
+        if not isinstance(quantidade, int) or isinstance(quantidade, bool) or quantidade <= 0:
+            raise HTTPException(status_code=400, detail=f"Quantidade inválida para {codigo_produto}, informe um inteiro positivo")
+
+        produto = repositorio.buscar_produto(codigo_produto)
+
+        if not produto:
+            raise HTTPException(status_code=404, detail=f"Produto com código {codigo_produto} não encontrado")
+
+        if produto['quantidade'] < quantidade:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Estoque insuficiente para {produto['nome']}. Disponível: {produto['quantidade']}"
+            )
+
+        subtotal = quantidade * produto['preco']
+        total_pedido += subtotal
+
+        itens_validados.append({
+            'produto_id': produto['id'],
+            'produto_codigo': produto['codigo'],
+            'produto_nome': produto['nome'],
+            'quantidade': quantidade,
+            'preco_unitario': produto['preco'],
+            'subtotal': subtotal
+        })
+
+    return total_pedido, itens_validados
+
+def validar_lote(cursor, pedidos: List[Dict]):
+    codigos = list({item['codigo_produto'] for pedido in pedidos if 'erro' not in pedido for item in pedido['itens']})
+    produtos = {}
+    for inicio in range(0, len(codigos), 500):
+        parte = codigos[inicio:inicio + 500]
+        cursor.execute(SQL_PRODUTOS_POR_CODIGO.format(marcadores(len(parte))), parte)
+        produtos.update({produto['codigo']: produto for produto in cursor.fetchall()})
+
+    # O estoque local é descontado pedido a pedido, na ordem do lote, então os últimos são os que ficam sem estoque
+    disponivel = {codigo: produto['quantidade'] for codigo, produto in produtos.items()}
+    for pedido in pedidos:
+        if 'erro' in pedido:
+            continue
+
+        faltando = sorted({item['codigo_produto'] for item in pedido['itens'] if item['codigo_produto'] not in produtos})
+        if faltando:
+            pedido.update(status_code=404, erro=f"Produtos não encontrados: {', '.join(faltando)}")
+            continue
+
+        quantidades = {}
+        for item in pedido['itens']:
+            quantidades[item['codigo_produto']] = quantidades.get(item['codigo_produto'], 0) + item['quantidade']
+        insuficientes = [
+            f"{produtos[codigo]['nome']} (disponível: {disponivel[codigo]})"
+            for codigo, quantidade in quantidades.items() if disponivel[codigo] < quantidade
+        ]
+        if insuficientes:
+            pedido.update(status_code=400, erro=f"Estoque insuficiente para: {', '.join(insuficientes)}")
+            continue
+
+        for codigo, quantidade in quantidades.items():
+            disponivel[codigo] -= quantidade
+        pedido['quantidades'] = quantidades
+        pedido['itens'] = [
+            {
+                'produto_id': produtos[item['codigo_produto']]['id'],
+                'produto_codigo': item['codigo_produto'],
+                'produto_nome': produtos[item['codigo_produto']]['nome'],
+                'quantidade': item['quantidade'],
+                'preco_unitario': produtos[item['codigo_produto']]['preco'],
+                'subtotal': item['quantidade'] * produtos[item['codigo_produto']]['preco']
+            }
+            for item in pedido['itens']
+        ]
+        pedido['total'] = sum(item['subtotal'] for item in pedido['itens'])
+
+def gravar_pedidos_lote(cursor, pedidos: List[Dict]):
+    cursor.execute("SELECT datetime('now') AS agora, date('now') AS dia")
+    momento = cursor.fetchone()
+
+    # Dentro da transação exclusiva ninguém mais insere pedidos, então os ids podem ser definidos aqui e gravados de uma vez
+    cursor.execute(
+        "SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'pedidos'), 0), "
+        "COALESCE((SELECT MAX(id) FROM pedidos), 0)) AS ultimo"
+    )
+    ultimo = cursor.fetchone()['ultimo']
+    for deslocamento, pedido in enumerate(pedidos, start=1):
+        pedido['pedido_id'] = ultimo + deslocamento
+
+    cursor.executemany(
+        "INSERT INTO pedidos (id, total, criado_em) VALUES (?, ?, ?)",
+        [(pedido['pedido_id'], pedido['total'], momento['agora']) for pedido in pedidos]
+    )
+    cursor.executemany(
+        "INSERT INTO pedidos_itens (pedido_id, produto_id, quantidade, preco_unitario, subtotal) VALUES (?, ?, ?, ?, ?)",
+        [
+            (pedido['pedido_id'], item['produto_id'], item['quantidade'], item['preco_unitario'], item['subtotal'])
+            for pedido in pedidos for item in pedido['itens']
+        ]
+    )
+
+    baixas = {}
+    for pedido in pedidos:
+        for item in pedido['itens']:
+            baixas[item['produto_id']] = baixas.get(item['produto_id'], 0) + item['quantidade']
+    cursor.executemany(SQL_BAIXAR_ESTOQUE, [(quantidade, produto_id) for produto_id, quantidade in baixas.items()])
+
+    acumular_vendas_dia(cursor, momento['dia'], pedidos)
+
+def normalizar_dia(valor: Optional[str], campo: str) -> Optional[str]:
+    if not valor:
+        return None
+    try:
+        return datetime.fromisoformat(valor).date().isoformat()
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Data inválida em {campo}, use o formato AAAA-MM-DD")
+
+def _periodo(condicoes: List[str], parametros: List, data_inicio: Optional[str], data_fim: Optional[str], coluna: str = "dia"):
+    if data_inicio:
+        condicoes.append(f"{coluna} >= ?")
+        parametros.append(data_inicio)
+    if data_fim:
+        condicoes.append(f"{coluna} <= ?")
+        parametros.append(data_fim)
+
+def _where(condicoes: List[str]) -> str:
+    return f"WHERE {' AND '.join(condicoes)}" if condicoes else ""
+
+def consulta_vendas(data_inicio: Optional[str], data_fim: Optional[str]) -> Tuple[str, List]:
+    condicoes, parametros = [], []
+    _periodo(condicoes, parametros, data_inicio, data_fim)
+    return f"SELECT dia, pedidos, itens, receita FROM vendas_diarias {_where(condicoes)} ORDER BY dia", parametros
+
+def consultar_vendas(cursor, data_inicio: Optional[str], data_fim: Optional[str]) -> Dict:
+    cursor.execute(*consulta_vendas(data_inicio, data_fim))
+    dias = [dict(linha) for linha in cursor.fetchall()]
+
+    return {
+        "dias": dias,
+        "total": {
+            "pedidos": sum(dia['pedidos'] for dia in dias),
+            "itens": sum(dia['itens'] for dia in dias),
+            "receita": round(sum(dia['receita'] for dia in dias), 2)
+        }
+    }
+
+def consulta_vendas_produtos(produto_id: Optional[int], data_inicio: Optional[str], data_fim: Optional[str]) -> Tuple[str, List]:
+    condicoes, parametros = [], []
+    if produto_id is not None:
+        condicoes.append("v.produto_id = ?")
+        parametros.append(produto_id)
+    _periodo(condicoes, parametros, data_inicio, data_fim, "v.dia")
+    return (
+        f"SELECT v.dia, p.codigo, p.nome, v.pedidos, v.quantidade, v.receita FROM vendas_diarias_produto v "
+        f"JOIN produtos p ON p.id = v.produto_id {_where(condicoes)} ORDER BY v.dia, p.codigo",
+        parametros
+    )
+
+def consultar_vendas_produtos(cursor, codigo_produto: Optional[str], data_inicio: Optional[str], data_fim: Optional[str]) -> List[Dict]:
+    produto_id = None
+    if codigo_produto:
+        cursor.execute(SQL_ID_PRODUTO, (codigo_produto,))
+        produto = cursor.fetchone()
+        if not produto:
+            raise HTTPException(status_code=404, detail="Produto não encontrado")
+        produto_id = produto['id']
+
+    cursor.execute(*consulta_vendas_produtos(produto_id, data_inicio, data_fim))
+    return [
+        {
+            "dia": linha['dia'],
+            "produto_codigo": linha['codigo'],
+            "produto_nome": linha['nome'],
+            "pedidos": linha['pedidos'],
+            "quantidade": linha['quantidade'],
+            "receita": linha['receita']
+        }
+        for linha in cursor.fetchall()
+    ]
+
+def normalizar_data(valor: Optional[str], campo: str) -> Optional[str]:
+    if not valor:
+        return None
+    try:
+        return datetime.fromisoformat(valor).strftime('%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Data inválida em {campo}, use o formato AAAA-MM-DD ou AAAA-MM-DDTHH:MM:SS")
+
+def normalizar_fim(valor: Optional[str], campo: str) -> Optional[str]:
+    # data_fim é inclusiva, como nos relatórios: vira o limite exclusivo logo depois dela (o dia seguinte para
+    # uma data sem hora, o segundo seguinte para data e hora, que é a precisão de criado_em)
+    if not valor:
+        return None
+    try:
+        return (date.fromisoformat(valor) + timedelta(days=1)).strftime('%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        pass
+    try:
+        return (datetime.fromisoformat(valor) + timedelta(seconds=1)).strftime('%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Data inválida em {campo}, use o formato AAAA-MM-DD ou AAAA-MM-DDTHH:MM:SS")
+
+def codificar_cursor(criado_em: str, pedido_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{criado_em}|{pedido_id}".encode()).decode()
+
+def decodificar_cursor(valor: str) -> Tuple[str, int]:
+    try:
+        criado_em, pedido_id = base64.urlsafe_b64decode(valor.encode()).decode().rsplit("|", 1)
+        return criado_em, int(pedido_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Cursor de paginação inválido")
+
+def itens_dos_pedidos(cursor, pedido_ids: List[int]) -> Dict[int, List[Dict]]:
+    itens = {pedido_id: [] for pedido_id in pedido_ids}
+    if not pedido_ids:
+        return itens
+
+    cursor.execute(SQL_ITENS_DOS_PEDIDOS.format(marcadores(len(pedido_ids))), pedido_ids)
+    for item in cursor.fetchall():
+        itens[item['pedido_id']].append({
+            "produto_id": item['produto_id'],
+            "produto_codigo": item['codigo'],
+            "produto_nome": item['nome'],
+            "quantidade": item['quantidade'],
+            "preco_unitario": item['preco_unitario'],
+            "subtotal": item['subtotal']
+        })
+    return itens
+
+def _periodo_pedidos(condicoes: List[str], parametros: List, data_inicio: Optional[str], data_fim: Optional[str]):
+    if data_inicio:
+        condicoes.append("criado_em >= ?")
+        parametros.append(data_inicio)
+    if data_fim:
+        condicoes.append("criado_em < ?")
+        parametros.append(data_fim)
+
+def consulta_pedidos(limite: int, posicao: Optional[Tuple[str, int]], data_inicio: Optional[str], data_fim: Optional[str]) -> Tuple[str, List]:
+    # Paginação por chave (criado_em, id): cada página é uma busca no índice, não importa quantos pedidos já passaram
+    condicoes, parametros = [], []
+    if posicao:
+        condicoes.append("(criado_em, id) < (?, ?)")
+        parametros += list(posicao)
+    _periodo_pedidos(condicoes, parametros, data_inicio, data_fim)
+    return (
+        f"SELECT id, total, criado_em FROM pedidos {_where(condicoes)} ORDER BY criado_em DESC, id DESC LIMIT ?",
+        parametros + [limite]
+    )
+
+def consulta_exportacao(desde_id: int, ate_id: int, data_inicio: Optional[str], data_fim: Optional[str], lote: int) -> Tuple[str, List]:
+    condicoes, parametros = ["id > ?", "id <= ?"], [desde_id, ate_id]
+    _periodo_pedidos(condicoes, parametros, data_inicio, data_fim)
+    return f"SELECT id, total, criado_em FROM pedidos {_where(condicoes)} ORDER BY id LIMIT ?", parametros + [lote]
+
+def buscar_pedidos(cursor, limite: int, posicao: Optional[str] = None,
+                   data_inicio: Optional[str] = None, data_fim: Optional[str] = None) -> Dict:
+    cursor.execute(*consulta_pedidos(limite + 1, decodificar_cursor(posicao) if posicao else None, data_inicio, data_fim))
+    pedidos = cursor.fetchall()
+
+    tem_mais = len(pedidos) > limite
+    pedidos = pedidos[:limite]
+    itens = itens_dos_pedidos(cursor, [pedido['id'] for pedido in pedidos])
+
+    return {
+        "pedidos": [
+            {
+                "id": pedido['id'],
+                "total": pedido['total'],
+                "criado_em": pedido['criado_em'],
+                "itens": itens[pedido['id']]
+            }
+            for pedido in pedidos
+        ],
+        "proximo_cursor": codificar_cursor(pedidos[-1]['criado_em'], pedidos[-1]['id']) if tem_mais else None,
+        "tem_mais": tem_mais
+    }
+
+COLUNAS_CSV = [
+    "pedido_id", "criado_em", "total", "produto_id", "produto_codigo",
+    "produto_nome", "quantidade", "preco_unitario", "subtotal"
+]
+
+def ultimo_pedido(cursor) -> int:
+    cursor.execute("SELECT COALESCE(MAX(id), 0) AS id FROM pedidos")
+    return cursor.fetchone()['id']
+
+def exportar_pedidos(conn, formato: str, compactar: bool, desde_id: int, ate_id: int,
+                     data_inicio: Optional[str] = None, data_fim: Optional[str] = None, lote: int = 1000):
+    cursor = conn.cursor()
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compactar else None
+
+    def codificar(texto: str) -> bytes:
+        dados = texto.encode()
+        return compressor.compress(dados) if compressor else dados
+
+    try:
+        if formato == "csv":
+            yield codificar(",".join(COLUNAS_CSV) + "\r\n")
+
+        # Cada lote é uma consulta curta pelo id, nenhuma transação fica aberta segurando as escritas da filial
+        while True:
+            cursor.execute(*consulta_exportacao(desde_id, ate_id, data_inicio, data_fim, lote))
+            pedidos = cursor.fetchall()
+            if not pedidos:
+                break
+            desde_id = pedidos[-1]['id']
+            itens = itens_dos_pedidos(cursor, [pedido['id'] for pedido in pedidos])
+
+            buffer = io.StringIO()
+            if formato == "csv":
+                escritor = csv.writer(buffer)
+                for pedido in pedidos:
+                    for item in itens[pedido['id']]:
+                        escritor.writerow([
+                            pedido['id'], pedido['criado_em'], pedido['total'], item['produto_id'], item['produto_codigo'],
+                            item['produto_nome'], item['quantidade'], item['preco_unitario'], item['subtotal']
+                        ])
+            else:
+                for pedido in pedidos:
+                    buffer.write(json.dumps({
+                        "id": pedido['id'],
+                        "total": pedido['total'],
+                        "criado_em": pedido['criado_em'],
+                        "itens": itens[pedido['id']]
+                    }) + "\n")
+
+            dados = codificar(buffer.getvalue())
+            if dados:
+                yield dados
+
+        if compressor:
+            yield compressor.flush()
+    finally:
+        conn.close()
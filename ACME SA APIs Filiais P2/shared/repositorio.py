@@ -0,0 +1,319 @@
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import ContextManager, Dict, Iterator, List, Optional, Protocol
+
+from shared.database import get_db_connection, iniciar_escrita, SQL_ESTOQUE_POR_CODIGO
+from shared.pedidos import SQL_BAIXAR_ESTOQUE, SQL_ID_PRODUTO
+from shared import idempotencia
+
+# Acesso a usuários, produtos, estoque, pedidos e respostas idempotentes. Cadastro, consulta e gravação de
+# estoque passam por aqui; pedidos usam criar_pedido e buscar_pedido, mas a gravação de um pedido na filial
+# divide a transação com cota, vendas_diarias e reservas_pendentes, que continuam em SQL nos seus módulos.
+
+# As consultas ficam em constantes para o benchmarks/planos.py verificar os planos delas
+SQL_USUARIO = "SELECT * FROM usuarios WHERE login = ?"
+SQL_PRODUTO = "SELECT p.id, p.codigo, p.nome, p.preco, e.quantidade, e.atualizado_em FROM produtos p JOIN estoque e ON p.id = e.produto_id WHERE p.codigo = ?"
+SQL_PEDIDO = "SELECT id, total, criado_em FROM pedidos WHERE id = ?"
+SQL_ITENS_PEDIDO = (
+    "SELECT pi.quantidade, pi.preco_unitario, pi.subtotal, p.id as produto_id, p.codigo, p.nome "
+    "FROM pedidos_itens pi JOIN produtos p ON pi.produto_id = p.id WHERE pi.pedido_id = ?"
+)
+
+class Repositorio(Protocol):
+    def buscar_usuario(self, login: str) -> Optional[Dict]: ...
+    def criar_usuario(self, login: str, password: str) -> bool: ...
+    def listar_produtos(self) -> List[Dict]: ...
+    def buscar_produto(self, codigo: str) -> Optional[Dict]: ...
+    def existe_produto(self, codigo: str) -> bool: ...
+    def criar_produto(self, codigo: str, nome: str, preco: float, quantidade: int, seq: int = 0, origem: Optional[str] = None) -> int: ...
+    def definir_estoque(self, produto_id: int, quantidade: int, seq: Optional[int] = None, origem: Optional[str] = None): ...
+    def definir_estoques(self, quantidades: Dict[str, int]): ...
+    def criar_pedido(self, total: float, itens: List[Dict]) -> int: ...
+    def buscar_pedido(self, pedido_id: int) -> Optional[Dict]: ...
+    def buscar_resposta(self, escopo: str, chave: Optional[str]) -> Optional[dict]: ...
+    def salvar_resposta(self, escopo: str, chave: Optional[str], resposta: dict): ...
+
+class Armazenamento(Protocol):
+    # leitura() entrega um repositório só para consultas, escrita() um repositório dentro de uma transação e
+    # na_transacao(cursor) um repositório dentro da transação já aberta por quem tem o cursor
+    def leitura(self) -> ContextManager[Repositorio]: ...
+    def escrita(self) -> ContextManager[Repositorio]: ...
+    def na_transacao(self, cursor) -> ContextManager[Repositorio]: ...
+
+class RepositorioSQLite:
+    # Trabalha sobre um cursor, então entra na transação de quem o criou (um endpoint ou o escritor da matriz)
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def buscar_usuario(self, login: str) -> Optional[Dict]:
+        self.cursor.execute(SQL_USUARIO, (login,))
+        usuario = self.cursor.fetchone()
+        return dict(usuario) if usuario else None
+
+    def criar_usuario(self, login: str, password: str) -> bool:
+        if self.buscar_usuario(login):
+            return False
+        self.cursor.execute("INSERT INTO usuarios (login, password) VALUES (?, ?)", (login, password))
+        return True
+
+    def listar_produtos(self) -> List[Dict]:
+        self.cursor.execute("SELECT id, codigo, nome, preco, criado_em FROM produtos")
+        return [dict(produto) for produto in self.cursor.fetchall()]
+
+    def buscar_produto(self, codigo: str) -> Optional[Dict]:
+        self.cursor.execute(SQL_PRODUTO, (codigo,))
+        produto = self.cursor.fetchone()
+        return dict(produto) if produto else None
+
+    def existe_produto(self, codigo: str) -> bool:
+        self.cursor.execute(SQL_ID_PRODUTO, (codigo,))
+        return self.cursor.fetchone() is not None
+
+    def criar_produto(self, codigo: str, nome: str, preco: float, quantidade: int, seq: int = 0, origem: Optional[str] = None) -> int:
+        # Se o produto já chegou pela replicação, atualiza o cadastro e mantém o estoque que veio da matriz
+        self.cursor.execute(
+            "INSERT INTO produtos (codigo, nome, preco, seq) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(codigo) DO UPDATE SET nome = excluded.nome, preco = excluded.preco",
+            (codigo, nome, preco, seq)
+        )
+        self.cursor.execute(SQL_ID_PRODUTO, (codigo,))
+        produto_id = self.cursor.fetchone()['id']
+        self.cursor.execute(
+            "INSERT INTO estoque (produto_id, quantidade, seq, origem) VALUES (?, ?, ?, ?) ON CONFLICT(produto_id) DO NOTHING",
+            (produto_id, quantidade, seq, origem)
+        )
+        return produto_id
+
+    def definir_estoque(self, produto_id: int, quantidade: int, seq: Optional[int] = None, origem: Optional[str] = None):
+        if seq is None:
+            self.cursor.execute(
+                "UPDATE estoque SET quantidade = ?, atualizado_em = CURRENT_TIMESTAMP WHERE produto_id = ?",
+                (quantidade, produto_id)
+            )
+        else:
+            self.cursor.execute(
+                "UPDATE estoque SET quantidade = ?, seq = ?, origem = ?, atualizado_em = CURRENT_TIMESTAMP WHERE produto_id = ?",
+                (quantidade, seq, origem, produto_id)
+            )
+
+    def definir_estoques(self, quantidades: Dict[str, int]):
+        self.cursor.executemany(
+            SQL_ESTOQUE_POR_CODIGO,
+            [(quantidade, codigo) for codigo, quantidade in quantidades.items()]
+        )
+
+    def criar_pedido(self, total: float, itens: List[Dict]) -> int:
+        self.cursor.execute("INSERT INTO pedidos (total) VALUES (?)", (total,))
+        pedido_id = self.cursor.lastrowid
+        for item in itens:
+            self.cursor.execute(
+                "INSERT INTO pedidos_itens (pedido_id, produto_id, quantidade, preco_unitario, subtotal) VALUES (?, ?, ?, ?, ?)",
+                (pedido_id, item['produto_id'], item['quantidade'], item['preco_unitario'], item['subtotal'])
+            )
+            self.cursor.execute(SQL_BAIXAR_ESTOQUE, (item['quantidade'], item['produto_id']))
+        return pedido_id
+
+    def buscar_pedido(self, pedido_id: int) -> Optional[Dict]:
+        self.cursor.execute(SQL_PEDIDO, (pedido_id,))
+        pedido = self.cursor.fetchone()
+        if not pedido:
+            return None
+        self.cursor.execute(SQL_ITENS_PEDIDO, (pedido_id,))
+        return {
+            "id": pedido['id'],
+            "total": pedido['total'],
+            "criado_em": pedido['criado_em'],
+            "itens": [
+                {
+                    "produto_id": item['produto_id'],
+                    "produto_codigo": item['codigo'],
+                    "produto_nome": item['nome'],
+                    "quantidade": item['quantidade'],
+                    "preco_unitario": item['preco_unitario'],
+                    "subtotal": item['subtotal']
+                }
+                for item in self.cursor.fetchall()
+            ]
+        }
+
+    def buscar_resposta(self, escopo: str, chave: Optional[str]) -> Optional[dict]:
+        return idempotencia.buscar_resposta(self.cursor, escopo, chave)
+
+    def salvar_resposta(self, escopo: str, chave: Optional[str], resposta: dict):
+        idempotencia.salvar_resposta(self.cursor, escopo, chave, resposta)
+
+def _agora() -> str:
+    # Mesmo formato do CURRENT_TIMESTAMP do SQLite
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+class RepositorioMemoria:
+    # Tabelas em listas indexadas pelo id (id - 1) e dicionários como índices únicos, sem disco nem SQL
+    def __init__(self):
+        self.usuarios: Dict[str, Dict] = {}
+        self.produtos: List[Dict] = []
+        self.por_codigo: Dict[str, int] = {}
+        self.estoque: List[Dict] = []
+        self.pedidos: List[Dict] = []
+        self.itens_por_pedido: List[List[Dict]] = []
+        self.respostas: Dict[tuple, tuple] = {}
+
+    def buscar_usuario(self, login: str) -> Optional[Dict]:
+        usuario = self.usuarios.get(login)
+        return dict(usuario) if usuario else None
+
+    def criar_usuario(self, login: str, password: str) -> bool:
+        if login in self.usuarios:
+            return False
+        self.usuarios[login] = {"id": len(self.usuarios) + 1, "login": login, "password": password, "criado_em": _agora()}
+        return True
+
+    def listar_produtos(self) -> List[Dict]:
+        return [dict(produto) for produto in self.produtos]
+
+    def buscar_produto(self, codigo: str) -> Optional[Dict]:
+        produto_id = self.por_codigo.get(codigo)
+        if produto_id is None:
+            return None
+        produto = self.produtos[produto_id - 1]
+        estoque = self.estoque[produto_id - 1]
+        return {
+            "id": produto_id,
+            "codigo": produto['codigo'],
+            "nome": produto['nome'],
+            "preco": produto['preco'],
+            "quantidade": estoque['quantidade'],
+            "atualizado_em": estoque['atualizado_em']
+        }
+
+    def existe_produto(self, codigo: str) -> bool:
+        return codigo in self.por_codigo
+
+    def criar_produto(self, codigo: str, nome: str, preco: float, quantidade: int, seq: int = 0, origem: Optional[str] = None) -> int:
+        produto_id = self.por_codigo.get(codigo)
+        if produto_id is not None:
+            self.produtos[produto_id - 1].update(nome=nome, preco=preco)
+            return produto_id
+        produto_id = len(self.produtos) + 1
+        agora = _agora()
+        self.produtos.append({"id": produto_id, "codigo": codigo, "nome": nome, "preco": preco, "criado_em": agora})
+        self.estoque.append({"quantidade": quantidade, "seq": seq, "origem": origem, "atualizado_em": agora})
+        self.por_codigo[codigo] = produto_id
+        return produto_id
+
+    def definir_estoque(self, produto_id: int, quantidade: int, seq: Optional[int] = None, origem: Optional[str] = None):
+        estoque = self.estoque[produto_id - 1]
+        estoque['quantidade'] = quantidade
+        estoque['atualizado_em'] = _agora()
+        if seq is not None:
+            estoque['seq'] = seq
+            estoque['origem'] = origem
+
+    def definir_estoques(self, quantidades: Dict[str, int]):
+        for codigo, quantidade in quantidades.items():
+            if codigo in self.por_codigo:
+                self.definir_estoque(self.por_codigo[codigo], quantidade)
+
+    def criar_pedido(self, total: float, itens: List[Dict]) -> int:
+        pedido_id = len(self.pedidos) + 1
+        agora = _agora()
+        self.pedidos.append({"id": pedido_id, "total": total, "criado_em": agora})
+        self.itens_por_pedido.append([
+            {
+                "produto_id": item['produto_id'],
+                "quantidade": item['quantidade'],
+                "preco_unitario": item['preco_unitario'],
+                "subtotal": item['subtotal']
+            }
+            for item in itens
+        ])
+        for item in itens:
+            estoque = self.estoque[item['produto_id'] - 1]
+            estoque['quantidade'] -= item['quantidade']
+            estoque['atualizado_em'] = agora
+        return pedido_id
+
+    def buscar_pedido(self, pedido_id: int) -> Optional[Dict]:
+        if not 1 <= pedido_id <= len(self.pedidos):
+            return None
+        pedido = self.pedidos[pedido_id - 1]
+        return {
+            "id": pedido['id'],
+            "total": pedido['total'],
+            "criado_em": pedido['criado_em'],
+            "itens": [
+                {
+                    "produto_id": item['produto_id'],
+                    "produto_codigo": self.produtos[item['produto_id'] - 1]['codigo'],
+                    "produto_nome": self.produtos[item['produto_id'] - 1]['nome'],
+                    "quantidade": item['quantidade'],
+                    "preco_unitario": item['preco_unitario'],
+                    "subtotal": item['subtotal']
+                }
+                for item in self.itens_por_pedido[pedido_id - 1]
+            ]
+        }
+
+    def buscar_resposta(self, escopo: str, chave: Optional[str]) -> Optional[dict]:
+        if not chave or (escopo, chave) not in self.respostas:
+            return None
+        resposta, criado_em = self.respostas[(escopo, chave)]
+        if criado_em <= time.time() - idempotencia.IDEMPOTENCIA_TTL_SEGUNDOS:
+            return None
+        return dict(resposta)
+
+    def salvar_resposta(self, escopo: str, chave: Optional[str], resposta: dict):
+        if chave:
+            self.respostas[(escopo, chave)] = (dict(resposta), time.time())
+
+class ArmazenamentoSQLite:
+    def __init__(self, db_name: str):
+        self.db_name = db_name
+
+    @contextmanager
+    def leitura(self) -> Iterator[RepositorioSQLite]:
+        conn = get_db_connection(self.db_name)
+        try:
+            yield RepositorioSQLite(conn.cursor())
+        finally:
+            conn.close()
+
+    @contextmanager
+    def escrita(self) -> Iterator[RepositorioSQLite]:
+        conn = get_db_connection(self.db_name)
+        try:
+            iniciar_escrita(conn)
+            yield RepositorioSQLite(conn.cursor())
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    @contextmanager
+    def na_transacao(self, cursor) -> Iterator[RepositorioSQLite]:
+        # O commit e o rollback ficam com o dono do cursor (o escritor da matriz ou a gravação do pedido)
+        yield RepositorioSQLite(cursor)
+
+class ArmazenamentoMemoria:
+    # Não há rollback: quem escreve valida tudo antes de alterar, como a regra de pedidos já faz
+    def __init__(self):
+        self.repositorio = RepositorioMemoria()
+        self.trava = threading.RLock()
+
+    @contextmanager
+    def leitura(self) -> Iterator[RepositorioMemoria]:
+        with self.trava:
+            yield self.repositorio
+
+    @contextmanager
+    def escrita(self) -> Iterator[RepositorioMemoria]:
+        with self.trava:
+            yield self.repositorio
+
+    @contextmanager
+    def na_transacao(self, cursor) -> Iterator[RepositorioMemoria]:
+        with self.trava:
+            yield self.repositorio
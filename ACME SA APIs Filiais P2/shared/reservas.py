@@ -0,0 +1,351 @@
+import json
+import os
+import threading
+import time
+import uuid
+from datetime import timedelta
+from typing import Callable, Dict, List, Optional
+
+import requests
+from fastapi import HTTPException
+
+from shared.database import get_db_connection, proxima_sequencia
+from shared.auth import create_access_token
+from shared.outbox import registrar_evento
+from shared.escrow import cotas_reservadas
+from shared.circuit_breaker import circuitos
+
+RESERVA_TTL_S = float(os.getenv('RESERVA_TTL_S', 60))
+
+PENDENTE = "pendente"
+CONFIRMADA = "confirmada"
+LIBERADA = "liberada"
+EXPIRADA = "expirada"
+
+def init_reservas(db_name):
+    conn = get_db_connection(db_name)
+    cursor = conn.cursor()
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS reservas (
+            id TEXT PRIMARY KEY,
+            origem TEXT,
+            itens TEXT NOT NULL,
+            estado TEXT NOT NULL,
+            expira_em REAL NOT NULL,
+            criado_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            atualizado_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_reservas_estado_expira ON reservas (estado, expira_em)")
+
+    conn.commit()
+    conn.close()
+
+def agrupar_itens(itens) -> Dict[str, int]:
+    if not isinstance(itens, list) or not itens:
+        raise HTTPException(status_code=400, detail="Reserva deve conter ao menos um item")
+
+    quantidades = {}
+    for item in itens:
+        codigo_produto = item.get('codigo_produto')
+        quantidade = int(item.get('quantidade', 0))
+        if not codigo_produto or quantidade <= 0:
+            raise HTTPException(status_code=400, detail="Item de reserva inválido")
+        quantidades[codigo_produto] = quantidades.get(codigo_produto, 0) + quantidade
+    return quantidades
+
+SQL_PRODUTOS_DA_RESERVA = "SELECT p.id, p.codigo, p.nome, e.quantidade FROM produtos p JOIN estoque e ON p.id = e.produto_id WHERE p.codigo IN ({})"
+SQL_RESERVA = "SELECT * FROM reservas WHERE id = ?"
+SQL_RESERVAS_VENCIDAS = "SELECT id FROM reservas WHERE estado = ? AND expira_em < ? ORDER BY expira_em LIMIT ?"
+SQL_RESERVAS_A_CONFIRMAR = "SELECT reserva_id, pedido_id FROM reservas_pendentes ORDER BY criado_em LIMIT 100"
+SQL_RESERVAS_RECUSADAS = "SELECT reserva_id, pedido_id, status_code, motivo, recusado_em FROM reservas_recusadas ORDER BY recusado_em DESC LIMIT ?"
+
+def _ajustar_itens(cursor, quantidades: Dict[str, int], sinal: int, origem) -> List[Dict]:
+    codigos = list(quantidades)
+    cursor.execute(SQL_PRODUTOS_DA_RESERVA.format(",".join("?" for _ in codigos)), codigos)
+    produtos = {produto['codigo']: produto for produto in cursor.fetchall()}
+
+    # Confere todas as linhas antes de alterar qualquer uma, o pedido inteiro passa ou nada é baixado
+    faltando = [codigo for codigo in codigos if codigo not in produtos]
+    if faltando:
+        raise HTTPException(status_code=404, detail=f"Produtos não encontrados: {', '.join(faltando)}")
+
+    if sinal < 0:
+        # As unidades separadas como cota das filiais não podem ser vendidas por outro caminho
+        reservadas = cotas_reservadas(cursor, [produto['id'] for produto in produtos.values()])
+        disponiveis = {
+            codigo: produto['quantidade'] - reservadas.get(produto['id'], 0)
+            for codigo, produto in produtos.items()
+        }
+        insuficientes = [
+            f"{produtos[codigo]['nome']} (disponível: {disponiveis[codigo]})"
+            for codigo in codigos
+            if disponiveis[codigo] < quantidades[codigo]
+        ]
+        if insuficientes:
+            raise HTTPException(status_code=400, detail=f"Estoque insuficiente para {', '.join(insuficientes)}")
+
+    resultado = []
+    for codigo in codigos:
+        produto = produtos[codigo]
+        nova_quantidade = produto['quantidade'] + sinal * quantidades[codigo]
+        cursor.execute(
+            "UPDATE estoque SET quantidade = ?, seq = ?, origem = ?, atualizado_em = CURRENT_TIMESTAMP WHERE produto_id = ?",
+            (nova_quantidade, proxima_sequencia(cursor), origem, produto['id'])
+        )
+        registrar_evento(cursor, "PUT", f"/estoque/{codigo}", {
+            "operacao": "saida" if sinal < 0 else "entrada",
+            "quantidade": quantidades[codigo],
+            "quantidade_atual": nova_quantidade,
+            "origem": "matriz"
+        }, origem)
+        resultado.append({
+            "produto_id": produto['id'],
+            "codigo_produto": codigo,
+            "quantidade_alterada": quantidades[codigo],
+            "quantidade_anterior": produto['quantidade'],
+            "quantidade_atual": nova_quantidade
+        })
+    return resultado
+
+def baixar_itens(cursor, quantidades: Dict[str, int], origem) -> List[Dict]:
+    return _ajustar_itens(cursor, quantidades, -1, origem)
+
+def devolver_itens(cursor, quantidades: Dict[str, int], origem) -> List[Dict]:
+    return _ajustar_itens(cursor, quantidades, 1, origem)
+
+def _buscar(cursor, reserva_id: str):
+    cursor.execute(SQL_RESERVA, (reserva_id,))
+    reserva = cursor.fetchone()
+    if not reserva:
+        raise HTTPException(status_code=404, detail="Reserva não encontrada")
+    return reserva
+
+def _atualizar_estado(cursor, reserva_id: str, estado: str):
+    cursor.execute(
+        "UPDATE reservas SET estado = ?, atualizado_em = CURRENT_TIMESTAMP WHERE id = ?",
+        (estado, reserva_id)
+    )
+
+def _resposta(reserva_id: str, estado: str, expira_em: float, quantidades: Dict[str, int]) -> Dict:
+    return {
+        "reserva_id": reserva_id,
+        "estado": estado,
+        "expira_em": expira_em,
+        "itens": [{"codigo_produto": codigo, "quantidade": quantidade} for codigo, quantidade in quantidades.items()]
+    }
+
+def criar_reserva(cursor, quantidades: Dict[str, int], origem, ttl: float = RESERVA_TTL_S) -> Dict:
+    # O estoque sai na hora, assim ninguém mais vende essas unidades enquanto a filial grava o pedido
+    baixar_itens(cursor, quantidades, origem)
+
+    reserva_id = uuid.uuid4().hex
+    expira_em = time.time() + ttl
+    cursor.execute(
+        "INSERT INTO reservas (id, origem, itens, estado, expira_em) VALUES (?, ?, ?, ?, ?)",
+        (reserva_id, origem, json.dumps(quantidades), PENDENTE, expira_em)
+    )
+    return _resposta(reserva_id, PENDENTE, expira_em, quantidades)
+
+def reserva_ativa(cursor, reserva_id: str) -> bool:
+    cursor.execute(SQL_RESERVA, (reserva_id,))
+    reserva = cursor.fetchone()
+    return bool(reserva) and reserva['estado'] in (PENDENTE, CONFIRMADA)
+
+def confirmar_reserva(cursor, reserva_id: str) -> Dict:
+    reserva = _buscar(cursor, reserva_id)
+    quantidades = json.loads(reserva['itens'])
+
+    if reserva['estado'] in (LIBERADA, EXPIRADA):
+        # A confirmação chegou depois do estoque ter voltado, baixa de novo se ainda houver
+        try:
+            baixar_itens(cursor, quantidades, reserva['origem'])
+        except HTTPException as e:
+            raise HTTPException(status_code=409, detail=f"Reserva {reserva['estado']} e não pôde ser refeita: {e.detail}")
+
+    if reserva['estado'] != CONFIRMADA:
+        _atualizar_estado(cursor, reserva_id, CONFIRMADA)
+    return _resposta(reserva_id, CONFIRMADA, reserva['expira_em'], quantidades)
+
+def liberar_reserva(cursor, reserva_id: str, estado: str = LIBERADA) -> Dict:
+    reserva = _buscar(cursor, reserva_id)
+    quantidades = json.loads(reserva['itens'])
+
+    if reserva['estado'] == CONFIRMADA:
+        raise HTTPException(status_code=409, detail="Reserva já confirmada")
+
+    if reserva['estado'] == PENDENTE:
+        devolver_itens(cursor, quantidades, reserva['origem'])
+        _atualizar_estado(cursor, reserva_id, estado)
+        return _resposta(reserva_id, estado, reserva['expira_em'], quantidades)
+    return _resposta(reserva_id, reserva['estado'], reserva['expira_em'], quantidades)
+
+def expirar_reservas(cursor, lote: int = 500) -> int:
+    cursor.execute(SQL_RESERVAS_VENCIDAS, (PENDENTE, time.time(), lote))
+    vencidas = [linha['id'] for linha in cursor.fetchall()]
+    for reserva_id in vencidas:
+        liberar_reserva(cursor, reserva_id, EXPIRADA)
+    return len(vencidas)
+
+class ExpiradorReservas:
+    # A expiração é passada por quem liga o expirador, na matriz ela vira um comando do escritor
+    def __init__(self, expirar: Callable[[], int], intervalo: float = 5.0):
+        self.expirar = expirar
+        self.intervalo = intervalo
+        self.parar = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def _loop(self):
+        while not self.parar.wait(self.intervalo):
+            try:
+                expiradas = self.expirar()
+                if expiradas:
+                    print(f"{expiradas} reservas expiradas e devolvidas ao estoque")
+            except Exception as e:
+                print(f"ERRO: Falha ao expirar reservas: {e}")
+
+    def start(self):
+        self.thread = threading.Thread(target=self._loop, name="expirador-reservas", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.parar.set()
+
+def init_confirmacoes(db_name):
+    conn = get_db_connection(db_name)
+    cursor = conn.cursor()
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS reservas_pendentes (
+            reserva_id TEXT PRIMARY KEY,
+            pedido_id INTEGER,
+            tentativas INTEGER NOT NULL DEFAULT 0,
+            ultimo_erro TEXT,
+            criado_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_reservas_pendentes_criado_em ON reservas_pendentes (criado_em)")
+
+    # Pedidos gravados na filial cuja reserva a matriz recusou confirmar, ficam aqui até alguém resolver
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS reservas_recusadas (
+            reserva_id TEXT PRIMARY KEY,
+            pedido_id INTEGER,
+            status_code INTEGER,
+            motivo TEXT,
+            recusado_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_reservas_recusadas_recusado_em ON reservas_recusadas (recusado_em)")
+
+    conn.commit()
+    conn.close()
+
+def listar_recusadas(cursor, limite: int = 100) -> List[Dict]:
+    cursor.execute(SQL_RESERVAS_RECUSADAS, (limite,))
+    return [dict(linha) for linha in cursor.fetchall()]
+
+class ConfirmadorReservas:
+    def __init__(self, db_name: str, matriz_url: Optional[str], intervalo: float = 2.0, timeout: float = 5.0):
+        self.db_name = db_name
+        self.matriz_url = matriz_url
+        self.intervalo = intervalo
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.acordar = threading.Event()
+        self.parar = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def _headers(self, chave: Optional[str] = None) -> Dict:
+        token = create_access_token(data={"sub": "admin"}, expires_delta=timedelta(minutes=5))
+        headers = {"Authorization": f"Bearer {token}"}
+        if chave:
+            headers["Idempotency-Key"] = chave
+        return headers
+
+    def reservar(self, itens: List[Dict], origem: str, chave: Optional[str] = None, ttl: float = RESERVA_TTL_S) -> Dict:
+        response = circuitos.request(
+            'matriz',
+            "POST",
+            f"{self.matriz_url}/reservas",
+            session=self.session,
+            json={"itens": itens, "origem": origem, "ttl_s": ttl},
+            headers=self._headers(chave),
+            timeout=self.timeout
+        )
+        response.raise_for_status()
+        return response.json()
+
+    def liberar(self, reserva_id: str):
+        try:
+            circuitos.request(
+                'matriz',
+                "POST",
+                f"{self.matriz_url}/reservas/{reserva_id}/liberar",
+                session=self.session,
+                headers=self._headers(),
+                timeout=self.timeout
+            ).raise_for_status()
+        except Exception as e:
+            # Sem a liberação a reserva expira sozinha na matriz
+            print(f"ERRO: Falha ao liberar reserva {reserva_id}: {e}")
+
+    def _confirmar_pendentes(self):
+        conn = get_db_connection(self.db_name)
+        cursor = conn.cursor()
+        try:
+            cursor.execute(SQL_RESERVAS_A_CONFIRMAR)
+            for linha in cursor.fetchall():
+                reserva_id = linha['reserva_id']
+                try:
+                    response = circuitos.request(
+                        'matriz',
+                        "POST",
+                        f"{self.matriz_url}/reservas/{reserva_id}/confirmar",
+                        session=self.session,
+                        headers=self._headers(),
+                        timeout=self.timeout
+                    )
+                    if response.status_code >= 500 or response.status_code in (401, 408, 429):
+                        response.raise_for_status()
+                    if response.status_code >= 400:
+                        # O pedido já está gravado na filial sem baixa na matriz, não pode sumir da fila em silêncio
+                        print(f"ERRO: Matriz recusou confirmar reserva {reserva_id} do pedido {linha['pedido_id']}: {response.text}")
+                        cursor.execute(
+                            "INSERT OR REPLACE INTO reservas_recusadas (reserva_id, pedido_id, status_code, motivo) VALUES (?, ?, ?, ?)",
+                            (reserva_id, linha['pedido_id'], response.status_code, response.text)
+                        )
+                    cursor.execute("DELETE FROM reservas_pendentes WHERE reserva_id = ?", (reserva_id,))
+                except requests.RequestException as e:
+                    cursor.execute(
+                        "UPDATE reservas_pendentes SET tentativas = tentativas + 1, ultimo_erro = ? WHERE reserva_id = ?",
+                        (str(e), reserva_id)
+                    )
+                    conn.commit()
+                    return
+                conn.commit()
+        finally:
+            conn.close()
+
+    def _loop(self):
+        while not self.parar.is_set():
+            self.acordar.wait(self.intervalo)
+            self.acordar.clear()
+            try:
+                self._confirmar_pendentes()
+            except Exception as e:
+                print(f"ERRO: Falha ao confirmar reservas na matriz: {e}")
+
+    def notificar(self):
+        self.acordar.set()
+
+    def start(self):
+        if not self.matriz_url:
+            return
+        self.thread = threading.Thread(target=self._loop, name="confirmador-reservas", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.parar.set()
+        self.acordar.set()
@@ -1,39 +1,225 @@
 import requests
-from datetime import datetime
-from typing import List, Dict
+from requests.adapters import HTTPAdapter
+from datetime import datetime, timedelta
+from typing import List, Dict, Optional
 import asyncio
 from concurrent.futures import ThreadPoolExecutor
+import threading
+import math
+from collections import deque
+import time
 import os
+import json
+
+from shared.circuit_breaker import circuitos
+from shared import merkle
+from shared.auth import create_access_token
+from shared.database import get_db_connection, iniciar_escrita, aplicar_catalogo, ler_controle, gravar_controle
 
 def load_replicas(exclude_api: str):
     replicas = {}
     base_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
     
-    all_apis = ['matriz', 'alipio', 'laranjeiras', 'alvorada']
-    all_apis.remove(exclude_api)
-    
-    for api_name in all_apis:
+    # Qualquer pasta vizinha com .env e API_PORT é uma réplica local
+    for api_name in sorted(os.listdir(base_path)):
         env_path = os.path.join(base_path, api_name, '.env')
-        if os.path.exists(env_path):
-            with open(env_path, 'r') as f:
-                for line in f:
-                    if line.startswith('API_PORT='):
-                        port = line.strip().split('=')[1]
-                        replicas[api_name] = f"http://localhost:{port}"
-                        break
+        if api_name == exclude_api or not os.path.exists(env_path):
+            continue
+        with open(env_path, 'r') as f:
+            for line in f:
+                if line.startswith('API_PORT='):
+                    port = line.strip().split('=')[1]
+                    replicas[api_name] = f"http://localhost:{port}"
+                    break
+    
+    matriz_url = os.getenv('MATRIZ_URL')
+    if matriz_url and exclude_api != 'matriz':
+        replicas['matriz'] = matriz_url.rstrip('/')
     return replicas
 
+class RegistroReplicas:
+    def __init__(self, estaticas: Optional[Dict[str, str]] = None, ttl: float = 30.0):
+        self.estaticas = dict(estaticas or {})
+        self.dinamicas: Dict[str, Dict] = {}
+        self.ttl = ttl
+        self.lock = threading.Lock()
+    
+    def registrar(self, nome: str, url: str, capacidades: Optional[List[str]] = None,
+                  versao: Optional[str] = None, heartbeat: Optional[float] = None) -> Dict:
+        membro = {
+            "nome": nome,
+            "url": url.rstrip('/'),
+            "capacidades": capacidades or [],
+            "versao": versao,
+            "ultimo_heartbeat": heartbeat or time.time()
+        }
+        with self.lock:
+            self.dinamicas[nome] = membro
+        return membro
+    
+    def substituir(self, membros: List[Dict], excluir: Optional[str] = None):
+        agora = time.time()
+        with self.lock:
+            self.dinamicas = {
+                membro['nome']: {
+                    "nome": membro['nome'],
+                    "url": membro['url'].rstrip('/'),
+                    "capacidades": membro.get('capacidades', []),
+                    "versao": membro.get('versao'),
+                    "ultimo_heartbeat": agora
+                }
+                for membro in membros
+                if membro['nome'] != excluir
+            }
+    
+    def remover(self, nome: str):
+        with self.lock:
+            self.dinamicas.pop(nome, None)
+    
+    def _vivo(self, membro: Dict, agora: float) -> bool:
+        return agora - membro['ultimo_heartbeat'] <= self.ttl
+    
+    def membros(self) -> Dict[str, str]:
+        agora = time.time()
+        with self.lock:
+            replicas = dict(self.estaticas)
+            for nome, membro in self.dinamicas.items():
+                if self._vivo(membro, agora):
+                    replicas[nome] = membro['url']
+        return replicas
+    
+    def detalhes(self) -> List[Dict]:
+        agora = time.time()
+        with self.lock:
+            dinamicas = {nome: dict(membro) for nome, membro in self.dinamicas.items() if self._vivo(membro, agora)}
+            estaticas = dict(self.estaticas)
+        
+        resultado = []
+        for nome, url in estaticas.items():
+            if nome not in dinamicas:
+                resultado.append({"nome": nome, "url": url, "capacidades": [], "versao": None, "origem": "estatica"})
+        for membro in dinamicas.values():
+            membro["idade_heartbeat_s"] = round(agora - membro.pop('ultimo_heartbeat'), 2)
+            membro["origem"] = "registro"
+            resultado.append(membro)
+        return resultado
+    
+    def items(self):
+        return self.membros().items()
+    
+    def keys(self):
+        return self.membros().keys()
+    
+    def values(self):
+        return self.membros().values()
+    
+    def get(self, nome: str, padrao=None):
+        return self.membros().get(nome, padrao)
+    
+    def __iter__(self):
+        return iter(self.membros())
+    
+    def __len__(self):
+        return len(self.membros())
+    
+    def __contains__(self, nome):
+        return nome in self.membros()
+
+def init_registro(db_name: str, registro: RegistroReplicas):
+    conn = get_db_connection(db_name)
+    cursor = conn.cursor()
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS replicas_registro (
+            nome TEXT PRIMARY KEY,
+            url TEXT NOT NULL,
+            capacidades TEXT NOT NULL DEFAULT '[]',
+            versao TEXT,
+            ultimo_heartbeat REAL NOT NULL,
+            registrado_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.commit()
+    
+    cursor.execute("SELECT nome, url, capacidades, versao, ultimo_heartbeat FROM replicas_registro")
+    for linha in cursor.fetchall():
+        registro.registrar(linha['nome'], linha['url'], json.loads(linha['capacidades']), linha['versao'], linha['ultimo_heartbeat'])
+    conn.close()
+
+def salvar_registro(cursor, membro: Dict):
+    cursor.execute(
+        "INSERT INTO replicas_registro (nome, url, capacidades, versao, ultimo_heartbeat) VALUES (?, ?, ?, ?, ?) "
+        "ON CONFLICT(nome) DO UPDATE SET url = excluded.url, capacidades = excluded.capacidades, versao = excluded.versao, ultimo_heartbeat = excluded.ultimo_heartbeat",
+        (membro['nome'], membro['url'], json.dumps(membro['capacidades']), membro['versao'], membro['ultimo_heartbeat'])
+    )
+
+class ClienteRegistro:
+    def __init__(self, nome: str, url: str, registro: RegistroReplicas, capacidades: List[str], versao: str, intervalo: float = 10.0):
+        self.nome = nome
+        self.url = url
+        self.registro = registro
+        self.capacidades = capacidades
+        self.versao = versao
+        self.intervalo = intervalo
+        self.session = requests.Session()
+        self.parar = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+    
+    def _heartbeat(self):
+        matriz_url = self.registro.get('matriz')
+        if not matriz_url:
+            return
+        
+        token = create_access_token(data={"sub": "admin"}, expires_delta=timedelta(minutes=5))
+        response = circuitos.request(
+            'matriz',
+            "POST",
+            f"{matriz_url}/replicas/registro",
+            session=self.session,
+            json={
+                "nome": self.nome,
+                "url": self.url,
+                "capacidades": self.capacidades,
+                "versao": self.versao
+            },
+            headers={"Authorization": f"Bearer {token}"},
+            timeout=5
+        )
+        response.raise_for_status()
+        self.registro.substituir(response.json()['replicas'], excluir=self.nome)
+    
+    def _loop(self):
+        while True:
+            try:
+                self._heartbeat()
+            except Exception as e:
+                print(f"ERRO: Falha ao registrar {self.nome} na matriz: {e}")
+            if self.parar.wait(self.intervalo):
+                return
+    
+    def start(self):
+        self.thread = threading.Thread(target=self._loop, name=f"registro-{self.nome}", daemon=True)
+        self.thread.start()
+    
+    def stop(self):
+        self.parar.set()
+
 class ReplicaManager:
-    def __init__(self, current_api_name: str, replicas: Dict[str, str]):
+    def __init__(self, current_api_name: str, replicas: Dict[str, str], intervalo: float = 5.0, amostras: int = 120):
         self.current_api_name = current_api_name
         self.replicas = replicas
         self.timeout = 5.0
-        self.executor = ThreadPoolExecutor(max_workers=10)
+        self.intervalo = intervalo
+        self.amostras = amostras
+        self.executor = ThreadPoolExecutor(max_workers=32)
+        self.estado: Dict[str, Dict] = {}
+        self.latencias: Dict[str, deque] = {}
+        self.task: Optional[asyncio.Task] = None
     
     def _check_replica_health_sync(self, name: str, url: str) -> Dict:
         try:
             start_time = datetime.now()
-            response = requests.get(f"{url}/status", timeout=self.timeout)
+            response = circuitos.request(name, "GET", f"{url}/status", timeout=self.timeout)
             latency = (datetime.now() - start_time).total_seconds() * 1000
             
             if response.status_code == 401:
@@ -59,8 +245,17 @@ class ReplicaManager:
                 "erro": str(e)
             }
     
-    async def check_all_replicas(self) -> List[Dict]:
-        loop = asyncio.get_event_loop()
+    def _registrar_amostra(self, resultado: Dict):
+        name = resultado['nome']
+        latencias = self.latencias.setdefault(name, deque(maxlen=self.amostras))
+        if resultado['latencia_ms'] is not None:
+            latencias.append(resultado['latencia_ms'])
+        
+        resultado["verificado_em"] = time.time()
+        self.estado[name] = resultado
+    
+    async def _verificar_replicas(self):
+        loop = asyncio.get_running_loop()
         tasks = [
             loop.run_in_executor(
                 self.executor,
@@ -68,7 +263,273 @@ class ReplicaManager:
                 name,
                 url
             )
-            for name, url in self.replicas.items()
+            for name, url in list(self.replicas.items())
         ]
-        results = await asyncio.gather(*tasks)
+        for resultado in await asyncio.gather(*tasks):
+            self._registrar_amostra(resultado)
+    
+    async def _heartbeat(self):
+        while True:
+            try:
+                await self._verificar_replicas()
+            except Exception as e:
+                print(f"ERRO: Falha no heartbeat das réplicas: {e}")
+            await asyncio.sleep(self.intervalo)
+    
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self._heartbeat())
+    
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+    
+    def _percentil(self, valores: List[float], percentil: float) -> Optional[float]:
+        if not valores:
+            return None
+        ordenados = sorted(valores)
+        indice = max(0, math.ceil(percentil / 100 * len(ordenados)) - 1)
+        return round(ordenados[indice], 2)
+    
+    async def check_all_replicas(self) -> List[Dict]:
+        agora = time.time()
+        results = []
+        for name, url in self.replicas.items():
+            estado = self.estado.get(name)
+            if estado is None:
+                results.append({
+                    "nome": name,
+                    "url": url,
+                    "status": "desconhecido",
+                    "latencia_ms": None,
+                    "idade_amostra_s": None
+                })
+                continue
+            
+            latencias = list(self.latencias.get(name, []))
+            result = {key: value for key, value in estado.items() if key != "verificado_em"}
+            result.update({
+                "latencia_p50_ms": self._percentil(latencias, 50),
+                "latencia_p99_ms": self._percentil(latencias, 99),
+                "idade_amostra_s": round(agora - estado['verificado_em'], 2)
+            })
+            results.append(result)
         return results
+
+class ReplicationDispatcher:
+    def __init__(self, replicas: Dict[str, str], max_por_replica: int = 4, timeout: float = 5.0, connect_timeout: float = 1.5,
+                 max_threads: int = 64):
+        self.replicas = replicas
+        self.max_por_replica = max_por_replica
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.sessions: Dict[str, requests.Session] = {}
+        self.limites: Dict[str, threading.BoundedSemaphore] = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_threads)
+    
+    def _sessao(self, name: str):
+        with self.lock:
+            if name not in self.sessions:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_por_replica)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self.sessions[name] = session
+                self.limites[name] = threading.BoundedSemaphore(self.max_por_replica)
+            return self.sessions[name], self.limites[name]
+    
+    def enviar(self, name: str, url: str, method: str, path: str, data: dict, headers: dict, json_body: dict = None) -> Dict:
+        session, limite = self._sessao(name)
+        with limite:
+            start_time = time.perf_counter()
+            try:
+                response = circuitos.request(
+                    name,
+                    method,
+                    f"{url}{path}",
+                    session=session,
+                    data=data,
+                    json=json_body,
+                    headers=headers,
+                    timeout=(self.connect_timeout, self.timeout)
+                )
+                latency = (time.perf_counter() - start_time) * 1000
+                return {
+                    "nome": name,
+                    "status_code": response.status_code,
+                    "ok": response.ok,
+                    "latencia_ms": round(latency, 2)
+                }
+            except Exception as e:
+                latency = (time.perf_counter() - start_time) * 1000
+                return {
+                    "nome": name,
+                    "status_code": None,
+                    "ok": False,
+                    "latencia_ms": round(latency, 2),
+                    "erro": str(e)
+                }
+
+def sincronizar_alteracoes(db_name: str, matriz_url: str, headers: dict, limite: int = 500) -> int:
+    session = requests.Session()
+    conn = get_db_connection(db_name)
+    cursor = conn.cursor()
+    aplicados = 0
+    
+    try:
+        since = ler_controle(cursor, 'seq_matriz')
+        while True:
+            response = circuitos.request(
+                'matriz',
+                "GET",
+                f"{matriz_url}/alteracoes",
+                session=session,
+                params={"since": since, "limite": limite},
+                headers=headers,
+                timeout=10
+            )
+            response.raise_for_status()
+            pagina = response.json()
+            
+            if pagina['itens']:
+                aplicar_catalogo(cursor, pagina['itens'])
+                since = pagina['ultima_seq']
+                gravar_controle(cursor, 'seq_matriz', since)
+                conn.commit()
+                aplicados += len(pagina['itens'])
+            
+            if not pagina['tem_mais']:
+                break
+    finally:
+        conn.close()
+        session.close()
+    
+    return aplicados
+
+def carregar_snapshot(db_name: str, matriz_url: str, headers: dict, lote: int = 1000) -> int:
+    conn = get_db_connection(db_name)
+    cursor = conn.cursor()
+    aplicados = 0
+    
+    try:
+        with circuitos.request('matriz', "GET", f"{matriz_url}/snapshot", headers=headers, stream=True, timeout=30) as response:
+            response.raise_for_status()
+            linhas = response.iter_lines()
+            cabecalho = json.loads(next(linhas))
+            
+            iniciar_escrita(conn)
+            itens = []
+            for linha in linhas:
+                if not linha:
+                    continue
+                itens.append(json.loads(linha))
+                if len(itens) >= lote:
+                    aplicar_catalogo(cursor, itens)
+                    aplicados += len(itens)
+                    itens = []
+            if itens:
+                aplicar_catalogo(cursor, itens)
+                aplicados += len(itens)
+            
+            gravar_controle(cursor, 'seq_matriz', cabecalho['seq'])
+            conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    
+    return aplicados
+
+def sincronizar_catalogo(db_name: str, matriz_url: str, headers: dict) -> int:
+    conn = get_db_connection(db_name)
+    seq_local = ler_controle(conn.cursor(), 'seq_matriz')
+    conn.close()
+    
+    aplicados = 0
+    if seq_local == 0:
+        aplicados += carregar_snapshot(db_name, matriz_url, headers)
+    aplicados += sincronizar_alteracoes(db_name, matriz_url, headers)
+    return aplicados
+
+def reconciliar_merkle(db_name: str, matriz_url: str, headers: dict) -> int:
+    session = requests.Session()
+    conn = get_db_connection(db_name)
+    cursor = conn.cursor()
+    
+    try:
+        # Desce a árvore só pelos nós com digest diferente, até chegar nas folhas divergentes
+        divergentes = [0]
+        for nivel in range(merkle.NIVEIS):
+            response = circuitos.request(
+                'matriz',
+                "POST",
+                f"{matriz_url}/merkle",
+                session=session,
+                json={"nivel": nivel, "nos": divergentes},
+                headers=headers,
+                timeout=10
+            )
+            response.raise_for_status()
+            remotos = response.json()['nos']
+            locais = merkle.filhos(cursor, nivel, divergentes)
+            
+            proximos = []
+            for no in divergentes:
+                for posicao, (local, remoto) in enumerate(zip(locais[no], remotos[str(no)])):
+                    if local != remoto:
+                        proximos.append(no * merkle.ARIDADE + posicao)
+            if not proximos:
+                return 0
+            divergentes = proximos
+        
+        response = circuitos.request(
+            'matriz',
+            "POST",
+            f"{matriz_url}/merkle/folhas",
+            session=session,
+            json={"folhas": divergentes},
+            headers=headers,
+            timeout=30
+        )
+        response.raise_for_status()
+        itens = response.json()['itens']
+        
+        aplicar_catalogo(cursor, itens)
+        conn.commit()
+        print(f"Anti-entropia: {len(divergentes)} faixas divergentes, {len(itens)} produtos reparados")
+        return len(itens)
+    finally:
+        conn.close()
+        session.close()
+
+class AntiEntropia:
+    def __init__(self, db_name: str, matriz_url: str, intervalo: float = 300.0):
+        self.db_name = db_name
+        self.matriz_url = matriz_url
+        self.intervalo = intervalo
+        self.parar = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+    
+    def executar(self) -> int:
+        token = create_access_token(data={"sub": "admin"}, expires_delta=timedelta(minutes=5))
+        headers = {"Authorization": f"Bearer {token}"}
+        return reconciliar_merkle(self.db_name, self.matriz_url, headers)
+    
+    def _loop(self):
+        while not self.parar.wait(self.intervalo):
+            try:
+                self.executar()
+            except Exception as e:
+                print(f"ERRO: Falha na anti-entropia com a matriz: {e}")
+    
+    def start(self):
+        self.thread = threading.Thread(target=self._loop, name="anti-entropia", daemon=True)
+        self.thread.start()
+    
+    def stop(self):
+        self.parar.set()
@@ -0,0 +1,25 @@
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shared.database import init_database, get_db_connection
+from shared.outbox import init_outbox
+from shared.reservas import init_reservas
+from shared.escrow import init_cotas_matriz
+
+@pytest.fixture
+def matriz(tmp_path):
+    # Banco da matriz com as tabelas de replicação, reservas e cotas, como no startup da API
+    db_name = str(tmp_path / "matriz.db")
+    init_database(db_name, "Testes")
+    init_outbox(db_name)
+    init_reservas(db_name)
+    init_cotas_matriz(db_name)
+
+    conn = get_db_connection(db_name)
+    yield conn
+    conn.rollback()
+    conn.close()
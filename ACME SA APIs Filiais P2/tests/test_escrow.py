@@ -0,0 +1,72 @@
+import pytest
+from fastapi import HTTPException
+
+from shared.database import init_database, get_db_connection
+from shared.escrow import COTA_TTL_S, init_cotas_filial, sincronizar_cotas, consultar_cotas, consumir_cota
+from shared.repositorio import RepositorioSQLite
+from shared.reservas import baixar_itens
+
+def estoque(cursor, codigo):
+    return RepositorioSQLite(cursor).buscar_produto(codigo)['quantidade']
+
+def sincronizar(cursor, consumido_total=0, vendido_total=0):
+    item = {"codigo_produto": "P", "consumido_total": consumido_total, "devolvido_total": 0, "vendido_total": vendido_total}
+    return sincronizar_cotas(cursor, "alipio", [item])[0]
+
+def expirar(cursor):
+    cursor.execute("UPDATE cotas_escrow SET sincronizado_em = sincronizado_em - ?", (COTA_TTL_S + 1,))
+
+@pytest.fixture
+def cursor(matriz):
+    cursor = matriz.cursor()
+    RepositorioSQLite(cursor).criar_produto("P", "Produto", 1.0, 100)
+    return cursor
+
+def test_cota_expirada_continua_separada_ate_a_filial_informar(cursor):
+    assert sincronizar(cursor, vendido_total=100)['concedido_total'] == 50
+
+    # A filial some depois de vender a cota inteira sem conseguir informar
+    expirar(cursor)
+    assert consultar_cotas(cursor)['itens'][0]['expirada']
+
+    with pytest.raises(HTTPException) as erro:
+        baixar_itens(cursor, {"P": 100}, None)
+    assert erro.value.status_code == 400
+    baixar_itens(cursor, {"P": 50}, None)
+
+    cota = sincronizar(cursor, consumido_total=50, vendido_total=150)
+    assert cota['devolver'] == 0
+    assert estoque(cursor, "P") == 0
+
+def test_filial_que_volta_devolve_a_cota_expirada(cursor):
+    sincronizar(cursor, vendido_total=100)
+    expirar(cursor)
+
+    cota = sincronizar(cursor, consumido_total=20, vendido_total=120)
+    assert cota['devolver'] == 30
+    assert cota['concedido_total'] == 50
+    assert estoque(cursor, "P") == 80
+
+def test_consumo_tardio_nao_deixa_estoque_negativo(cursor):
+    sincronizar(cursor, vendido_total=100)
+    cursor.execute("UPDATE estoque SET quantidade = 20")
+
+    sincronizar(cursor, consumido_total=50, vendido_total=150)
+    assert estoque(cursor, "P") == 0
+
+def test_consumir_cota_exige_cota_com_saldo_em_toda_linha(tmp_path):
+    db_name = str(tmp_path / "filial.db")
+    init_database(db_name, "Testes")
+    init_cotas_filial(db_name)
+    conn = get_db_connection(db_name)
+    cursor = conn.cursor()
+    produto_id = RepositorioSQLite(cursor).criar_produto("P", "Produto", 1.0, 10)
+    outro_id = RepositorioSQLite(cursor).criar_produto("Q", "Outro", 1.0, 10)
+    cursor.execute("INSERT INTO cotas_locais (produto_id, concedido_total) VALUES (?, 5)", (produto_id,))
+
+    assert not consumir_cota(cursor, [{"produto_id": outro_id, "quantidade": -50}])
+    assert not consumir_cota(cursor, [{"produto_id": produto_id, "quantidade": 0}])
+    assert not consumir_cota(cursor, [{"produto_id": produto_id, "quantidade": 2}, {"produto_id": outro_id, "quantidade": 1}])
+    assert consumir_cota(cursor, [{"produto_id": produto_id, "quantidade": 5}])
+    conn.rollback()
+    conn.close()
@@ -0,0 +1,71 @@
+import sqlite3
+
+from shared.database import MIGRACOES, init_database, get_db_connection, versao_schema, ler_controle
+from shared.merkle import NUM_FOLHAS
+
+# Schema do banco antes das migrações, como as APIs criavam na primeira versão
+SCHEMA_ORIGINAL = """
+    CREATE TABLE usuarios (id INTEGER PRIMARY KEY AUTOINCREMENT, login TEXT UNIQUE NOT NULL, password TEXT NOT NULL,
+                           criado_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+    CREATE TABLE produtos (id INTEGER PRIMARY KEY AUTOINCREMENT, codigo TEXT UNIQUE NOT NULL, nome TEXT NOT NULL,
+                           preco REAL NOT NULL, criado_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+    CREATE TABLE estoque (id INTEGER PRIMARY KEY AUTOINCREMENT, produto_id INTEGER NOT NULL, quantidade INTEGER NOT NULL DEFAULT 0,
+                          atualizado_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+    CREATE TABLE pedidos (id INTEGER PRIMARY KEY AUTOINCREMENT, total REAL NOT NULL, criado_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+    CREATE TABLE pedidos_itens (id INTEGER PRIMARY KEY AUTOINCREMENT, pedido_id INTEGER NOT NULL, produto_id INTEGER NOT NULL,
+                                quantidade INTEGER NOT NULL, preco_unitario REAL NOT NULL, subtotal REAL NOT NULL);
+    INSERT INTO produtos (codigo, nome, preco) VALUES ('P', 'Produto', 2.0);
+    INSERT INTO estoque (produto_id, quantidade) VALUES (1, 5);
+    INSERT INTO estoque (produto_id, quantidade) VALUES (1, 8);
+    INSERT INTO pedidos (total, criado_em) VALUES (6.0, '2026-01-02 10:00:00');
+    INSERT INTO pedidos_itens (pedido_id, produto_id, quantidade, preco_unitario, subtotal) VALUES (1, 1, 3, 2.0, 6.0);
+"""
+
+def colunas(conn, tabela):
+    return {linha['name'] for linha in conn.execute(f"PRAGMA table_info({tabela})")}
+
+def test_banco_novo_fica_na_ultima_versao(tmp_path):
+    db_name = str(tmp_path / "novo.db")
+    init_database(db_name, "Testes")
+
+    conn = get_db_connection(db_name)
+    assert versao_schema(conn) == MIGRACOES[-1][0]
+    assert {"seq", "folha"} <= colunas(conn, "produtos")
+    assert {"seq", "origem"} <= colunas(conn, "estoque")
+    assert conn.execute("SELECT COUNT(*) FROM merkle_folhas").fetchone()[0] == NUM_FOLHAS
+    conn.close()
+
+def test_banco_original_e_migrado_no_lugar(tmp_path):
+    db_name = str(tmp_path / "original.db")
+    original = sqlite3.connect(db_name)
+    original.executescript(SCHEMA_ORIGINAL)
+    original.close()
+
+    init_database(db_name, "Testes")
+
+    conn = get_db_connection(db_name)
+    assert versao_schema(conn) == MIGRACOES[-1][0]
+    estoque = conn.execute("SELECT quantidade, seq FROM estoque").fetchall()
+    assert [tuple(linha) for linha in estoque] == [(8, 2)]
+    assert ler_controle(conn.cursor(), 'seq') == 2
+    assert tuple(conn.execute("SELECT dia, pedidos, itens, receita FROM vendas_diarias").fetchone()) == ("2026-01-02", 1, 3, 6.0)
+    assert conn.execute("SELECT COUNT(*) FROM merkle_folhas WHERE digest != 0").fetchone()[0] == 1
+    conn.close()
+
+def test_banco_com_colunas_criadas_antes_das_migracoes(tmp_path):
+    # Bancos na versão 3 já tinham seq, folha, totais e idempotência, criados sem migração
+    db_name = str(tmp_path / "versao3.db")
+    init_database(db_name, "Testes")
+    conn = get_db_connection(db_name)
+    conn.execute("INSERT INTO produtos (codigo, nome, preco, seq) VALUES ('P', 'Produto', 2.0, 7)")
+    conn.execute("INSERT INTO estoque (produto_id, quantidade, seq) VALUES (1, 5, 7)")
+    digests = conn.execute("SELECT digest FROM merkle_folhas ORDER BY folha").fetchall()
+    conn.execute("PRAGMA user_version = 3")
+    conn.commit()
+
+    init_database(db_name, "Testes")
+
+    assert versao_schema(conn) == MIGRACOES[-1][0]
+    assert tuple(conn.execute("SELECT quantidade, seq FROM estoque").fetchone()) == (5, 7)
+    assert conn.execute("SELECT digest FROM merkle_folhas ORDER BY folha").fetchall() == digests
+    conn.close()
@@ -0,0 +1,75 @@
+import pytest
+
+from shared.database import init_database, get_db_connection
+from shared.escritor import EscritorUnico, IniciarCursorReplica, AvancarCursorReplica, LimparOutbox
+from shared.outbox import (
+    OutboxWorker, init_outbox, registrar_evento, iniciar_cursor_replica, avancar_cursor_replica, limpar_outbox
+)
+
+class Dispatcher:
+    def __init__(self):
+        self.enviados = []
+
+    def enviar(self, name, url, metodo, caminho, payload, headers, json_body=None):
+        self.enviados.append((name, caminho, json_body if json_body is not None else payload))
+        return {"ok": True, "status_code": 200}
+
+@pytest.fixture
+def escritor(tmp_path):
+    db_name = str(tmp_path / "matriz.db")
+    init_database(db_name, "Testes")
+    init_outbox(db_name)
+
+    # Os mesmos comandos que a matriz registra no seu escritor
+    escritor = EscritorUnico(db_name)
+    escritor.comando(IniciarCursorReplica)(lambda cursor, comando: iniciar_cursor_replica(cursor, comando.replica))
+    escritor.comando(AvancarCursorReplica)(
+        lambda cursor, comando: avancar_cursor_replica(
+            cursor, comando.replica, comando.ultimo_id, comando.tentativas, comando.proxima_tentativa, comando.erro
+        )
+    )
+    escritor.comando(LimparOutbox)(lambda cursor, comando: limpar_outbox(cursor, comando.replicas))
+    escritor.start()
+    yield escritor
+    escritor.stop()
+
+def registrar_estoque(db_name, codigo, quantidade, origem=None):
+    conn = get_db_connection(db_name)
+    registrar_evento(conn.cursor(), "PUT", f"/estoque/{codigo}", {"quantidade_atual": quantidade, "origem": "matriz"}, origem)
+    conn.commit()
+    conn.close()
+
+def test_lote_de_estoque_nao_volta_para_a_filial_de_origem(escritor):
+    replicas = {"alipio": "http://alipio", "laranjeiras": "http://laranjeiras"}
+    dispatcher = Dispatcher()
+    worker = OutboxWorker(escritor.db_name, replicas, dispatcher, lambda comando: escritor.enviar(comando).result())
+    for name, url in replicas.items():
+        worker._drenar_replica_sync(name, url)
+
+    registrar_estoque(escritor.db_name, "P", 10)
+    registrar_estoque(escritor.db_name, "P", 7, "Alipio ACME/SA API")
+    registrar_estoque(escritor.db_name, "Q", 3, "Alipio ACME/SA API")
+    registrar_estoque(escritor.db_name, "R", 5)
+
+    for name, url in replicas.items():
+        worker._drenar_replica_sync(name, url)
+
+    lotes = {name: body['itens'] for name, caminho, body in dispatcher.enviados if caminho == "/estoque/lote"}
+    assert lotes['alipio'] == [{"codigo_produto": "R", "quantidade_atual": 5}]
+    assert sorted(lotes['laranjeiras'], key=lambda item: item['codigo_produto']) == [
+        {"codigo_produto": "P", "quantidade_atual": 7},
+        {"codigo_produto": "Q", "quantidade_atual": 3},
+        {"codigo_produto": "R", "quantidade_atual": 5}
+    ]
+    assert worker.drenagens['alipio']['ultimo_id'] == worker.drenagens['laranjeiras']['ultimo_id']
+
+def test_cursor_passa_dos_eventos_da_propria_filial(escritor):
+    dispatcher = Dispatcher()
+    worker = OutboxWorker(escritor.db_name, {"alipio": "http://alipio"}, dispatcher, lambda comando: escritor.enviar(comando).result())
+    worker._drenar_replica_sync("alipio", "http://alipio")
+
+    registrar_estoque(escritor.db_name, "P", 7, "Alipio ACME/SA API")
+
+    assert worker._drenar_replica_sync("alipio", "http://alipio")
+    assert not worker._drenar_replica_sync("alipio", "http://alipio")
+    assert dispatcher.enviados == []
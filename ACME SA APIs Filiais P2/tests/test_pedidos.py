@@ -0,0 +1,29 @@
+import pytest
+from fastapi import HTTPException
+
+from shared.pedidos import validar_itens
+from shared.repositorio import RepositorioSQLite
+
+@pytest.mark.parametrize("item", [
+    {"codigo_produto": "P", "quantidade": -50},
+    {"codigo_produto": "P", "quantidade": 0},
+    {"codigo_produto": "P", "quantidade": "2"},
+    {"codigo_produto": "P", "quantidade": 1.5},
+    {"codigo_produto": "P"},
+    "P"
+])
+def test_validar_itens_recusa_item_invalido(matriz, item):
+    repositorio = RepositorioSQLite(matriz.cursor())
+    repositorio.criar_produto("P", "Produto", 1.0, 10)
+
+    with pytest.raises(HTTPException) as erro:
+        validar_itens(repositorio, [item])
+    assert erro.value.status_code == 400
+
+def test_validar_itens_soma_o_total(matriz):
+    repositorio = RepositorioSQLite(matriz.cursor())
+    repositorio.criar_produto("P", "Produto", 2.5, 10)
+
+    total, itens = validar_itens(repositorio, [{"codigo_produto": "P", "quantidade": 4}])
+    assert total == 10.0
+    assert itens[0]['quantidade'] == 4
@@ -0,0 +1,23 @@
+import pytest
+
+from shared.database import get_db_connection
+from benchmarks.planos import CONSULTAS, banco_completo, plano, problemas_do_plano
+
+@pytest.fixture(scope="module")
+def banco(tmp_path_factory):
+    conn = get_db_connection(banco_completo(str(tmp_path_factory.mktemp("planos"))))
+    # Confere o schema antes do primeiro EXPLAIN, como o verificar_planos
+    conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+    yield conn
+    conn.close()
+
+@pytest.mark.parametrize("nome, sql, parametros", CONSULTAS, ids=[nome for nome, _, _ in CONSULTAS])
+def test_consulta_do_caminho_quente_usa_indice(banco, nome, sql, parametros):
+    detalhes = plano(banco, sql, parametros)
+    assert problemas_do_plano(sql, detalhes) == [], detalhes
+
+def test_scan_de_indice_sem_limit_le_o_indice_inteiro():
+    detalhes = ["SCAN p USING COVERING INDEX sqlite_autoindex_produtos_1"]
+    assert problemas_do_plano("SELECT codigo FROM produtos p ORDER BY codigo", detalhes) == detalhes
+    assert problemas_do_plano("SELECT codigo FROM produtos p ORDER BY codigo LIMIT ?", detalhes) == []
+    assert problemas_do_plano("SELECT codigo FROM produtos p LIMIT ?", detalhes) == detalhes
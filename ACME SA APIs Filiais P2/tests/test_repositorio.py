@@ -0,0 +1,24 @@
+import pytest
+
+from shared.database import init_database
+from shared.repositorio import ArmazenamentoSQLite, ArmazenamentoMemoria
+
+@pytest.fixture(params=["sqlite", "memoria"])
+def armazenamento(request, tmp_path):
+    if request.param == "memoria":
+        return ArmazenamentoMemoria()
+    db_name = str(tmp_path / "repositorio.db")
+    init_database(db_name, "Testes")
+    return ArmazenamentoSQLite(db_name)
+
+def test_escrita_na_transacao_aberta_aparece_na_leitura(armazenamento):
+    with armazenamento.escrita() as repositorio:
+        produto_id = repositorio.criar_produto("P", "Produto", 1.0, 10)
+
+    # Como no escritor da matriz: o cursor é de uma transação aberta por outro código
+    with armazenamento.escrita() as repositorio:
+        with armazenamento.na_transacao(getattr(repositorio, 'cursor', None)) as na_transacao:
+            na_transacao.definir_estoque(produto_id, 7)
+
+    with armazenamento.leitura() as repositorio:
+        assert repositorio.buscar_produto("P")['quantidade'] == 7